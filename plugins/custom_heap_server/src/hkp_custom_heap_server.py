@@ -48,9 +48,7 @@ class CustomHeapGenerator(hkweb.IndexGenerator):
         **Returns:** |HtmlText|
         """
 
-        def post_in_heap(post):
-            return post.heap_id() == self._heap_id
-        posts = self._postdb.all().collect(post_in_heap)
+        posts = self._postdb.posts_in_heap(self._heap_id)
 
         # Getting the posts in the interesting threads
         xpostitems = self.walk_exp_posts(posts)
@@ -59,7 +59,7 @@ class BaseITGenerator(hkgen.BaseGenerator):
     # Initialization
 
     def __init__(self, postdb, heap_id):
-        hkgen.BaseGenerator.__init__(postdb)
+        hkgen.BaseGenerator.__init__(self, postdb)
         BaseITGenerator.init(self, heap_id)
 
     def init(self, heap_id):
@@ -81,6 +81,15 @@ class BaseITGenerator(hkgen.BaseGenerator):
                 post.has_tag('bug') or
                 post.has_tag('feature'))
 
+    def issue_tagged_posts(self):
+        # The posts are looked up in the tag and heap indexes of the post
+        # database
+        postdb = self._postdb
+        posts = postdb.postbitset([])
+        for tag in ('prop', 'issue', 'bug', 'feature'):
+            posts |= postdb.posts_with_tag(tag)
+        return posts & postdb.posts_in_heap(self._heap_id)
+
     def is_thread_issue(self, root):
         for post in self._postdb.postset(root).expf():
             if (post.heap_id() == self._heap_id and
@@ -108,17 +117,19 @@ class BaseITGenerator(hkgen.BaseGenerator):
 
     def calc(self):
 
-        # These are the threads and posts that are interesting for us
-        postdb = self._postdb
-        roots = postdb.postset(postdb.roots())
-        issue_threads = roots.collect(self.is_thread_issue)
+        # These are the threads and posts that are interesting for us. The
+        # sections are calculated with post bit sets, whose set operations
+        # are cheap; they are converted to post sets when stored. The issue
+        # threads are the threads of the posts with an issue tag, which are
+        # looked up in the tag index instead of walking all threads.
+        issue_threads = self.issue_tagged_posts().thread_roots()
         issue_posts = issue_threads.expf().collect(self.is_post_wanted)
 
         open_threads = issue_threads.collect(self.is_thread_open)
         open_posts = open_threads.expf() & issue_posts
 
         review_needed_posts = issue_posts.collect(self.is_review_needed)
-        review_needed_threads = review_needed_posts.expb().collect.is_root()
+        review_needed_threads = review_needed_posts.thread_roots()
 
         all_section = issue_posts
         open_section = open_posts
@@ -126,16 +137,16 @@ class BaseITGenerator(hkgen.BaseGenerator):
             review_needed_posts.exp() & issue_posts - open_posts
         closed_section = issue_posts - open_section - review_needed_section
 
-        self.issue_threads = issue_threads
-        self.issue_posts = issue_posts
-        self.all_section = all_section
-        self.open_threads = open_threads
-        self.open_posts = open_posts
-        self.open_section = open_section
-        self.review_needed_posts = review_needed_posts
-        self.review_needed_threads = review_needed_threads
-        self.review_needed_section = review_needed_section
-        self.closed_section = closed_section
+        self.issue_threads = issue_threads.postset()
+        self.issue_posts = issue_posts.postset()
+        self.all_section = all_section.postset()
+        self.open_threads = open_threads.postset()
+        self.open_posts = open_posts.postset()
+        self.open_section = open_section.postset()
+        self.review_needed_posts = review_needed_posts.postset()
+        self.review_needed_threads = review_needed_threads.postset()
+        self.review_needed_section = review_needed_section.postset()
+        self.closed_section = closed_section.postset()
 
     # Printing the issues
 
@@ -571,15 +582,37 @@ def start(heap_id, url=None):
     hkweb.insert_urls(
         [url + '-threaded', make_CustomHeapServer(flat_issues=False)])
 
-    def issue_target(post, pattern):
-        postdb = post._postdb
-        root = postdb.root(post)
-        gen = BaseITGenerator(postdb)
+    def thread_predicate(pattern):
         if pattern == 'issue':
-            return gen.is_thread_issue(root)
+            return BaseITGenerator.is_thread_issue
         elif pattern == 'open':
-            return gen.is_thread_open(root)
+            return BaseITGenerator.is_thread_open
         else:
-            return False
+            return None
 
-    hksearch.add_target_type('issue', issue_target)
+    def issue_target(post, pattern):
+        is_thread_wanted = thread_predicate(pattern)
+        if is_thread_wanted is None:
+            return False
+        postdb = post._postdb
+        gen = BaseITGenerator(postdb, heap_id)
+        return is_thread_wanted(gen, postdb.root(post))
+
+    def compile_issue_target(target):
+        # The generator is created only once per post database for a query
+        is_thread_wanted = thread_predicate(target.pattern)
+        if is_thread_wanted is None:
+            return lambda post: False
+
+        generators = {} # {PostDB: BaseITGenerator}
+        def issue_target_matches(post):
+            postdb = post._postdb
+            gen = generators.get(postdb)
+            if gen is None:
+                gen = BaseITGenerator(postdb, heap_id)
+                generators[postdb] = gen
+            return is_thread_wanted(gen, postdb.root(post))
+        return issue_target_matches
+
+    hksearch.add_target_type('issue', issue_target, compile_issue_target,
+                             cost=50)
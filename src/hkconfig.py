@@ -31,9 +31,17 @@ def unify_config(config):
         {'heaps': {HeapName: {'path': str,
                               ['id': str,]
                               ['name': str,]
+                              ['storage': ('directory' | 'packed'),]
                               [Server,]
                               ['nicknames': Nicknames]}},
-         ['paths': {['html_dir': str]}],
+         ['paths': {['html_dir': str,]
+                    ['cache_dir': str]}],
+         ['postdb': {['load_processes': str(int),]
+                     ['lazy_bodies': ('true' | 'false'),]
+                     ['max_resident_bodies': str(int),]
+                     ['search_index': ('true' | 'false'),]
+                     ['search_processes': str(int),]
+                     ['parallel_search_min_posts': str(int)]}],
          [Server,]
          ['nicknames': Nicknames],
          ['accounts': Accounts]}
@@ -55,10 +63,18 @@ def unify_config(config):
 
     Unified format::
 
-        {'paths': {'html_dir': (str | None)},
+        {'paths': {'html_dir': (str | None),
+                   ['cache_dir': str]},
+         ['postdb': {['load_processes': int,]
+                     ['lazy_bodies': bool,]
+                     ['max_resident_bodies': int,]
+                     ['search_index': bool,]
+                     ['search_processes': int,]
+                     ['parallel_search_min_posts': int]}],
          'heaps': {HeapName: {'path': str,
                               'id': str,
                               'name': str,
+                              ['storage': ('directory' | 'packed'),]
                               [Server,]
                               'nicknames': Nicknames}},
          [Server,]
@@ -143,6 +159,20 @@ def unify_format_3(config):
     config.setdefault('paths', {})
     config['paths'].setdefault('html_dir', None)
 
+    # postdb
+    postdb = config.get('postdb', {})
+    for key in ('load_processes', 'max_resident_bodies', 'search_processes',
+                'parallel_search_min_posts'):
+        if key in postdb:
+            postdb[key] = int(postdb[key])
+    for key in ('lazy_bodies', 'search_index'):
+        if key in postdb:
+            value = postdb[key]
+            if value not in ('true', 'false'):
+                raise hkutils.HkException(
+                    'Incorrect value for postdb/%s: "%s"' % (key, value))
+            postdb[key] = (value == 'true')
+
     # heaps/<heap name>
     for heap_name, heap_dict in config['heaps'].items():
         assert isinstance(heap_dict['path'], str)
@@ -19,6 +19,8 @@
 """|hkemail| downloads emails and converts them into posts."""
 
 
+from __future__ import with_statement
+
 import base64
 import email
 import email.header
@@ -418,24 +420,27 @@ class EmailDownloader(object):
             # The final ')' element causes a single email to be represented
             # by 3 elements in the list of results.
 
-            for i in range(len(result) / 3):
-                number_str = result[i * 3][0]
-                number = number_str[0:number_str.index(' ')]
-                text = result[i * 3][1]
-                header = result[i * 3 + 1][1]
-                # Catch "Exception" # pylint: disable=W0703
-                try:
-                    post = self.create_post_from_email(header, text)
-                    self._postdb.add_new_post(post, self._heap_id)
-                    new_posts.append(post)
-                except Exception, e:
-                    hkutils.log('Error while downloading: %s' % e)
+            # The listeners of the post database are notified only once per
+            # fragment
+            with self._postdb.batch():
+                for i in range(len(result) / 3):
+                    number_str = result[i * 3][0]
+                    number = number_str[0:number_str.index(' ')]
+                    text = result[i * 3][1]
+                    header = result[i * 3 + 1][1]
+                    # Catch "Exception" # pylint: disable=W0703
+                    try:
+                        post = self.create_post_from_email(header, text)
+                        self._postdb.add_new_post(post, self._heap_id)
+                        new_posts.append(post)
+                    except Exception, e:
+                        hkutils.log('Error while downloading: %s' % e)
+                        downloaded_msg_count += 1
+                        continue
+                    if detailed_log:
+                        hkutils.log('Post #%s (#%s in INBOX) downloaded.' %
+                                    (post.post_index(), number))
                     downloaded_msg_count += 1
-                    continue
-                if detailed_log:
-                    hkutils.log('Post #%s (#%s in INBOX) downloaded.' %
-                                (post.post_index(), number))
-                downloaded_msg_count += 1
 
         hkutils.log('%d new message%s downloaded.' %
                     (downloaded_msg_count,
@@ -1028,7 +1028,8 @@ class BaseGenerator(object):
     # Printing and walking several post items
 
     # TODO: test
-    def walk_thread(self, root=None, threadstruct=None):
+    def walk_thread(self, root=None, threadstruct=None,
+                    share_postitems=False):
         """Walks the given thread.
 
         **Argument:**
@@ -1038,11 +1039,14 @@ class BaseGenerator(object):
         - `threadstruct` ({(``None`` | |PostId|): |PostId|} | ``None``) -- The
           thread structure to be used. If ``None``, the thread structure of the
           post database will be used.
+        - `share_postitems` (bool) -- If ``True``, one post item is yielded
+          for all positions of a post. See :func:`hklib.PostDB.walk_thread`.
 
         **Returns:** iterable(|PostItem|)
         """
 
-        return self._postdb.walk_thread(root, threadstruct, yield_inner=True)
+        return self._postdb.walk_thread(root, threadstruct, yield_inner=True,
+                                        share_postitems=share_postitems)
 
     # TODO test
     def walk_exp_posts(self, posts):
@@ -1066,7 +1070,7 @@ class BaseGenerator(object):
         assert(isinstance(posts, hklib.PostSet))
 
         # roots: roots of posts in `posts`; these threads have to be walked
-        roots = posts.expb().collect.is_root()
+        roots = posts.thread_roots()
         roots_list = roots.sorted_list()
 
         # posts_exp: thread mates of posts in `posts`; these posts have to be
@@ -1263,7 +1267,9 @@ class BaseGenerator(object):
         **Returns:** |HtmlText|
         """
 
-        normal_postitems = self.walk_thread(None)
+        # The post items are printed as soon as they are yielded, so one post
+        # item is enough for each post
+        normal_postitems = self.walk_thread(None, share_postitems=True)
         if self._postdb.has_cycle():
             cycle_postitems = self._postdb.walk_cycles()
             return (
@@ -1584,7 +1590,7 @@ class StaticGenerator(BaseGenerator):
         if posts is None:
             posts = self._postdb.all()
         outdated_posts = posts.collect(may_thread_page_of_post_be_outdated)
-        outdated_threads = outdated_posts.expb().collect.is_root()
+        outdated_threads = outdated_posts.thread_roots()
 
         return outdated_threads
 
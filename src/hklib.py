@@ -102,6 +102,25 @@ types in the documentation so we can talk about them easily.
 
   Real type: {(|PostId| | ``None``): [|PostId|]}
 
+.. _hklib_Snapshot:
+
+- **Snapshot** -- The parsed posts of a heap. A post index is assigned to
+  the stamp of the post (see :func:`HeapStorage.stamps`), and the header,
+  body and body offset parsed from it. The body is ``None`` if it was not
+  loaded.
+
+  Real type: {|PostIndex|: (object, {str: (str | [str])}, (str | ``None``),
+  int)}
+
+.. _hklib_PostField:
+
+- **PostField** -- The name of a field of a post that can be modified. It is
+  used to tell what was modified in a post. Possible values: ``'author'``,
+  ``'subject'``, ``'messid'``, ``'parent'``, ``'date'``, ``'tags'``,
+  ``'flags'``, ``'body'``.
+
+  Real type: str
+
 .. _hklib_PostDBEventListener:
 
 - **PostDBEventListener** -- An object or function that can be called when a
@@ -125,7 +144,13 @@ types in the documentation so we can talk about them easily.
 
 from __future__ import with_statement
 
+import array
+import bisect
+import collections
+import contextlib
+import cPickle
 import datetime
+import multiprocessing
 import os
 import os.path
 import re
@@ -194,12 +219,21 @@ class Post(object):
 
     - `_header` ({str: (str | [str])}) -- The header of the post. See
       the contents below.
-    - `_body` (str) -- The body of the post. The first character of the
-      body is not a whitespace. The last character is a newline character, and
-      the last but one character is not a whitespace. It does not contain any
-      ``\\r`` characters, newlines are stored as ``\\n``. The form of the body
-      expressed as a regular expression: ``(\\S|\\S[^\\r]*\\S)\\n``. The
-      :func:`set_body` function converts any given string into this format.
+    - `_body` (str | ``None``) -- The body of the post. The first character of
+      the body is not a whitespace. The last character is a newline character,
+      and the last but one character is not a whitespace. It does not contain
+      any ``\\r`` characters, newlines are stored as ``\\n``. The form of the
+      body expressed as a regular expression: ``(\\S|\\S[^\\r]*\\S)\\n``.
+      The :func:`set_body` function converts any given string into this
+      format. It is ``None`` if the body has not been read from the post file
+      yet; see :func:`body`.
+    - `_body_offset` (int | ``None``) -- The position of the body in the post
+      file. If it is not ``None``, the body is the same as the content of the
+      post file from that position, so it can be read (again) from there when
+      needed.
+    - `_stamp` (object | ``None``) -- The stamp of the post in the heap
+      storage (see :func:`HeapStorage.stamps`) when the post was read or
+      written last time. ``None`` if it is not known.
     - `_post_id` (|PostId| | None) -- The identifier of the post.
     - `_postdb` (|PostDB| | None) -- The post database object that contains the
       post. If `_postdb` is not ``None``, `_heapid` must not be ``None``
@@ -210,6 +244,18 @@ class Post(object):
     - `_meta_dict` ({str: (str | ``None``)}) -- Dictionary that contains meta
       text from the body.
     - `_body_object` (|Body|) -- The parsed body.
+    - `_datetime` (datetime.datetime | ``None`` | ``hkutils.NOT_SET``) -- The
+      date of the post as a datetime object.
+    - `_timestamp` (int | ``hkutils.NOT_SET``) -- The timestamp of the date
+      of the post.
+    - `_date_str` (str | ``hkutils.NOT_SET``) -- The date of the post as a
+      string in local time.
+    - `_sort_key` ((int, |PostId|) | ``hkutils.NOT_SET``) -- The key by which
+      the posts are sorted.
+
+    The `_datetime`, `_timestamp`, `_date_str` and `_sort_key` data attributes
+    are calculated lazily (see the :ref:`lazy_data_calculation_pattern`
+    pattern).
 
     The `_header` attribute is a dictonary that contains attributes of the post
     such as the subject. The `_header` always contains all the following items:
@@ -410,19 +456,45 @@ class Post(object):
         super(Post, self).__init__()
         # Catch "Exception" # pylint: disable=W0703
         try:
-            self._header, self._body = Post.parse(f, post_id)
-            self._post_id = Post.unify_post_id(post_id)
-            self._postdb = postdb
-            self._datetime = hkutils.NOT_SET
-            self._modified = not self.postfile_exists()
-            self._meta_dict = None
-            self._body_object = None
+            header, body = Post.parse(f, post_id)
         except Exception, e:
             exc_info = sys.exc_info()
             if (isinstance(e, hkutils.HkException) and hasattr(f, 'name')):
                 print exc_info[1]
                 exc_info[1].value += '\nwhile parsing post file "%s"' % f.name
             raise exc_info[0], exc_info[1], exc_info[2]
+        self._init_fields(header, body, post_id, postdb)
+
+    def _init_fields(self, header, body, post_id, postdb, body_offset=None):
+        """Initializes the data attributes of the post.
+
+        **Arguments:**
+
+        - `header` ({str: (str | [str])}) -- The header of the post in the
+          form returned by :func:`create_header`.
+        - `body` (str | ``None``) -- The body of the post. ``None`` means that
+          the body will be read from the post file when needed.
+        - `post_id` (|PostId| | ``None``) -- The post id of the post.
+        - `postdb` (|PostDB| | ``None``) -- The post database to which the post
+          belongs.
+        - `body_offset` (int | ``None``) -- The position of the body in the
+          post file. It must not be ``None`` if `body` is ``None``.
+        """
+
+        assert(body is not None or body_offset is not None)
+        self._header = header
+        self._body = body
+        self._body_offset = body_offset
+        self._stamp = None
+        self._post_id = Post.unify_post_id(post_id)
+        self._postdb = postdb
+        self._datetime = hkutils.NOT_SET
+        self._timestamp = hkutils.NOT_SET
+        self._date_str = hkutils.NOT_SET
+        self._sort_key = hkutils.NOT_SET
+        self._modified = not self.postfile_exists()
+        self._meta_dict = None
+        self._body_object = None
 
     @staticmethod
     def from_str(s, post_id=None, postdb=None):
@@ -462,6 +534,34 @@ class Post(object):
         with open(filename, 'r') as f:
             return Post(f, Post.unify_post_id(post_id), postdb)
 
+    @staticmethod
+    def from_parsed(header, body, post_id=None, postdb=None, body_offset=None):
+        """Creates a post object from an already parsed header and body.
+
+        **Arguments:**
+
+        - `header` ({str: (str | [str])}) -- The header of the post in the
+          form returned by :func:`create_header`. The post will own the
+          dictionary, so it should not be used by the caller afterwards.
+        - `body` (str | ``None``) -- The body of the post in the form returned
+          by :func:`parse`. If ``None``, the body will be read from the post
+          file when it is needed for the first time.
+        - `post_id` (|PostId| | ``None``) -- The post id of the post.
+        - `postdb` (|PostDB| | ``None``) -- The post database to which the post
+          belongs.
+        - `body_offset` (int | ``None``) -- The position of the body in the
+          post file. It must be given if `body` is ``None``.
+
+        **Returns:** |Post|
+        """
+
+        assert(postdb is None or Post.is_post_id(post_id))
+        assert(body is not None or postdb is not None)
+        post = Post.__new__(Post)
+        super(Post, post).__init__()
+        post._init_fields(header, body, post_id, postdb, body_offset)
+        return post
+
     @staticmethod
     def create_empty(post_id=None, postdb=None):
         """Creates an empty post object.
@@ -479,7 +579,7 @@ class Post(object):
 
     # Modifications
 
-    def touch(self, touch_postdb=True):
+    def touch(self, touch_postdb=True, fields=None):
         """Should be called each time after the post is modified.
 
         See also the :ref:`lazy_data_calculation_pattern` pattern.
@@ -487,14 +587,24 @@ class Post(object):
         **Arguments:**
 
         - `touch_postdb` (bool) -- Touch the post database.
+        - `fields` (iterable(str) | ``None``) -- The fields of the post that
+          were modified (see |PostField|). ``None`` means that any field may
+          have been modified.
         """
 
+        if fields is not None:
+            fields = frozenset(fields)
         self._modified = True
-        self._datetime = hkutils.NOT_SET
-        self._meta_dict = None
-        self._body_object = None
+        if fields is None or 'date' in fields:
+            self._datetime = hkutils.NOT_SET
+            self._timestamp = hkutils.NOT_SET
+            self._date_str = hkutils.NOT_SET
+            self._sort_key = hkutils.NOT_SET
+        if fields is None or 'body' in fields:
+            self._meta_dict = None
+            self._body_object = None
         if self._postdb is not None and touch_postdb:
-            self._postdb.touch(self)
+            self._postdb.touch(self, fields)
 
     def is_modified(self):
         """Returns whether the post is modified.
@@ -506,6 +616,15 @@ class Post(object):
 
         return self._modified
 
+    def stamp(self):
+        """Returns the stamp of the post in the heap storage when the post was
+        read or written last time.
+
+        **Returns:** object | ``None``
+        """
+
+        return self._stamp
+
     # post id fields
 
     def post_id(self):
@@ -566,7 +685,7 @@ class Post(object):
         """
 
         self._header['Author'] = author
-        self.touch()
+        self.touch(fields=['author'])
 
     # subject field
 
@@ -599,7 +718,7 @@ class Post(object):
         """
 
         self._header['Subject'] = subject
-        self.touch()
+        self.touch(fields=['subject'])
 
     # message id field
 
@@ -624,7 +743,7 @@ class Post(object):
         postdb = self._postdb
         if postdb is not None:
             postdb.notify_changed_messid(self, old_messid, messid)
-        self.touch()
+        self.touch(fields=['messid'])
 
     # parent field
 
@@ -645,7 +764,7 @@ class Post(object):
         """
 
         self._header['Parent'] = parent
-        self.touch()
+        self.touch(fields=['parent'])
 
     # date field
 
@@ -666,7 +785,7 @@ class Post(object):
         """
 
         self._header['Date'] = date
-        self.touch()
+        self.touch(fields=['date'])
 
     # TODO test
     def timestamp(self):
@@ -677,8 +796,35 @@ class Post(object):
         **Returns:** int
         """
 
-        date = self.date()
-        return int(hkutils.calc_timestamp(date)) if date != '' else 0
+        self._recalc_timestamp()
+        return self._timestamp
+
+    def _recalc_timestamp(self):
+        """Recalculates the `_timestamp` data attribute if needed.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._timestamp == hkutils.NOT_SET:
+            date = self.date()
+            if date != '':
+                self._timestamp = int(hkutils.calc_timestamp(date))
+            else:
+                self._timestamp = 0
+
+    def sort_key(self):
+        """Returns the key by which the posts are sorted.
+
+        The posts are sorted by their timestamps; posts with the same
+        timestamp are sorted by their post ids. Posts without a date have 0 as
+        their timestamp, so they precede the posts with a date.
+
+        **Returns:** (int, |PostId|)
+        """
+
+        if self._sort_key == hkutils.NOT_SET:
+            self._sort_key = (self.timestamp(), self.post_id())
+        return self._sort_key
 
     # TODO test
     def datetime(self):
@@ -716,11 +862,14 @@ class Post(object):
         **Returns:** str
         """
 
-        timestamp = self.timestamp()
-        if timestamp == 0:
-            return ''
-        else:
-            return time.strftime('%Y.%m.%d. %H:%M', localtime_fun(timestamp))
+        if self._date_str == hkutils.NOT_SET:
+            timestamp = self.timestamp()
+            if timestamp == 0:
+                self._date_str = ''
+            else:
+                self._date_str = \
+                    time.strftime('%Y.%m.%d. %H:%M', localtime_fun(timestamp))
+        return self._date_str
 
     # TODO test
     def before(self, *dt):
@@ -803,7 +952,7 @@ class Post(object):
         """
 
         self._header['Tag'] = sorted(tags)
-        self.touch()
+        self.touch(fields=['tags'])
 
     # TODO test
     def add_tag(self, tag):
@@ -818,7 +967,7 @@ class Post(object):
         if not self.has_tag(tag):
             self._header['Tag'].append(tag)
             self._header['Tag'].sort()
-        self.touch()
+        self.touch(fields=['tags'])
 
     # TODO test
     def remove_tag(self, tag):
@@ -831,7 +980,7 @@ class Post(object):
 
         if self.has_tag(tag):
             self._header['Tag'].remove(tag)
-        self.touch()
+        self.touch(fields=['tags'])
 
     # TODO test
     def has_tag(self, tag):
@@ -885,7 +1034,7 @@ class Post(object):
 
         assert(isinstance(flags, list))
         self._header['Flag'] = sorted(flags)
-        self.touch()
+        self.touch(fields=['flags'])
 
     # deletion
 
@@ -916,6 +1065,7 @@ class Post(object):
                       'Unknown type of field: %s' % (value,)
         self._header['Flag'] = ['deleted']
         self._body = ''
+        self._body_offset = None
         self.touch()
 
     # meta field
@@ -967,18 +1117,70 @@ class Post(object):
         """Recalculates the parsed body object."""
 
         if self._body_object is None:
-            self._body_object = hkbodyparser.parse(self._body)
+            self._body_object = hkbodyparser.parse(self.body())
 
     # body
 
     def body(self):
         """Returns the body of the post.
 
+        If the body has not been read yet, it is read from the post file.
+
         **Returns:** str
         """
 
+        self._recalc_body()
         return self._body
 
+    def _recalc_body(self):
+        """Reads the body from the post file if needed.
+
+        The body is read only if the stored post has not changed since the
+        post was read (i.e. its stamp is the same), because otherwise the
+        position of the body is not known.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._body is None:
+            storage = self._postdb.storage(self.heap_id())
+            if storage.stamp(self.post_index()) != self._stamp:
+                raise hkutils.HkException(
+                    'Post file "%s" has changed since post %s was read; '
+                    'the post database should be reloaded.' %
+                    (self.postfilename(), self.post_id_str()))
+            self._body = \
+                storage.read_body(self.post_index(), self._body_offset)
+            self._postdb.notify_body_loaded(self)
+
+    def is_body_loaded(self):
+        """Returns whether the body of the post is in the memory.
+
+        **Returns:** bool
+        """
+
+        return self._body is not None
+
+    def unload_body(self):
+        """Removes the body of the post from the memory if it can be read
+        again from the post file.
+
+        The body (and the data calculated from it) is dropped only if the post
+        is not modified and the position of the body in the post file is
+        known.
+
+        **Returns:** bool -- Whether the body was dropped.
+        """
+
+        if self._modified or self._body_offset is None:
+            return False
+        self._body = None
+        self._meta_dict = None
+        self._body_object = None
+        if self._postdb is not None:
+            self._postdb.notify_body_unloaded(self)
+        return True
+
     def set_body(self, body):
         """Sets the body of the post.
 
@@ -988,7 +1190,8 @@ class Post(object):
         """
 
         self._body = body.rstrip() + '\n'
-        self.touch()
+        self._body_offset = None
+        self.touch(fields=['body'])
 
     def body_contains(self, regexp):
         """Returns whether the body contains the given regexp.
@@ -1000,7 +1203,7 @@ class Post(object):
         **Returns:** bool
         """
 
-        return re.search(regexp, self._body) != None
+        return re.search(regexp, self.body()) != None
 
     # writing
 
@@ -1049,7 +1252,7 @@ class Post(object):
             write_list(attr)
 
         f.write('\n')
-        f.write(self._body)
+        f.write(self.body())
 
     def write_str(self, force_print=set()):
         """Writes the post to a string.
@@ -1077,9 +1280,34 @@ class Post(object):
         - `silent` (bool) --- Do not call :func:`PostDB.touch`.
         """
 
-        # Parsing the post file and returning if it is the same as the post
-        # object
         header, body = Post.parse(f, self._post_id)
+        self.read_parsed(header, body, silent)
+
+    def read_parsed(self, header, body, silent=False, body_offset=None):
+        """Sets the header and the body of the post to the given, already
+        parsed values.
+
+        If they are the same as the current ones, the post is not touched.
+
+        **Arguments:**
+
+        - `header` ({str: (str | [str])}) -- The new header in the form
+          returned by :func:`create_header`.
+        - `body` (str | ``None``) -- The new body in the form returned by
+          :func:`parse`. ``None`` means that the body is the same as the
+          content of the post file from `body_offset`, and it should be read
+          only when needed. In this case, the current body of the post must
+          not be loaded either, and the body is considered unchanged.
+        - `silent` (bool) --- Do not call :func:`PostDB.touch`.
+        - `body_offset` (int | ``None``) -- The position of the body in the
+          post file.
+        """
+
+        assert(body is not None or
+               (body_offset is not None and self._body is None))
+        self._body_offset = body_offset
+
+        # Returning if the new content is the same as the post object
         if header == self._header and body == self._body:
             return
 
@@ -1121,9 +1349,13 @@ class Post(object):
 
         assert(self._postdb != None)
         if self._modified:
-            with open(self.postfilename(), 'w') as f:
-                self.write(f)
-                self._modified = False
+            # The body has to be read before the post file is overwritten
+            self._recalc_body()
+            storage = self._postdb.storage(self.heap_id())
+            self._stamp = \
+                storage.write_post(self.post_index(), self.postfile_str())
+            self._modified = False
+            self._body_offset = None
 
     def load(self, silent=False):
         """(Re)loads the post from the disk.
@@ -1133,8 +1365,19 @@ class Post(object):
         - `silent` (bool) --- Do not call :func:`PostDB.touch`.
         """
 
-        with open(self.postfilename(), 'r') as f:
-            self.read(f, silent)
+        storage = self._postdb.storage(self.heap_id())
+        raw_header, body, body_offset = storage.read_post(self.post_index())
+        try:
+            if raw_header is None:
+                # `body` contains the error message
+                raise hkutils.HkException(body)
+            header = Post.create_header(raw_header, self._post_id)
+        except hkutils.HkException, e:
+            e.value += ('\nwhile parsing post file "%s"' %
+                        (self.postfilename(),))
+            raise
+        self.read_parsed(header, body, silent, body_offset)
+        self._stamp = storage.stamp(self.post_index())
 
     # Filenames
 
@@ -1206,7 +1449,8 @@ class Post(object):
         if self._postdb == None:
             return False
         else:
-            return os.path.exists(self.postfilename())
+            storage = self._postdb.storage(self.heap_id())
+            return storage.post_exists(self.post_index())
 
     # Post database
 
@@ -1241,7 +1485,7 @@ class Post(object):
         if isinstance(other, Post):
             return self.post_id() == other.post_id() and \
                    self._header == other._header and \
-                   self._body == other._body
+                   self.body() == other.body()
         else:
             return False
 
@@ -1255,12 +1499,10 @@ class Post(object):
     def __lt__(self, other):
         """Returns whether the post is smaller than another post.
 
-        The following method should be used to decide whether post1 or post2
-        is greater:
-
-        - If both of them have a timestamp and these are not equal, the post
-          with the later timestamp is greater.
-        - Otherwise the post with the greater heapid is the greater.
+        The posts are compared by their sort keys (see :func:`sort_key`), so
+        they are sorted in the same order as by :func:`PostSet.sorted_list`:
+        by their timestamps, and then by their post ids. Posts without a date
+        precede the posts with a date.
 
         **Arguments:**
 
@@ -1270,14 +1512,7 @@ class Post(object):
         """
 
         assert(isinstance(other, Post))
-        this_dt = self.datetime()
-        other_dt = other.datetime()
-        if this_dt and other_dt:
-            if this_dt < other_dt:
-                return True
-            elif this_dt > other_dt:
-                return False
-        return self.post_id() < other.post_id()
+        return self.sort_key() < other.sort_key()
 
     def __gt__(self, other):
         """Returns whether the post is greater than another post.
@@ -1290,7 +1525,7 @@ class Post(object):
         """
 
         assert(isinstance(other, Post))
-        return other.__lt__(self)
+        return self.sort_key() > other.sort_key()
 
     def __le__(self, other):
         """Returns whether the post is smaller or equal to another post.
@@ -1448,20 +1683,34 @@ class PostDBEvent(object):
 
     **Data attributes:**
 
-    - `type` (str) -- The type of the event. Currently always ``'touch'``.
-    - `post` (|Post| | ``None``) -- The post that was touched.
+    - `type` (str) -- The type of the event: ``'touch'`` if a post was
+      touched, ``'batch_touch'`` if posts were touched inside a
+      :func:`PostDB.batch` block, ``'touch_all'`` if any post may have
+      changed (e.g. the heaps were loaded).
+    - `post` (|Post| | ``None``) -- The post that was touched (in case of a
+      ``'touch'`` event).
+    - `posts` (|PostSet| | ``None``) -- The posts that were touched (in case
+      of a ``'batch_touch'`` event).
+    - `fields` (frozenset(|PostField|) | ``None``) -- The fields of the post
+      (or posts) that were modified. ``None`` means that any field may have
+      been modified.
     """
 
     # Unused arguments # pylint: disable=W0613
     def __init__(self,
                  type=hkutils.NOT_SET,
-                 post=None):
+                 post=None,
+                 posts=None,
+                 fields=None):
         """Constructor.
 
         **Arguments:**
 
         - `type` (str) -- The type of the event.
         - `post` (|Post| | ``None``) -- The post that was touched.
+        - `posts` (|PostSet| | ``None``) -- The posts that were touched.
+        - `fields` (frozenset(|PostField|) | ``None``) -- The fields of the
+          post that were modified.
         """
 
         super(PostDBEvent, self).__init__()
@@ -1476,1214 +1725,4142 @@ class PostDBEvent(object):
 
             <PostDBEvent with the following attributes:
             type = touch
-            post = <post my_heap/0>>
+            post = <post my_heap/0>
+            posts = None
+            fields = None>
         """
 
         s = '<PostDBEvent with the following attributes:'
-        for attr in ['type', 'post']:
+        for attr in ['type', 'post', 'posts', 'fields']:
             s += '\n%s = %s' % (attr, getattr(self, attr))
         s += '>'
         return s
 
 
-##### PostDB #####
+##### Heap storages #####
 
-class PostDB(object):
+def parse_post_file(filename, read_body=True, offset=0, length=None):
+    """Parses a post file or a post stored in a part of a file.
 
-    """The post database that stores and handles the posts.
+    This function is used by :func:`PostDB.parse_posts`, possibly in a
+    worker process, so it returns the error message instead of raising an
+    exception if the post is incorrect.
 
-    **Data attributes:**
+    **Arguments:**
 
-    - `_heaps` ({|HeapId|: str}) -- Assigns directory names to the heaps in
-      which they are stored in the file system.
-    - `post_id_to_post` ({|PostId|: |Post|}) -- Stores the posts assigned to
-      their post ids.
-    - `messid_to_post_id` ({|Messageid|, |PostId|}) -- Stores which messids and
-      post ids belong together.
-    - `_next_post_index` ({(|HeapId|, str): int}) -- A dictionary that assigns
-      the next free post indices to the heapid-prefix pairs. This is part of a
-      caching mechanism. If a prefix is not found here, the whole lookup
-      procedure is performed, then the results are added to this dictionary.
-      The next free post index for a prefix is a number for which numbers in
-      all other post indices with this prefix are smaller.
-    - `_html_dir` (str) -- The directory that contains the generated HTML
-      files.
-    - `listeners` ([|PostDBEventListener|]) -- Listeners that are called when
-      an event happens.
+    - `filename` (str)
+    - `read_body` (bool) -- If ``False``, only the header is parsed.
+    - `offset` (int) -- The position of the post in the file.
+    - `length` (int | ``None``) -- The length of the post in the file.
+      ``None`` means that the post lasts until the end of the file.
 
-    **Lazy data attributes:**
+    **Returns:** ({str: [str]}, (str | ``None``), int) | (``None``, str,
+    ``None``) -- The header as returned by :func:`Post.parse_header`, the
+    body (or ``None`` if it was not read) and the position of the body in the
+    file; or ``None`` and the error message.
+    """
 
-    These data attributes are part of the :ref:`lazy_data_calculation_pattern`
-    pattern.
+    try:
+        with open(filename, 'r') as f:
+            f.seek(offset)
+            if length is None:
+                raw_header = Post.parse_header(f)
+                body_offset = f.tell()
+                body_file = f
+            else:
+                body_file = StringIO.StringIO(f.read(length))
+                raw_header = Post.parse_header(body_file)
+                body_offset = offset + body_file.tell()
+            if read_body:
+                body = body_file.read().rstrip() + '\n'
+            else:
+                body = None
+        return raw_header, body, body_offset
+    except hkutils.HkException, e:
+        return None, str(e), None
 
-    - `_posts` ([|Post|] | ``None``) -- All non-deleted posts as a list. It can
-      be obtained using :func:`posts`.
-    - `_all` (|PostSet| | ``None``) -- All non-deleted posts as a post set. It
-      can be obtained using :func:`all`.
-    - `_threadstruct` (|ThreadStruct| | ``None``) -- Assigns the childrens of a
-      post to the post. Root posts are assigned to ``None``. It can be obtained
-      using :func:`threadstruct`.
-    - `_cycles` (|PostSet| | ``None``) -- Posts that are in a cycle in the
-      thread structure. These posts will not be iterated by the
-      :func:`iter_thread` function. It can be obtained using :func:`cycles`.
-    - `_roots` (|PostSet| | ``None``) -- The root posts. It can be obtained
-      using :func:`roots`.
-    - `_threads` ({|Post|: |PostSet|} | ``None``) -- A dictionary that assigns
-      posts in a thread to the root of the thread. It can be obtained using
-      :func:`threads`.
-    """
+def parse_post_task(task):
+    """Parses a post; a wrapper of :func:`parse_post_file` that can be used
+    with :func:`multiprocessing.Pool.map`.
 
-    # Constructors
+    **Argument:**
 
-    def __init__(self):
-        """Constructor."""
+    - `task` ((str, bool, int, (int | ``None``))) -- The arguments of
+      :func:`parse_post_file`.
 
-        super(PostDB, self).__init__()
-        self._heaps = {}
-        self.post_id_to_post = {}
-        self.messid_to_post_id = {}
-        self._html_dir = None
-        self._next_post_index = {}
-        self.listeners = []
-        self.touch()
+    **Returns:** ({str: [str]}, (str | ``None``), int) | (``None``, str,
+    ``None``) -- See :func:`parse_post_file`.
+    """
 
-    def add_post_to_dicts(self, post):
-        """Adds the post to the `heapid_to_post` and `messid_to_post_id`
-        dictionaries.
+    filename, read_body, offset, length = task
+    return parse_post_file(filename, read_body, offset, length)
 
-        **Arguments:**
+def read_post_body(filename, body_offset, body_end=None):
+    """Reads the body of a post from its post file.
 
-        - `post` (|Post|)
-        """
+    **Arguments:**
 
-        post_id = post.post_id()
-        self.post_id_to_post[post_id] = post
-        messid = post.messid()
-        if messid != '':
-            # Don't store the messid if it is already used
-            if messid in self.messid_to_post_id:
-                messid_user_post = self.messid_to_post_id[messid]
-                hkutils.log('Warning: post %s has message id %s, but that '
-                            'message id is already used by post %s.' %
-                            (post_id, messid, messid_user_post))
-            else:
-                self.messid_to_post_id[messid] = post_id
-        self.touch()
+    - `filename` (str)
+    - `body_offset` (int) -- The position of the body in the file.
+    - `body_end` (int | ``None``) -- The position of the end of the body in
+      the file. ``None`` means the end of the file.
 
-    def remove_post_from_dicts(self, post):
-        """Removed the post from the `heapid_to_post` and `messid_to_post_id`
-        dictionaries.
+    **Returns:** str -- The body in the form returned by :func:`Post.parse`.
+    """
 
-        **Arguments:**
+    with open(filename, 'r') as f:
+        f.seek(body_offset)
+        if body_end is None:
+            body = f.read()
+        else:
+            body = f.read(body_end - body_offset)
+    return body.rstrip() + '\n'
 
-        - `post` (|Post|)
-        """
 
-        post_id = post.post_id()
-        del self.post_id_to_post[post_id]
-        messid = post.messid()
-        if messid != '':
-            # We should remove the messid from messid_to_post_id only if `post`
-            # is stored as the owner of that messid
-            if self.messid_to_post_id.get(messid) == post_id:
-                del self.messid_to_post_id[post.messid()]
-        self.touch()
+class HeapStorage(object):
 
-    def load_heap(self, heap_id):
-        """Loading a heap from the disk.
+    """Stores the posts of a heap on the disk.
 
-        **Arguments:**
+    This is an abstract class. The subclasses have to implement
+    :func:`stamps`, :func:`post_source`, :func:`postfile_name`,
+    :func:`write_post`.
 
-        - `heap_id` (|HeapId|)
-        """
+    A post is stored as a text in post file format. It is located by its
+    *source*, which is the name of the file that contains the post, the
+    position of the post in the file and the length of the post (which is
+    ``None`` if the post lasts until the end of the file).
 
-        # We filter the posts in the given heap into `posts_in_heap` and remove
-        # them from the post_id_to_post and messid_to_post_id
-        posts_in_heap = {} # post index -> post
-        for post_id, post in list(self.post_id_to_post.items()):
-            if post_id[0] == heap_id:
-                self.remove_post_from_dicts(post)
-                posts_in_heap[post_id[1]] = post
+    **Data attributes:**
 
-        # We walk the heap directory and look for post files
+    - `_heap_dir` (str) -- The directory that contains the heap.
+    """
 
-        heap_dir = self._heaps[heap_id]
-        if not os.path.isdir(heap_dir):
-            raise hkutils.HkException('Directory %s not found.' % (heap_dir,))
+    def __init__(self, heap_dir):
+        """Constructor.
 
-        for file in os.listdir(heap_dir):
+        **Argument:**
 
-            if not file.endswith('.post'):
-                continue # if `file` is not a post file, skip it
+        - `heap_dir` (str)
+        """
 
-            post_index = file[:-5]
-            post_id = (heap_id, post_index)
-            post_file_absname = os.path.join(heap_dir, file)
+        super(HeapStorage, self).__init__()
+        self._heap_dir = heap_dir
 
-            # We try to obtain the post which has the post id `post_id`. If
-            # such a post exists (i.e. original_post_id_to_post contains
-            # `post_id`), the post should be reloaded from the disk. This
-            # way, if someone has a reference to post object, they will
-            # refer to the reloaded posts. If there is no post with
-            # `post_id`, a new Post object should be created.
-            post = posts_in_heap.get(post_index)
-            if post is None:
-                post = Post.from_file(post_file_absname, post_id, self)
-            else:
-                post.load(silent=True)
-            self.add_post_to_dicts(post)
+    def heap_dir(self):
+        """Returns the directory that contains the heap.
 
-        # We remove the entries about the given heap from the next_post_index
-        # cache
-        for curr_heap_id, prefix in list(self._next_post_index.keys()):
-            if curr_heap_id == heap_id:
-                del self._next_post_index[(curr_heap_id, prefix)]
+        **Returns:** str
+        """
 
-        self.touch()
+        return self._heap_dir
 
-    def add_heap(self, heap_id, heap_dir):
-        """Adds a heap to the post database and loads it.
+    def stamps(self):
+        """Returns the stamps of the stored posts.
 
-        **Arguments:**
+        A stamp of a post changes whenever the post is rewritten.
 
-        - `heap_id` (|HeapId|)
-        - `heap_dir` (str)
+        **Returns:** {|PostIndex|: object}
         """
 
-        self._heaps[heap_id] = heap_dir
-        if not os.path.exists(heap_dir):
-            hkutils.log('Warning: post directory does not exists: "%s"' %
-                        (heap_dir,))
-            os.mkdir(heap_dir)
-            hkutils.log('Post directory has been created.')
-        self.load_heap(heap_id)
+        raise NotImplementedError
 
-    def set_html_dir(self, html_dir):
-        """Sets the HTML directory.
+    def stamp(self, post_index):
+        """Returns the stamp of a stored post.
 
         **Argument:**
 
-        - `html_dir` (str)
+        - `post_index` (|PostIndex|)
+
+        **Returns:** object | ``None`` -- ``None`` if the post is not stored.
         """
 
-        self._html_dir = html_dir
-        if (html_dir is not None) and (not os.path.exists(html_dir)):
-            hkutils.log('Warning: HTML directory does not exists: "%s"' %
-                        (html_dir,))
-            os.mkdir(html_dir)
-            hkutils.log('HTML directory has been created.')
+        return self.stamps().get(post_index)
 
-    @staticmethod
-    def get_heaps_from_config(config):
-        """Gets the details of the heaps from a configuration object.
+    def post_source(self, post_index):
+        """Returns where the post is stored.
 
         **Argument:**
 
-        - `config` (|ConfigDict|)
+        - `post_index` (|PostIndex|)
 
-        **Returns:** {|HeapId|: str} -- The directory that stores the heap is
-        assigned to each heap.
+        **Returns:** (str, int, (int | ``None``)) -- The file name, position
+        and length of the post.
         """
 
-        heaps = {}
-        for heap_config in config['heaps'].values():
-            heaps[heap_config['id']] = heap_config['path']
-        return heaps
-
-    def read_config(self, config):
-        """Configures the post database according to a configuration object.
+        raise NotImplementedError
 
-        The `_html_dir` data attribute is set and heaps are added to the post
-        database.
+    def postfile_name(self, post_index):
+        """Returns the name of the file that contains (or would contain) the
+        post.
 
         **Argument:**
 
-        - `config` (|ConfigDict|)
+        - `post_index` (|PostIndex|)
+
+        **Returns:** str
         """
 
-        heaps = self.get_heaps_from_config(config)
-        html_dir = config['paths']['html_dir']
+        raise NotImplementedError
 
-        for heap_id, heap_dir in heaps.iteritems():
-            self.add_heap(heap_id, heap_dir)
-        self.set_html_dir(html_dir)
-
-    # Modifications
-
-    # TODO test
-    def notify_listeners(self, event):
-        """Notifies the listeners about an event.
+    def post_exists(self, post_index):
+        """Returns whether the post is stored.
 
         **Argument:**
 
-        - `event` (|PostDBEvent|)
-        """
-
-        for listener in self.listeners:
-            listener(event)
-
-    # TODO test
-    def touch(self, post=None):
-        """If something in the database changes, this function should be
-        called.
-
-        If a post in the database is changed, this function will be invoked
-        automatically, so there is no need to call it again.
-
-        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        - `post_index` (|PostIndex|)
 
-        **Argument:**
-
-        - `post` (|Post| | ``None``) -- The post concerned in the database
-          modification. If not ``None``, the listeners will be notified.
+        **Returns:** bool
         """
 
-        self._posts = None
-        self._all = None
-        self._threadstruct = None
-        self._cycles = None
-        self._roots = None
-        self._threads = None
-        if post != None:
-            self.notify_listeners(PostDBEvent(type='touch', post=post))
+        return post_index in self.stamps()
 
-    def notify_changed_messid(self, post, old_messid, new_messid):
-        """Should be called when the messid of a post changed.
+    def parse_task(self, post_index, read_body=True):
+        """Returns the task that parses the given post.
 
-        **Argument:**
+        **Arguments:**
 
-        - `post` (|Post|) -- The post whose messid changed.
-        - `old_messid` (|Messageid|) -- The old messid.
-        - `new_messid` (|Messageid|) -- The new messid.
-        """
+        - `post_index` (|PostIndex|)
+        - `read_body` (bool) -- If ``False``, only the header will be parsed.
 
-        post_id = post.post_id()
+        **Returns:** (str, bool, int, (int | ``None``)) -- See
+        :func:`parse_post_task`.
+        """
 
-        # We should remove the old messid from messid_to_post_id only if `post`
-        # is stored as the owner of that messid
-        if self.messid_to_post_id.get(old_messid) == post_id:
-            del self.messid_to_post_id[old_messid]
+        filename, offset, length = self.post_source(post_index)
+        return filename, read_body, offset, length
 
-        self.messid_to_post_id.setdefault(new_messid, post_id)
+    def read_post(self, post_index, read_body=True):
+        """Parses a stored post.
 
-    # Get-set functions
+        **Arguments:**
 
-    def has_post_id(self, post_id):
-        """Returns whether there is a post with the given post id.
+        - `post_index` (|PostIndex|)
+        - `read_body` (bool) -- If ``False``, only the header is parsed.
 
-        **Argument:**
+        **Returns:** ({str: [str]}, (str | ``None``), int) | (``None``, str,
+        ``None``) -- See :func:`parse_post_file`.
+        """
 
-        - `post_id` (|PostId|)
+        return parse_post_task(self.parse_task(post_index, read_body))
 
-        **Returns:** bool
-        """
+    def read_body(self, post_index, body_offset):
+        """Reads the body of a stored post.
 
-        return self.post_id_to_post.has_key(post_id)
+        **Arguments:**
 
-    def heap_ids(self):
-        """Returns the heap ids.
+        - `post_index` (|PostIndex|)
+        - `body_offset` (int) -- The position of the body as returned by
+          :func:`read_post`.
 
-        **Returns:** [|HeapId|]
+        **Returns:** str
         """
 
-        return self._heaps.keys()
+        filename, offset, length = self.post_source(post_index)
+        if length is None:
+            body_end = None
+        else:
+            body_end = offset + length
+        return read_post_body(filename, body_offset, body_end)
 
-    def has_heap_id(self, heap_id):
-        """Returns whether there is a heap with the given heap id.
+    def read_post_text(self, post_index):
+        """Reads the text of a stored post.
 
         **Argument:**
 
-        - `heap_id` (|HeapId|)
+        - `post_index` (|PostIndex|)
 
-        **Returns:** bool
+        **Returns:** str
         """
 
-        return self._heaps.has_key(heap_id)
+        filename, offset, length = self.post_source(post_index)
+        with open(filename, 'r') as f:
+            f.seek(offset)
+            if length is None:
+                return f.read()
+            else:
+                return f.read(length)
 
-    def next_post_index(self, heap_id, prefix=''):
-        """Returns the next free post index with the form ``prefix + int``.
+    def write_post(self, post_index, text):
+        """Stores a post.
 
-        The "next" here means the post index with smallest number which is
-        larger than all numbers present in all other post indices with the
-        given prefix.
+        **Arguments:**
 
-        This function uses a caching mechanism to avoid iterating over all
-        posts on each calling. This cache is the `_next_heapid` data member,
-        a dictionary where the keys are the prefixes. The empty prefix is
-        always cached, while other prefixes are cached after the first lookup.
+        - `post_index` (|PostIndex|)
+        - `text` (str) -- The post in post file format.
 
-        **Arguments**:
+        **Returns:** object -- The new stamp of the post.
+        """
 
-        - `heap_id` (|HeapId|) -- The heap in which the next free post index
-          should be found.
-        - `prefix` (str) -- The prefix of the new heapid.
+        raise NotImplementedError
 
-        **Returns**: |PostIndex|
+    def flush(self):
+        """Writes the pending changes of the storage to the disk.
+
+        The posts are always written by :func:`write_post`; this function only
+        writes the auxiliary data.
         """
 
-        cache = self._next_post_index
-        key = (heap_id, prefix)
+        pass
 
-        # If the heap_id+prefix pair is not in the cache, we put it there
-        if not cache.has_key(key):
-            numbers = []
-            for curr_post_id, _curr_post in self.post_id_to_post.iteritems():
-                curr_heap_id, curr_post_index = curr_post_id
-                if (curr_heap_id != heap_id or
-                    not curr_post_index.startswith(prefix)):
-                    continue
-                number_str = curr_post_index[len(prefix):]
-                try:
-                    numbers.append(int(number_str))
-                except ValueError:
-                    pass
-            if numbers == []:
-                cache[(heap_id, prefix)] = 1
-            else:
-                cache[(heap_id, prefix)] = max(numbers) + 1
 
-        # We find and return the first candidate index that is not used
-        while True:
-            next_candidate = prefix + str(cache[key])
-            cache[key] += 1
-            if not self.has_post_id((heap_id, next_candidate)):
-                return next_candidate
+class DirectoryHeapStorage(HeapStorage):
 
-    def invalidate_next_post_index_cache(self):
-        """Invalidates the "next post index" cache."""
+    """Stores each post of a heap in its own ``<heap dir>/<post index>.post``
+    file."""
 
-        self._next_post_index = {}
+    def stamps(self):
+        """Returns the stamps of the stored posts.
 
-    def real_posts(self):
-        """Returns the list of all posts, even the deleted ones.
+        The stamp of a post is the size and modification time of its post
+        file.
 
-        **Returns:** [|Post|]
+        **Returns:** {|PostIndex|: (int, float)}
         """
 
-        return self.post_id_to_post.values()
-
-    def posts(self):
-        """Returns the list of all posts that are not deleted.
+        heap_dir = self._heap_dir
+        if not os.path.isdir(heap_dir):
+            raise hkutils.HkException(
+                      'Directory %s not found.' % (heap_dir,))
 
-        The object returned by this function should not be modified.
+        stamps = {}
+        for file in os.listdir(heap_dir):
+            if not file.endswith('.post'):
+                continue # if `file` is not a post file, skip it
+            stat = os.stat(os.path.join(heap_dir, file))
+            stamps[file[:-5]] = (stat.st_size, stat.st_mtime)
+        return stamps
 
-        **Returns:** [|Post|]
-        """
+    def stamp(self, post_index):
+        """Returns the stamp of a stored post.
 
-        self._recalc_posts()
-        return self._posts
+        **Argument:**
 
-    def _recalc_posts(self):
-        """Recalculates the `_posts` data attribute if needed.
+        - `post_index` (|PostIndex|)
 
-        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        **Returns:** (int, float) | ``None``
         """
 
-        if self._posts == None:
-            self._posts = \
-                [ p for p in self.real_posts() if not p.is_deleted() ]
+        try:
+            stat = os.stat(self.postfile_name(post_index))
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
 
-    def postset(self, posts, default_heap=None):
-        """Creates a PostSet that will contain the specified posts.
+    def post_source(self, post_index):
+        """Returns where the post is stored.
 
-        **Arguments:**
+        **Argument:**
 
-        - `posts` (|PrePostSet|)
-        - `default_heap` (|HeapId| | ``None``)
+        - `post_index` (|PostIndex|)
 
-        **Returns:** |PostSet|
+        **Returns:** (str, int, ``None``)
         """
 
-        return PostSet(self, posts, default_heap)
+        return self.postfile_name(post_index), 0, None
 
-    def post_by_post_id(self, post_id):
-        """Finds a post by its post id.
+    def postfile_name(self, post_index):
+        """Returns the name of the post file: ``<heap dir>/<post
+        index>.post``.
 
         **Argument:**
 
-        - `post_id` (|PostId|)
+        - `post_index` (|PostIndex|)
 
-        **Returns:** |Post| | ``None``
+        **Returns:** str
         """
 
-        Post.assert_is_post_id(post_id)
-        return self.post_id_to_post.get(Post.unify_post_id(post_id))
+        return os.path.join(self._heap_dir, post_index + '.post')
 
-    def post_by_messid(self, messid):
-        """Finds a post by its message id.
+    def post_exists(self, post_index):
+        """Returns whether the post file exists.
 
         **Argument:**
 
-        - `post_id` (|Messageid|)
+        - `post_index` (|PostIndex|)
 
-        **Returns:** |Post| | ``None``
+        **Returns:** bool
         """
 
-        post_id = self.messid_to_post_id.get(messid)
-        if post_id is None:
-            return None
-        else:
-            return self.post_by_post_id(post_id)
-
-    def post(self, prepost, default_heap=None, raise_exception=False):
-        """Converts a |PrePost| into a |Post|.
+        return os.path.exists(self.postfile_name(post_index))
 
-        In other words, it returns the post specified by its post id or message
-        id or post index or the post itself. See the definition of |PrePost| on
-        how the conversion happens.
+    def write_post(self, post_index, text):
+        """Writes the post file of the post.
 
         **Arguments:**
 
-        - `prepost` (|PrePost|)
-        - `default_heap` (|HeapId| | ``None``)
-        - `raise_exception` (bool) -- Specifies what should happen it the post
-          is not found. If raise_exception is ``False``, ``None`` will be
-          returned, otherwise a |PostNotFoundError| exception will be raised.
+        - `post_index` (|PostIndex|)
+        - `text` (str)
 
-        **Returns:** |Post| | ``None``
+        **Returns:** (int, float)
+        """
 
-        **Raises:**
+        with open(self.postfile_name(post_index), 'w') as f:
+            f.write(text)
+        return self.stamp(post_index)
 
-        - |PostNotFoundError| -- The post was not found and `raise_exception`
-          was ``True``.
-        """
 
-        # Is `prepost` the post itself?
-        if isinstance(prepost, Post):
-            return prepost
+class PackedHeapStorage(HeapStorage):
 
-        # Try with `prepost` as post id
-        if Post.is_post_id(prepost):
-            post = self.post_by_post_id(prepost)
-            if post is not None:
-                return post
+    """Stores the posts of a heap in one append-only data file.
 
-        # Try with `(default_heap, prepost)` as post id
-        if (default_heap is not None
-            and Post.is_post_id((default_heap, prepost))):
+    The data file is ``<heap dir>/posts.pack``. When a post is written, a new
+    record is appended to the data file; the record contains a
+    ``<post index> <length>\\n`` line and the text of the post. The last
+    record of a post is the valid one.
 
-            post = self.post_by_post_id((default_heap, prepost))
-            if post is not None:
-                return post
+    The position of the latest record of the posts is stored in the index file
+    (``<heap dir>/posts.index``). The data file is always the authority: if
+    the index file does not cover the whole data file (e.g. because
+    :func:`flush` was not called after a write), the rest of the data file is
+    scanned when the storage is opened. An incomplete record at the end of
+    the data file (e.g. one left by an interrupted write) is removed then.
 
-        # Try with `prepost` as message id
-        if isinstance(prepost, str):
-            post = self.post_by_messid(prepost)
-            if post is not None:
-                return post
+    **Data attributes:**
 
-        if raise_exception:
-            raise PostNotFoundError(prepost)
-        else:
-            return None
+    - `_index` ({|PostIndex|: (int, int)}) -- The position and length of the
+      text of the posts in the data file.
+    - `_data_size` (int) -- The size of the data file covered by `_index`.
+    - `_index_written` (bool) -- Whether the index file is up-to-date.
+    """
 
-    # Save, reload
+    # The version of the index file format.
+    INDEX_VERSION = 1
 
-    def save(self):
-        """Saves all the posts that needs to be saved."""
-        for post in self.real_posts():
-            post.save()
+    def __init__(self, heap_dir):
+        """Constructor.
 
-    def reload(self):
-        """Reloads the database from the disk.
+        **Argument:**
 
-        The unsaved changes will be abandoned.
+        - `heap_dir` (str)
         """
 
-        for heap_id in self._heaps:
-            self.load_heap(heap_id)
+        super(PackedHeapStorage, self).__init__(heap_dir)
+        self._index = {}
+        self._data_size = 0
+        self._index_written = False
+        self.read_index()
 
-    # New posts
+    def data_file_name(self):
+        """Returns the name of the data file.
 
-    def add_new_post(self, post, heap_id, post_index=None, prefix=''):
-        """Adds a new post to the postdb.
+        **Returns:** str
+        """
 
-        **Arguments:**
+        return os.path.join(self._heap_dir, 'posts.pack')
 
-        - `post` (|Post|) -- The post to be added to the database.
-        - `heap_id` (|HeapId|) -- The heap to which the post is added.
-        - `post_index` (str | ``None``) -- The post should have this post
-          index. If ``None``, the post should get the next free post index
-          that starts with `prefix` (see the definition of "next free post
-          index" at :func:`next_post_index`).
-        - `prefix` (str) -- If `post_index` is ``None``, the post should get
-          the next free heapid that starts with `prefix`.
+    def index_file_name(self):
+        """Returns the name of the index file.
 
-        **Returns:** |Post|
+        **Returns:** str
         """
 
-        if post_index == None:
-            post_index = self.next_post_index(heap_id, prefix=prefix)
-        post.add_to_postdb((heap_id, post_index), self)
-        self.add_post_to_dicts(post)
-        return post
+        return os.path.join(self._heap_dir, 'posts.index')
 
-    # All posts
+    def read_index(self):
+        """Reads the index file and scans the part of the data file that is
+        not covered by it."""
 
-    def all(self):
-        """Returns the post set of all posts that are not deleted.
+        self._index = {}
+        self._data_size = 0
+        self._index_written = False
 
-        The object returned by this function should not be modified. On the
-        other hand, the posts contained by it can be modified.
+        index_file = self.index_file_name()
+        if os.path.exists(index_file):
+            # Catch "Exception" # pylint: disable=W0703
+            try:
+                with open(index_file, 'rb') as f:
+                    version, data_size, index = cPickle.load(f)
+                if version == PackedHeapStorage.INDEX_VERSION:
+                    self._index, self._data_size = index, data_size
+                    self._index_written = True
+            except Exception:
+                hkutils.log('Warning: corrupt index file ignored: "%s"' %
+                            (index_file,))
+
+        data_file = self.data_file_name()
+        if os.path.exists(data_file):
+            size = os.path.getsize(data_file)
+        else:
+            size = 0
+        if size < self._data_size:
+            # The data file was replaced; the index is useless
+            self._index = {}
+            self._data_size = 0
+        if size != self._data_size:
+            self.scan(size)
 
-        **Returns:** |PostSet|
-        """
+    def scan(self, size):
+        """Adds the records of the data file that are not in the index yet to
+        the index.
 
-        self._recalc_all()
-        return self._all
+        If the last record of the data file is incomplete (e.g. because
+        writing it was interrupted), it is cut off from the data file.
 
-    def _recalc_all(self):
-        """Recalculates the `_all` data attribute if needed.
+        **Argument:**
 
-        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        - `size` (int) -- The size of the data file.
         """
 
-        if self._all == None:
-            self._all = PostSet(self, self.posts())
-
-    # Thread structure
+        self._index_written = False
+        data_file = self.data_file_name()
+        with open(data_file, 'rb') as f:
+            f.seek(self._data_size)
+            record_end = f.tell()
+            while record_end < size:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    break # incomplete record header
+                m = re.match(r'(\S+) (\d+)\n$', line)
+                if m is None:
+                    raise hkutils.HkException(
+                        'Incorrect record in "%s" at position %d.' %
+                        (data_file, record_end))
+                post_index, length = m.group(1), int(m.group(2))
+                offset = f.tell()
+                if offset + length > size:
+                    break # incomplete post text
+                self._index[post_index] = (offset, length)
+                f.seek(length, 1)
+                record_end = f.tell()
+        if record_end < size:
+            hkutils.log('Warning: incomplete record removed from "%s" at '
+                        'position %d.' % (data_file, record_end))
+            with open(data_file, 'r+b') as f:
+                f.truncate(record_end)
+        self._data_size = record_end
+
+    def stamps(self):
+        """Returns the stamps of the stored posts.
+
+        The stamp of a post is the position and length of its latest record.
+
+        **Returns:** {|PostIndex|: (int, int)}
+        """
+
+        return self._index.copy()
+
+    def stamp(self, post_index):
+        """Returns the stamp of a stored post.
 
-    def threadstruct(self):
-        """Returns the thread structure of the post database.
+        **Argument:**
 
-        The object returned by this function should not be modified.
+        - `post_index` (|PostIndex|)
 
-        **Returns:** |ThreadStruct|
+        **Returns:** (int, int) | ``None``
         """
 
-        self._recalc_threadstruct()
-        return self._threadstruct
-
-    def parent(self, post):
-        """Returns the parent of the given post.
+        return self._index.get(post_index)
 
-        If there is no such post in the database, it returns ``None``.
+    def post_source(self, post_index):
+        """Returns where the post is stored.
 
         **Argument:**
 
-        - `post` (|Post|)
+        - `post_index` (|PostIndex|)
 
-        **Returns:** |Post| | ``None``
+        **Returns:** (str, int, int)
         """
 
-        assert(post in self.all())
-        postparent = post.parent()
+        offset, length = self._index[post_index]
+        return self.data_file_name(), offset, length
 
-        if postparent == '':
-            return None
+    def postfile_name(self, post_index):
+        """Returns the name of the data file, since it contains all posts.
 
-        parentpost = self.post(postparent, default_heap=post.heap_id())
+        **Argument:**
 
-        # deleted posts do not count
-        if parentpost is not None and parentpost.is_deleted():
-            return None
+        - `post_index` (|PostIndex|)
 
-        return parentpost
+        **Returns:** str
+        """
 
-    def root(self, post):
-        """Returns the :ref:`root <glossary_root>` of a post.
+        return self.data_file_name()
+
+    def post_exists(self, post_index):
+        """Returns whether the post is stored.
 
         **Argument:**
 
-        - `post` (|Post|)
+        - `post_index` (|PostIndex|)
 
-        **Returns:** |Post| | ``None`` -- ``None`` is returned when the post
-        is in a cycle.
+        **Returns:** bool
         """
 
-        assert(post in self.all())
-        posts = set([post])
-        while True:
-            parentpost = self.parent(post)
-            if parentpost == None:
-                return post
-            elif parentpost in posts:
-                return None # we found a cycle
-            else:
-                posts.add(parentpost)
-                post = parentpost
-
-    def children(self, post, threadstruct=None):
-        """Returns the :ref:`children <glossary_parent_child>` of the given
-        post.
+        return post_index in self._index
 
-        If `post` is ``None``, it returns the posts with no parents (i.e. whose
-        parent is ``None``).
+    def write_post(self, post_index, text):
+        """Appends a new record of the post to the data file.
 
         **Arguments:**
 
-        - `post` (|Post| | ``None``)
-        - `threadstruct` (|ThreadStruct| | ``None``) -- The thread structure to
-          be used. If ``None``, the thread structure of the post database is
-          used. (Note: that is usually what we want.)
+        - `post_index` (|PostIndex|)
+        - `text` (str)
 
-        **Returns:** [Post]
+        **Returns:** (int, int)
         """
 
-        assert(post == None or post in self.all())
+        record_header = '%s %d\n' % (post_index, len(text))
+        with open(self.data_file_name(), 'ab') as f:
+            f.seek(0, 2)
+            if f.tell() != self._data_size:
+                # The data file has been changed since it was scanned
+                self.scan(f.tell())
+                f.seek(0, 2)
+            offset = f.tell() + len(record_header)
+            f.write(record_header)
+            f.write(text)
+        self._index[post_index] = (offset, len(text))
+        self._data_size = offset + len(text)
+        self._index_written = False
+        return offset, len(text)
 
-        if threadstruct is None:
-            threadstruct = self.threadstruct()
+    def flush(self):
+        """Writes the index file if it is not up-to-date."""
 
-        if post == None:
-            children_post_ids = threadstruct.get(None, [])
-        else:
-            children_post_ids = threadstruct.get(post.post_id(), [])
+        if self._index_written:
+            return
+        index_file = self.index_file_name()
+        tmp_index_file = index_file + '.tmp'
+        with open(tmp_index_file, 'wb') as f:
+            cPickle.dump(
+                (PackedHeapStorage.INDEX_VERSION, self._data_size,
+                 self._index),
+                f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_index_file, index_file)
+        self._index_written = True
+
+    def compact(self):
+        """Rewrites the data file so that it contains only the latest record
+        of each post.
+
+        **Returns:** {|PostIndex|: int} -- How much the position of the posts
+        has changed.
+        """
+
+        data_file = self.data_file_name()
+        if not os.path.exists(data_file):
+            return {}
+        tmp_data_file = data_file + '.tmp'
+        new_index = {}
+        shifts = {}
+        with open(data_file, 'rb') as old_f:
+            with open(tmp_data_file, 'wb') as new_f:
+                for post_index in sorted(self._index):
+                    offset, length = self._index[post_index]
+                    old_f.seek(offset)
+                    new_f.write('%s %d\n' % (post_index, length))
+                    new_offset = new_f.tell()
+                    new_f.write(old_f.read(length))
+                    new_index[post_index] = (new_offset, length)
+                    shifts[post_index] = new_offset - offset
+                data_size = new_f.tell()
+        os.rename(tmp_data_file, data_file)
+        self._index = new_index
+        self._data_size = data_size
+        self._index_written = False
+        self.flush()
+        return shifts
+
+
+# The heap storage classes that can be used in the configuration.
+HEAP_STORAGE_TYPES = {'directory': DirectoryHeapStorage,
+                      'packed': PackedHeapStorage}
+
+def copy_heap_storage(source, target):
+    """Copies all posts from one heap storage to another.
+
+    It can be used to convert a heap to another storage type, e.g. to import
+    a directory of post files into a packed storage or to export a packed
+    storage into post files.
+
+    **Arguments:**
+
+    - `source` (|HeapStorage|)
+    - `target` (|HeapStorage|)
+    """
 
-        # This assertion can catch nasty bugs when the thread structure
-        # contains a string as a value instead of a list.
-        assert(isinstance(children_post_ids, list))
+    for post_index in sorted(source.stamps()):
+        target.write_post(post_index, source.read_post_text(post_index))
+    target.flush()
 
-        return [ self.post(post_id) for post_id in children_post_ids ]
 
-    def _recalc_threadstruct(self):
-        """Recalculates the `_threadstruct` data attribute if needed.
+##### PostDB #####
 
-        See also the :ref:`lazy_data_calculation_pattern` pattern.
-        """
+# If the files are parsed by several processes, each process should get at
+# least this many post files; otherwise starting the processes costs more than
+# what we gain.
+MIN_FILES_PER_LOAD_PROCESS = 100
 
-        if self._threadstruct == None:
+# The version of the snapshot file format. It should be increased whenever the
+# format of the snapshots or the parsed representation of the posts changes.
+SNAPSHOT_VERSION = 3
 
-            def add_timestamp(post):
-                """Creates a (timestamp, post_id) pair from the post."""
-                return (post.timestamp(), post.post_id())
+# The fields of the posts on which the set of non-deleted posts depends
+POSTSET_FIELDS = frozenset(['flags'])
 
-            threads = {None: []} # dict(post_id,[answered:(timestamp,post_id)])
-            for post in self.posts():
-                parentpost = self.parent(post)
-                parent_post_id = \
-                    parentpost.post_id() if parentpost != None else None
-                if parent_post_id in threads:
-                    threads[parent_post_id].append(add_timestamp(post))
-                else:
-                    threads[parent_post_id] = [add_timestamp(post)]
-            t = {}
-            for post_id in threads:
-                threads[post_id].sort()
-                t[post_id] = \
-                    [ post_id2 for timestamp, post_id2 in threads[post_id] ]
-            self._threadstruct = t
+# The fields of the posts on which the thread structure (and so the roots, the
+# cycles and the threads) depends
+THREADSTRUCT_FIELDS = frozenset(['messid', 'parent', 'date', 'flags'])
 
-    def iter_thread(self, post, threadstruct=None):
-        """Iterates over a thread.
+# The fields of the posts on which the heap link index depends
+LINK_INDEX_FIELDS = frozenset(['body', 'flags'])
 
-        The first element of the thread will be the post (except when the post
-        is None, which will not be yielded). All the consequenses of post will
-        be yielded in a preorder way. An example::
+# The fields of the posts on which the tag, author and heap indexes depend
+FIELD_INDEX_FIELDS = frozenset(['author', 'tags'])
 
-            1 <- 2 <- 3
-              <- 4
-            5
+# The fields of the posts on which the date index depends
+DATE_INDEX_FIELDS = frozenset(['date'])
 
-        The posts will be yielded in the following order: 1, 2, 3, 4, 5.
+# The local time of the posts is calculated from their timestamps, but the
+# offset of the local time may change (e.g. because of daylight saving time).
+# The posts whose timestamp is this close (in seconds) to the timestamp of a
+# post at a date boundary are compared with the boundary one by one.
+DATE_INDEX_MARGIN = 2 * 24 * 60 * 60
 
-        The posts can be modified during the iteration.
+def normalize_author(author):
+    """Returns the normalized form of an author, by which the posts are
+    assigned to authors in the author index of the post database.
 
-        **Arguments:**
+    The normalized form is in lower case and its words are separated by
+    single spaces.
 
-        - `post` (|Post| | ``None``) -- The post whose (sub)thread should be
-          iterated.
-        - `threadstruct` (|ThreadStruct| | ``None``) -- The thread structure to
-          be used. If ``None``, the thread structure of the post database is
-          used. (Note: that is usually what we want.)
+    **Argument:**
 
-        **Returns:** iterable(|Post|)
-        """
+    - `author` (str)
 
-        assert(post in self.all() or post == None)
-        if post != None:
-            yield post
-        post_id = post.post_id() if post != None else None
-        if threadstruct == None:
-            threadstruct = self.threadstruct()
-        for ch_post_id in threadstruct.get(post_id, []):
-            for post2 in self.iter_thread(self.post(ch_post_id), threadstruct):
-                yield post2
+    **Returns:** str
 
-    def walk_thread(self, root, threadstruct=None, yield_inner=False):
-        """Walks a thread and yields its posts.
+    **Example:** ::
 
-        `walk_thread` walks the thread indicated by `root` with deep walk and
-        yields |PostItem| objects. A post item contains a post and some
-        additional information.
+        >>> hklib.normalize_author('  Author   NAME ')
+        'author name'
+    """
 
-        The post item contains the post's position, which can be ``begin`` or
-        ``end``. Each post is yielded twice during the walk. When the deep walk
-        enters the subthread of a post, the post is yielded with ``begin``
-        position. When the deep walk leaves its subthread, it is yielded with
-        ``end`` position.
+    return ' '.join(author.lower().split())
 
-        The post item also contains the level of the post. The level of the
-        root post is 0, the level of its children is 1, etc. When the `root`
-        argument is ``None`` and the whole database is walked, the level of all
-        root posts is 0.
+class PostDB(object):
 
-        **Arguments:**
+    """The post database that stores and handles the posts.
 
-        - `root` (|Post| | ``None``) -- The root of the thread to be walked. If
-          ``None``, the whole thread structure is walked.
-        - `threadstruct` (|ThreadStruct| | ``None``) -- The thread structure to
-          be used. If ``None``, the thread structure of the post database will
-          be used. (Note: that is usually what we want.)
+    **Data attributes:**
 
-        **Returns:** iterable(|PostItem|)
+    - `_heaps` ({|HeapId|: str}) -- Assigns directory names to the heaps in
+      which they are stored in the file system.
+    - `_storages` ({|HeapId|: |HeapStorage|}) -- The objects that read and
+      write the posts of the heaps.
+    - `post_id_to_post` ({|PostId|: |Post|}) -- Stores the posts assigned to
+      their post ids.
+    - `messid_to_post_id` ({|Messageid|, |PostId|}) -- Stores which messids and
+      post ids belong together.
+    - `_next_post_index` ({(|HeapId|, str): int}) -- A dictionary that assigns
+      the next free post indices to the heapid-prefix pairs. This is part of a
+      caching mechanism. If a prefix is not found here, the whole lookup
+      procedure is performed, then the results are added to this dictionary.
+      The next free post index for a prefix is a number for which numbers in
+      all other post indices with this prefix are smaller.
+    - `_html_dir` (str) -- The directory that contains the generated HTML
+      files.
+    - `_cache_dir` (str | ``None``) -- The directory that contains the heap
+      snapshots. If ``None``, no snapshots are used.
+    - `_load_processes` (int) -- The number of processes that parse the post
+      files when heaps are loaded.
+    - `_lazy_bodies` (bool) -- If ``True``, only the headers of the post files
+      are parsed when the heaps are loaded, and the bodies are read when they
+      are needed.
+    - `_max_resident_bodies` (int | ``None``) -- The maximum number of bodies
+      read on demand that are kept in the memory. ``None`` means no limit.
+    - `_resident_bodies` ({|Post|: int}) -- The posts whose bodies were read
+      on demand and are still in the memory, with the serial number of the
+      reading. It is maintained only if `_max_resident_bodies` is not
+      ``None``.
+    - `_resident_order` (collections.deque([(int, |Post|)])) -- The serial
+      numbers and posts of `_resident_bodies` in the order of reading. The
+      items whose serial number is not the one in `_resident_bodies` are
+      outdated and skipped.
+    - `_resident_serial` (int) -- The serial number of the last reading.
+    - `_handles` ({|PostId|: int}) -- Assigns a dense integer handle to each
+      post id that has ever been in the database. A post keeps its handle
+      while it is in the database (even if it is deleted or moved), so the
+      handles can be used as indices of arrays.
+    - `_handle_table` ([|Post| | ``None``]) -- Assigns the posts to their
+      handles. ``None`` means that the post was removed from the database.
+    - `_removed_handles` (long) -- The bit with index ``h`` is set if the
+      handle ``h`` belongs to a post that was removed from the database.
+    - `listeners` ([|PostDBEventListener|]) -- Listeners that are called when
+      an event happens.
+    - `_batch_level` (int) -- The number of :func:`batch` blocks that are
+      being executed.
+    - `_batch_touched` ({|Post|: frozenset(|PostField|) | ``None``}) -- The
+      posts touched inside the current :func:`batch` block and their
+      modified fields.
 
-        **Example:**
+    **Lazy data attributes:**
 
-        The thread structure walked::
+    These data attributes are part of the :ref:`lazy_data_calculation_pattern`
+    pattern.
 
-            0 <- 1 <- 2
-              <- 3
-            4
+    - `_posts` ([|Post|] | ``None``) -- All non-deleted posts as a list. It can
+      be obtained using :func:`posts`.
+    - `_all` (|PostSet| | ``None``) -- All non-deleted posts as a post set. It
+      can be obtained using :func:`all`.
+    - `_threadstruct` (|ThreadStruct| | ``None``) -- Assigns the childrens of a
+      post to the post. Root posts are assigned to ``None``. It can be obtained
+      using :func:`threadstruct`. It is not recalculated when a post changes,
+      but patched by :func:`_update_threadstruct`.
+    - `_thread_state` ({|PostId|: (str, (str), |PostId| | ``None``,
+      (int, |PostId|))}) -- Stores the information about the non-deleted
+      posts that was used to place them into `_threadstruct`: the Parent
+      header, the references by which other posts can refer to the post (see
+      :func:`_post_refs`), the post id of the parent and the sort key. It is
+      calculated together with `_threadstruct`.
+    - `_parent_refs` ({str: set(|PostId|)}) -- Assigns the non-deleted posts
+      to their Parent header. It is calculated together with `_threadstruct`.
+      It also contains the dangling references (Parent headers that do not
+      refer to a non-deleted post), so these posts are placed under their
+      parent as soon as the parent is added.
+    - `_threadstruct_shared` (bool) -- ``True`` if `_threadstruct` was
+      returned by :func:`threadstruct`, so it should be copied before being
+      patched.
+    - `_cycles` (|PostSet| | ``None``) -- Posts that are in a cycle in the
+      thread structure. These posts will not be iterated by the
+      :func:`iter_thread` function. It can be obtained using :func:`cycles`.
+      It is calculated from `_cycle_post_ids`.
+    - `_cycle_post_ids` (set(|PostId|) | ``None``) -- The post ids of the
+      posts in `_cycles`. It is calculated once by walking the thread
+      structure, and then it is updated by :func:`_update_cycles` when the
+      parent of a post changes.
+    - `_roots` (|PostSet| | ``None``) -- The root posts. It can be obtained
+      using :func:`roots`.
+    - `_threads` ({|Post|: |PostSet|} | ``None``) -- A dictionary that assigns
+      posts in a thread to the root of the thread. It can be obtained using
+      :func:`threads`.
+    - `_thread_arrays` ((array('i'), array('i'), array('i')) | ``None``) --
+      The thread structure in compressed sparse row format using the handles
+      of the posts: the handles of the roots, the offsets of the child lists
+      and the handles of the children. The children of the post with handle
+      ``h`` are ``child_handles[offsets[h]:offsets[h + 1]]``. It is
+      calculated from `_threadstruct` by :func:`_recalc_thread_arrays`.
+    - `_root_handles` (array('i') | ``None``) -- Assigns the handle of the
+      root of its thread to each handle. Posts in cycles and handles of
+      deleted or removed posts are assigned to -1. It is used by
+      :func:`root`.
+    - `_depths` (array('i') | ``None``) -- Assigns the depth of the post in
+      its thread to each handle. Roots have depth 0. Posts in cycles and
+      handles of deleted or removed posts are assigned to -1. It is used by
+      :func:`depth`. It is calculated together with `_root_handles`.
+    - `_post_links` ({|PostId|: (str)} | ``None``) -- Assigns the prepost ids
+      of the heap links in the body of the non-deleted posts to the posts.
+      It is not recalculated when a post changes, but updated by
+      :func:`_update_link_index`.
+    - `_link_refs` ({str: set(|PostId|)} | ``None``) -- Assigns the posts
+      to the prepost ids of the heap links in their body. It is calculated
+      together with `_post_links`.
+    - `_post_index_keys` ({|PostId|: (str, (str))} | ``None``) -- Stores the
+      author and the tags by which the posts of the database (including the
+      deleted ones) were placed into the tag, author and heap indexes. It is
+      not recalculated when a post changes, but updated by
+      :func:`_update_field_indexes`.
+    - `_heap_index` ({|HeapId|: set(|PostId|)} | ``None``) -- Assigns the
+      posts to their heap. It is calculated together with `_post_index_keys`.
+    - `_author_index` ({str: {str: set(|PostId|)}} | ``None``) -- Assigns the
+      posts to their author. The first key is the normalized author (see
+      :func:`normalize_author`), the second one is the author. It is
+      calculated together with `_post_index_keys`.
+    - `_tag_index` ({|Tag|: set(|PostId|)} | ``None``) -- Assigns the posts
+      to their tags. It is calculated together with `_post_index_keys`.
+    - `_date_index` ([(int, int)] | ``None``) -- The timestamps and handles
+      of the posts of the database that have a date (including the deleted
+      ones), sorted by the timestamps. It is not recalculated when a post
+      changes, but updated by :func:`_update_date_index`.
+    - `_undated_handles` (set(int) | ``None``) -- The handles of the posts
+      that do not have a date. It is calculated together with `_date_index`.
+    - `_date_index_keys` ({int: int} | ``None``) -- Assigns the timestamps by
+      which the posts were placed into `_date_index` (or 0 for the posts in
+      `_undated_handles`) to their handles. It is calculated together with
+      `_date_index`.
+    - `_generation` (int) -- The generation of the post database, which is
+      increased each time the post database is touched and each time a post
+      is added to or removed from the dictionaries. It can be obtained using
+      :func:`generation`.
+    """
 
-        The post items yielded (indentation is there only to help the human
-        reader)::
+    # Constructors
 
-            <PostItem: pos=begin, heapid='0', level=0>
-              <PostItem: pos=begin, heapid='1', level=1>
-                <PostItem: pos=begin, heapid='2', level=2>
-                <PostItem: pos=end, heapid='2', level=2>
-              <PostItem: pos=end, heapid='1', level=1>
-              <PostItem: pos=begin, heapid='3', level=1>
-              <PostItem: pos=end, heapid='3', level=1>
-            <PostItem: pos=end, heapid='0', level=0>
-            <PostItem: pos=begin, heapid='4', level=0>
-            <PostItem: pos=end, heapid='4', level=0>
-        """
+    def __init__(self):
+        """Constructor."""
 
-        # `stack` is initialized with "beginning" `PostItem`s (i.e.
-        # ``item.pos == 'begin'``).
-        # During the execution of the loop:
-        #  - the stack is popped,
-        #  - whatever we got, we yield it,
-        #  - if it is a beginning `PostItem`, we push the matching ending
-        #    `PostItem`
-        #  - then push a beginning `PostItem` for all the children of the
-        #    popped item's post
-        # This means that we will yield the ending `PostItem` once all the
-        # children (and their children etc.) are processed.
+        super(PostDB, self).__init__()
+        self._heaps = {}
+        self._storages = {}
+        self.post_id_to_post = {}
+        self.messid_to_post_id = {}
+        self._html_dir = None
+        self._cache_dir = None
+        self._load_processes = 1
+        self._lazy_bodies = False
+        self._max_resident_bodies = None
+        self._resident_bodies = {}
+        self._resident_order = collections.deque()
+        self._resident_serial = 0
+        self._next_post_index = {}
+        self._handles = {}
+        self._handle_table = []
+        self._removed_handles = 0L
+        self.listeners = []
+        self._batch_level = 0
+        self._batch_touched = {}
+        self._generation = 0
+        self.touch()
 
-        assert(root in self.all() or root == None)
-        if threadstruct == None:
-            threadstruct = self.threadstruct()
+    def add_post_to_dicts(self, post):
+        """Adds the post to the `heapid_to_post` and `messid_to_post_id`
+        dictionaries.
 
-        if root is None:
-            roots = [ PostItem(pos='begin', post=root, level=0)
-                      for root in self.children(None, threadstruct) ]
-            stack = list(reversed(roots))
+        **Arguments:**
+
+        - `post` (|Post|)
+        """
+
+        post_id = post.post_id()
+        self.post_id_to_post[post_id] = post
+        handle = self._handles.get(post_id)
+        if handle is None:
+            self._handles[post_id] = len(self._handle_table)
+            self._handle_table.append(post)
         else:
-            stack = [ PostItem(pos='begin', post=root, level=0) ]
+            self._handle_table[handle] = post
+            self._removed_handles &= ~(1L << handle)
+        messid = post.messid()
+        if messid != '':
+            # Don't store the messid if it is already used
+            if messid in self.messid_to_post_id:
+                messid_user_post = self.messid_to_post_id[messid]
+                hkutils.log('Warning: post %s has message id %s, but that '
+                            'message id is already used by post %s.' %
+                            (post_id, messid, messid_user_post))
+            else:
+                self.messid_to_post_id[messid] = post_id
+        self._generation += 1
+        self._post_changed(post)
 
-        while len(stack) > 0:
+    def remove_post_from_dicts(self, post):
+        """Removed the post from the `heapid_to_post` and `messid_to_post_id`
+        dictionaries.
 
-            postitem = stack.pop()
-            yield postitem
+        The post is also forgotten by `_resident_bodies`.
 
-            if postitem.pos == 'begin':
+        **Arguments:**
 
-                if yield_inner:
-                    postitem_inner = postitem.copy()
-                    postitem_inner.pos = 'inner'
-                    yield postitem_inner
+        - `post` (|Post|)
+        """
 
-                # pushing the closing pair of postitem into the stack
-                postitem_end = postitem.copy()
-                postitem_end.pos = 'end'
-                stack.append(postitem_end)
+        post_id = post.post_id()
+        del self.post_id_to_post[post_id]
+        handle = self._handles[post_id]
+        self._handle_table[handle] = None
+        self._removed_handles |= 1L << handle
+        messid = post.messid()
+        if messid != '':
+            # We should remove the messid from messid_to_post_id only if `post`
+            # is stored as the owner of that messid
+            if self.messid_to_post_id.get(messid) == post_id:
+                del self.messid_to_post_id[post.messid()]
+        self.notify_body_unloaded(post)
+        self._generation += 1
+        self._post_changed(post)
 
-                # pushing the children of the post into the stack
-                new_level = postitem.level + 1
-                child_postitems = \
-                    [ PostItem(pos='begin', post=child, level=new_level)
-                      for child in self.children(postitem.post, threadstruct) ]
-                stack += reversed(child_postitems)
+    def load_heap(self, heap_id):
+        """Loading a heap from the disk.
 
-    def cycles(self):
-        """Returns the posts that are in a :ref:`cycle <glossary_cycle>` of the
-        thread structure.
+        **Arguments:**
 
-        **Returns:** |PostSet|
+        - `heap_id` (|HeapId|)
         """
 
-        self._recalc_cycles()
-        return self._cycles
+        self.load_heaps([heap_id])
 
-    def has_cycle(self):
-        """Returns whether there is a :ref:`cycle <glossary_cycle>` in the
-        thread structure.
+    def load_heaps(self, heap_ids):
+        """Loading heaps from the disk.
 
-        **Returns:** bool
-        """
+        The posts that are not found in the snapshots of the heaps are parsed
+        using :func:`parse_posts`. If `_load_processes` is greater than 1, the
+        posts of all heaps are distributed among a pool of worker processes.
+        The workers parse the posts, while the post objects are created by
+        this process.
 
-        return len(self.cycles()) != 0
+        The new, changed and removed posts are touched in a :func:`batch`
+        block, so the listeners are notified only about them.
 
-    def _recalc_cycles(self):
-        """Recalculates the `_cycles` data attribute if needed.
+        **Arguments:**
 
-        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        - `heap_ids` ([|HeapId|])
         """
 
-        if self._cycles == None:
-            self._cycles = self.all().copy()
-            # A post is in a cycle <=> it cannot be accessed by iter_thread
-            for post in self.iter_thread(None):
-                self._cycles.remove(post)
-
-    def walk_cycles(self):
-        """Walks and yields post items for the posts in :ref:`cycles
-        <glossary_cycle>`.
+        # `to_load` will contain the posts to be loaded in the following
+        # format: [(heap_id, post_index, stamp, snapshot entry)]
+        to_load = []
+        snapshots = {} # {heap_id: new snapshot}
+        snapshots_changed = set() # set(heap_id)
+        posts_in_heaps = {} # {post id: post}
 
-        The ``pos`` attribute of the post items will be ``'flat'``. The
-        ``level`` attribute will be 0.
+        # Many posts will change, so it is not worth updating the thread
+        # structure post by post
+        self._clear_lazy_data()
 
-        **Returns:** iterable(|PostItem|)
-        """
+        # The posts that are new, changed or removed; the listeners will be
+        # notified about them
+        touched_posts = []
 
-        for post in self.cycles().sorted_list():
-            yield PostItem(pos='flat', post=post, level=0)
+        for heap_id in heap_ids:
 
-    def roots(self):
-        """Returns the :ref:`root <glossary_root>` posts (i.e. the ones with no
-        parent).
+            # We filter the posts in the given heap into `posts_in_heaps` and
+            # remove them from the post_id_to_post and messid_to_post_id
+            for post_id, post in list(self.post_id_to_post.items()):
+                if post_id[0] == heap_id:
+                    self.remove_post_from_dicts(post)
+                    posts_in_heaps[post_id] = post
 
-        **Returns:** |PostSet|
-        """
+            # The snapshot contains the parsed posts of the heap as they were
+            # when the heap was loaded last time. A snapshot entry is used only
+            # if the stamp of the post (e.g. the size and modification time of
+            # its post file) is the same as when the entry was created.
+            snapshot = self.read_snapshot(heap_id)
+            snapshots[heap_id] = {}
 
-        self._recalc_roots()
-        return self._roots
+            stamps = self.storage(heap_id).stamps()
+            for post_index, stamp in stamps.iteritems():
 
-    def _recalc_roots(self):
-        """Recalculates the `_roots` data attribute if needed.
+                entry = snapshot.pop(post_index, None)
+                if entry is not None and entry[0] != stamp:
+                    entry = None
+                if entry is None:
+                    snapshots_changed.add(heap_id)
+                to_load.append((heap_id, post_index, stamp, entry))
 
-        See also the :ref:`lazy_data_calculation_pattern` pattern.
-        """
+            # If a post was removed, the snapshot has to be updated, too
+            if len(snapshot) > 0:
+                snapshots_changed.add(heap_id)
 
-        if self._roots == None:
-            self._roots = [ self.post(post_id)
-                            for post_id in self.threadstruct()[None] ]
+        # Parsing the posts that are not in the snapshots
+        read_body = not self._lazy_bodies
+        tasks = [ self.storage(heap_id).parse_task(post_index, read_body)
+                  for heap_id, post_index, _, entry in to_load
+                  if entry is None ]
+        parsed_posts = iter(self.parse_posts(tasks))
 
-    def threads(self):
-        """Returns a dictionary that assigns posts in a thread to the
-        :ref:`root <glossary_root>` of the thread.
+        for heap_id, post_index, stamp, entry in to_load:
 
-        **Returns:** {|Post|: |PostSet|}
-        """
+            post_id = (heap_id, post_index)
+            storage = self.storage(heap_id)
+            if entry is not None:
+                _stamp, header, body, body_offset = entry
+                if self._lazy_bodies:
+                    body = None
+                elif body is None:
+                    body = storage.read_body(post_index, body_offset)
+            else:
+                header, body, body_offset = \
+                    self._create_parsed_post(post_id, parsed_posts.next())
 
-        self._recalc_threads()
-        return self._threads
+            # We try to obtain the post which has the post id `post_id`. If
+            # such a post exists (i.e. `posts_in_heaps` contains `post_id`),
+            # the post should be reloaded from the disk. This way, if someone
+            # has a reference to post object, they will refer to the reloaded
+            # posts. If there is no post with `post_id`, a new Post object
+            # should be created.
+            post = posts_in_heaps.pop(post_id, None)
+            if post is None:
+                post = Post.from_parsed(header, body, post_id, self,
+                                        body_offset)
+                touched_posts.append(post)
+            else:
+                # If the post file has changed or the body of the post is in
+                # the memory (and so it may have been modified), the body has
+                # to be read to find out whether the post has changed
+                if body is None and (entry is None or post.is_body_loaded()):
+                    body = storage.read_body(post_index, body_offset)
+                if (post.is_modified() or header != post._header or
+                    (body is not None and body != post._body)):
+                    touched_posts.append(post)
+                post.read_parsed(header, body, True, body_offset)
+            post._stamp = stamp
+            snapshots[heap_id][post_index] = \
+                (stamp, post._header, post._body, body_offset)
+            self.add_post_to_dicts(post)
 
-    def _recalc_threads(self):
-        """Recalculates the `_threads` data attribute if needed.
+        for heap_id in heap_ids:
+            if heap_id in snapshots_changed:
+                self.write_snapshot(heap_id, snapshots[heap_id])
 
-        See also the :ref:`lazy_data_calculation_pattern` pattern.
-        """
+        # We remove the entries about the given heaps from the
+        # next_post_index cache
+        for curr_heap_id, prefix in list(self._next_post_index.keys()):
+            if curr_heap_id in heap_ids:
+                del self._next_post_index[(curr_heap_id, prefix)]
 
-        if self._threads == None:
-            self._threads = {}
-            for root in self.roots():
-                self._threads[root] = self.postset(root).expf()
+        # The remaining posts are not stored any more
+        touched_posts.extend(posts_in_heaps.values())
 
-    def move(self, post, new_post_id, placeholder=False):
-        """Moves a post by changing its post id.
+        self._clear_lazy_data()
+        with self.batch():
+            for post in touched_posts:
+                self.touch(post)
 
-        This method should be used with care.
+    def _create_parsed_post(self, post_id, parsed_post):
+        """Converts the result of :func:`parse_post_file` to the header, body
+        and body offset of a post.
 
         **Arguments:**
 
-        - `post` (|Post|)
-        - `new_post_id` (|PrePostId|) -- The new post id of the post.
-        - `placeholder` (bool) -- If ``True``, a placeholder post will be
-          created with the original post id of `post`. The placeholder post
-          will be marked as deleted.
+        - `post_id` (|PostId|)
+        - `parsed_post` (({str: [str]}, (str | ``None``), int) | (``None``,
+          str, ``None``)) -- The value returned by :func:`parse_post_file`.
+
+        **Returns:** ({str: (str | [str])}, (str | ``None``), int) -- The
+        header in the form returned by :func:`Post.create_header`, the body
+        and the body offset.
+
+        **Raises:** hkutils.HkException -- If the post could not be parsed.
         """
 
-        Post.assert_is_post_id(new_post_id)
-        new_post_id = Post.unify_post_id(new_post_id)
-        new_heap_id, new_post_index = new_post_id
+        raw_header, body, body_offset = parsed_post
+        try:
+            if raw_header is None:
+                # `body` contains the error message
+                raise hkutils.HkException(body)
+            header = Post.create_header(raw_header, post_id)
+        except hkutils.HkException, e:
+            heap_id, post_index = post_id
+            e.value += ('\nwhile parsing post file "%s"' %
+                        (self.storage(heap_id).postfile_name(post_index),))
+            raise
+        return header, body, body_offset
 
-        if self.post(new_post_id) is not None:
-            raise hkutils.HkException, \
-                  ('The given post id is already occupied: %s' %
-                   (new_post_id,))
+    def parse_posts(self, tasks):
+        """Parses posts.
 
-        if not self.has_heap_id(new_heap_id):
-            raise hkutils.HkException, \
-                  ('No such heap: %s' % (new_heap_id,))
+        If `_load_processes` is greater than 1 and there are enough posts,
+        the posts are parsed by a pool of worker processes.
 
-        old_post_id = post.post_id()
+        **Argument:**
 
-        def new_reference(source_post, old_post_ref, old_post_id, new_post_id):
-            """Returns how a post reference should change when a post's id is
-            renamed.
+        - `tasks` ([(str, bool, int, (int | ``None``))]) -- The tasks as
+          returned by :func:`HeapStorage.parse_task`.
 
-            **Arguments:**
+        **Returns:** [({str: [str]}, (str | ``None``), int) | (``None``, str,
+        ``None``)] -- The list of the values returned by
+        :func:`parse_post_file` for the tasks, in the same order.
+        """
 
-            - `source_post` (|Post|) -- The post that contains the post
-              reference.
-            - `old_post_ref` (str) -- The post reference whose modification is
-              in question.
-            - `old_post_id` (|PostId|) -- The old post id of the post to be
-              renamed.
-            - `new_post_id` (|PostId|) -- The new post id of the post to be
-              renamed.
+        processes = self._load_processes
+        if processes <= 1 or len(tasks) < MIN_FILES_PER_LOAD_PROCESS * 2:
+            return [ parse_post_task(task) for task in tasks ]
 
-            **Returns:** str | ``None`` -- If ``None`` is returned, the post
-            reference should not be changed. If a string is returned, it is the
-            new post reference that will be correct after the post was moved.
-            It is a prepost id; it has one of the following forms: either
-            ``"<post index>"`` or ``"<heap id>/<post index>"``.
-            """
+        processes = min(processes, len(tasks) / MIN_FILES_PER_LOAD_PROCESS)
+        pool = multiprocessing.Pool(processes)
+        try:
+            # Larger chunks mean less communication between the processes,
+            # but they make the load less balanced
+            chunksize = max(1, len(tasks) / (processes * 4))
+            return pool.map(parse_post_task, tasks, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+    def add_heap(self, heap_id, heap_dir, storage_type='directory'):
+        """Adds a heap to the post database and loads it.
 
-            old_heap_id, old_post_index = old_post_id
-            old_post_id_str = '%s/%s' % old_post_id
-            new_heap_id, new_post_index = new_post_id
-            new_post_id_str = '%s/%s' % new_post_id
+        **Arguments:**
 
-            # The reference is a full post id to the moving post
-            if old_post_ref == old_post_id_str:
-                return new_post_id_str
+        - `heap_id` (|HeapId|)
+        - `heap_dir` (str)
+        - `storage_type` (str) -- The type of the heap storage; a key of
+          :data:`HEAP_STORAGE_TYPES`.
+        """
 
-            # The reference if a post index to the moving post
-            elif (old_post_ref == old_post_index and
-                  source_post.heap_id() == old_heap_id):
+        self.add_heaps({heap_id: heap_dir}, {heap_id: storage_type})
 
-                # The target post stays in the heap
-                if new_heap_id == old_heap_id:
-                    return new_post_index
+    def add_heaps(self, heaps, storage_types={}):
+        """Adds heaps to the post database and loads them.
 
-                # The target post moves to another heap, so we need to set the
-                # full post id
-                else:
-                    return new_post_id_str
+        **Arguments:**
 
+        - `heaps` ({|HeapId|: str}) -- The directories of the heaps.
+        - `storage_types` ({|HeapId|: str}) -- The types of the heap storages
+          (see :func:`add_heap`). The default type is ``'directory'``.
+        """
 
-        for curr_post in self.posts():
+        for heap_id, heap_dir in sorted(heaps.items()):
+            storage_type = storage_types.get(heap_id, 'directory')
+            storage_class = HEAP_STORAGE_TYPES.get(storage_type)
+            if storage_class is None:
+                raise hkutils.HkException(
+                          'Unknown heap storage type: "%s"' % (storage_type,))
+            self._heaps[heap_id] = heap_dir
+            if not os.path.exists(heap_dir):
+                hkutils.log('Warning: post directory does not exists: "%s"' %
+                            (heap_dir,))
+                os.mkdir(heap_dir)
+                hkutils.log('Post directory has been created.')
+            self._storages[heap_id] = storage_class(heap_dir)
+        self.load_heaps(sorted(heaps.keys()))
 
-            # Modifying the Parent header item if necessary
-            new_ref = new_reference(curr_post, curr_post.parent(),
-                                    old_post_id, new_post_id)
-            if new_ref is not None:
-                curr_post.set_parent(new_ref)
+    def storage(self, heap_id):
+        """Returns the storage of the given heap.
 
-            # Modifying the heap links if necessary
-            body_object = curr_post.body_object()
-            modified = False
-            for segment in body_object.segments:
-                if segment.type == 'heap_link':
-                    new_ref = \
-                        new_reference(curr_post, segment.get_prepost_id_str(),
-                                      old_post_id, new_post_id)
-                    if new_ref is not None:
-                        segment.set_prepost_id_str(new_ref)
-                        modified = True
+        If no storage has been created for the heap yet, its posts are
+        supposed to be stored in a directory.
 
-            if modified:
-                body_str = body_object.body_str()
-                curr_post.set_body(body_str)
+        **Argument:**
 
-        self.remove_post_from_dicts(post)
-        post._post_id = new_post_id
-        post.touch()
-        self.add_post_to_dicts(post)
+        - `heap_id` (|HeapId|)
 
-        if placeholder:
-            placeholder_post = Post.create_empty(old_post_id, self)
-            placeholder_post.delete()
-            self.add_post_to_dicts(placeholder_post)
+        **Returns:** |HeapStorage|
+        """
 
-        self.touch()
+        storage = self._storages.get(heap_id)
+        if storage is None:
+            storage = DirectoryHeapStorage(self._heaps[heap_id])
+            self._storages[heap_id] = storage
+        return storage
 
-    # Filenames
+    def compact_heap(self, heap_id):
+        """Compacts the storage of the given heap if it supports it.
 
-    def postfile_name(self, post):
-        """Returns the string ``<heap dir>/<post index>.post``, which is the
-        name of the file in which the post should be stored.
+        The modified posts of the heap are saved first.
 
         **Argument:**
 
-        - `post` (|Post|)
-
-        **Returns:** str
+        - `heap_id` (|HeapId|)
         """
 
-        return os.path.join(
-                   self._heaps[post.heap_id()],
-                   post.post_index() + '.post')
+        storage = self.storage(heap_id)
+        if not hasattr(storage, 'compact'):
+            return
+        self.save()
+        shifts = storage.compact()
 
-    def html_dir(self):
-        """Return the directory in which the generator HTML files are stored.
+        # The bodies that are not in the memory have been moved, and the
+        # stamps of the posts have changed
+        for post_id, post in self.post_id_to_post.iteritems():
+            if post_id[0] == heap_id:
+                post_index = post_id[1]
+                if post._body_offset is not None:
+                    post._body_offset += shifts[post_index]
+                post._stamp = storage.stamp(post_index)
 
-        **Returns:** str | ``None``
-        """
+    def set_html_dir(self, html_dir):
+        """Sets the HTML directory.
 
-        return self._html_dir
+        **Argument:**
 
+        - `html_dir` (str)
+        """
 
-class PostItem(object):
+        self._html_dir = html_dir
+        if (html_dir is not None) and (not os.path.exists(html_dir)):
+            hkutils.log('Warning: HTML directory does not exists: "%s"' %
+                        (html_dir,))
+            os.mkdir(html_dir)
+            hkutils.log('HTML directory has been created.')
 
-    """Represents a post when performing walk on posts.
+    def set_cache_dir(self, cache_dir):
+        """Sets the cache directory.
 
-    Used for example by :func:`PostDB.walk_thread`. For information about what
-    exactly the values of the data attributes will be during a walk, please
-    read the documenation of the function that performs the walk.
+        The cache directory contains the snapshots of the heaps, which make
+        loading the heaps faster.
 
-    **Data attributes:**
+        **Argument:**
 
-    - `pos` (str) -- The position of the post item. Possible values:
-      ``'begin'``, ``'end'``, ``'flat'``.
-    - `post` (Post) -- The post represented by the post item.
-    - `level` (int) -- The level of the post.
-    """
+        - `cache_dir` (str | ``None``) -- If ``None``, no snapshots will be
+          read or written.
+        """
 
-    def __init__(self, pos, post, level=0):
-        """Constructor.
+        self._cache_dir = cache_dir
+        if (cache_dir is not None) and (not os.path.exists(cache_dir)):
+            hkutils.log('Warning: cache directory does not exists: "%s"' %
+                        (cache_dir,))
+            os.mkdir(cache_dir)
+            hkutils.log('Cache directory has been created.')
 
-        **Arguments:**
+    def set_load_processes(self, load_processes):
+        """Sets the number of processes that parse the post files when the
+        heaps are loaded.
 
-        - `pos` (str) -- Initializes the `pos` data attribute.
-        - `post` (Post) -- Initializes the `post` data attribute.
-        - `level` (int) -- Initializes the `level` data attribute.
-        """
+        **Argument:**
 
-        assert(pos in ['begin', 'end', 'inner', 'flat'])
-        self.pos = pos
-        self.post = post
-        self.level = level
+        - `load_processes` (int) -- If 1, the post files are parsed by the
+          current process. If 0, the number of processes will be the number of
+          CPUs.
+        """
 
-    def copy(self):
-        """Creates a shallow copy of the post item.
+        if load_processes == 0:
+            load_processes = multiprocessing.cpu_count()
+        self._load_processes = load_processes
 
-        **Returns:** |PostItem|
-        """
+    def set_lazy_bodies(self, lazy_bodies, max_resident_bodies=None):
+        """Sets whether the bodies of the posts should be read only when they
+        are needed.
 
-        p = PostItem(pos=self.pos,
-                     post=self.post,
-                     level=self.level)
-        p.__dict__ = self.__dict__.copy()
-        return p
+        The setting affects the heaps loaded afterwards.
 
-    def __str__(self):
-        """Returns the string representation of the PostItem.
+        If a post file is modified by another program while its body is not in
+        the memory, the body read later will be the new one, so the post
+        database should be reloaded in that case.
 
-        **Returns:** str
+        **Arguments:**
 
-        **Example:** ``<PostItem: pos=begin, heapid='42', level=0>``
+        - `lazy_bodies` (bool)
+        - `max_resident_bodies` (int | ``None``) -- The maximum number of
+          bodies read on demand that are kept in the memory. When it is
+          exceeded, the bodies read earliest are dropped (unless their posts
+          are modified). ``None`` means no limit.
         """
 
-        post_id = self.post.post_id()
-        if post_id is None:
-            post_id_str = 'None'
-        else:
-            post_id_str = "%s/%s" % post_id
+        self._lazy_bodies = lazy_bodies
+        self._max_resident_bodies = max_resident_bodies
+        self._resident_bodies = {}
+        self._resident_order = collections.deque()
 
-        s = ('<PostItem: pos=%s, post_id=%s, level=%d' %
-             (self.pos, post_id_str, self.level))
-        attrs = self.__dict__.copy()
-        del attrs['pos']
-        del attrs['post']
-        del attrs['level']
+    def notify_body_loaded(self, post):
+        """Should be called when the body of a post has been read on demand.
 
-        for attr, value in attrs.items():
-            s += ', %s=%s' % (attr, value)
+        If there are more bodies in the memory than `_max_resident_bodies`,
+        the ones read earliest are unloaded. A post is counted only once even
+        if its body was read several times.
 
-        s += '>'
-        return s
+        **Argument:**
 
-    def __eq__(self, other):
-        """Returns whether the post item is equal to another post item.
+        - `post` (|Post|)
+        """
 
-        Two post items are considered equal if they have the same position,
-        level, etc. and point to the same post.
+        if self._max_resident_bodies is None:
+            return
+        resident_bodies = self._resident_bodies
+        resident_order = self._resident_order
+        self._resident_serial += 1
+        resident_bodies[post] = self._resident_serial
+        resident_order.append((self._resident_serial, post))
+        while len(resident_bodies) > self._max_resident_bodies:
+            serial, post = resident_order.popleft()
+            if resident_bodies.get(post) == serial:
+                del resident_bodies[post]
+                post.unload_body()
+
+        # Dropping the outdated items if they are the majority
+        if len(resident_order) > 2 * len(resident_bodies):
+            self._resident_order = collections.deque(
+                [ (serial, post) for serial, post in resident_order
+                  if resident_bodies.get(post) == serial ])
+
+    def notify_body_unloaded(self, post):
+        """Should be called when the body of a post has been removed from the
+        memory or the post has been removed from the post database.
 
-        **Returns:** bool
+        **Argument:**
+
+        - `post` (|Post|)
         """
 
-        return self.__dict__ == other.__dict__
+        self._resident_bodies.pop(post, None)
 
+    @staticmethod
+    def get_storage_types_from_config(config):
+        """Gets the storage types of the heaps from a configuration object.
 
-##### PostSet #####
+        **Argument:**
 
-class PostSet(set):
+        - `config` (|ConfigDict|)
 
-    """A set of posts.
+        **Returns:** {|HeapId|: str} -- The type of the heap storage is
+        assigned to each heap.
+        """
 
-    **Data attributes:**
+        storage_types = {}
+        for heap_config in config['heaps'].values():
+            storage_types[heap_config['id']] = \
+                heap_config.get('storage', 'directory')
+        return storage_types
 
-    - `_postdb` (|PostDB|) -- The post database.
-    """
+    @staticmethod
+    def get_heaps_from_config(config):
+        """Gets the details of the heaps from a configuration object.
 
-    def __init__(self, postdb, posts, default_heap=None):
-        """Constructor.
+        **Argument:**
 
-        **Arguments:**
+        - `config` (|ConfigDict|)
 
-        - `postdb` (| PostDB|) -- The post database.
-        - `posts` ( |PrePostSet|) -- The set of posts to be initially
-          contained.
+        **Returns:** {|HeapId|: str} -- The directory that stores the heap is
+        assigned to each heap.
+        """
+
+        heaps = {}
+        for heap_config in config['heaps'].values():
+            heaps[heap_config['id']] = heap_config['path']
+        return heaps
+
+    def read_config(self, config):
+        """Configures the post database according to a configuration object.
+
+        The `_html_dir`, `_cache_dir`, `_load_processes`, `_lazy_bodies` and
+        `_max_resident_bodies` data attributes are set and heaps are added to
+        the post database.
+
+        **Argument:**
+
+        - `config` (|ConfigDict|)
+        """
+
+        heaps = self.get_heaps_from_config(config)
+        html_dir = config['paths']['html_dir']
+        postdb_config = config.get('postdb', {})
+
+        # The cache directory and the loading options have to be set before
+        # loading the heaps
+        self.set_cache_dir(config['paths'].get('cache_dir'))
+        self.set_load_processes(postdb_config.get('load_processes', 1))
+        self.set_lazy_bodies(postdb_config.get('lazy_bodies', False),
+                             postdb_config.get('max_resident_bodies'))
+
+        self.add_heaps(heaps, self.get_storage_types_from_config(config))
+        self.set_html_dir(html_dir)
+
+    # Modifications
+
+    # TODO test
+    def notify_listeners(self, event):
+        """Notifies the listeners about an event.
+
+        **Argument:**
+
+        - `event` (|PostDBEvent|)
+        """
+
+        for listener in self.listeners:
+            listener(event)
+
+    # TODO test
+    def touch(self, post=None, fields=None):
+        """If something in the database changes, this function should be
+        called.
+
+        If a post in the database is changed, this function will be invoked
+        automatically, so there is no need to call it again.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+
+        **Arguments:**
+
+        - `post` (|Post| | ``None``) -- The post concerned in the database
+          modification. If not ``None``, the listeners will be notified and
+          only the data that depends on the post is updated (see
+          :func:`_post_changed`). If ``None``, all the lazy data attributes
+          are cleared and the listeners are notified with a ``'touch_all'``
+          event.
+        - `fields` (iterable(|PostField|) | ``None``) -- The fields of `post`
+          that were modified. ``None`` means that any field may have been
+          modified.
+        """
+
+        if fields is not None:
+            fields = frozenset(fields)
+
+        self._generation += 1
+        if post is None:
+            self._clear_lazy_data()
+            self.notify_listeners(PostDBEvent(type='touch_all'))
+        else:
+            self._post_changed(post, fields)
+            if self._batch_level > 0:
+                if post in self._batch_touched:
+                    old_fields = self._batch_touched[post]
+                    if old_fields is None or fields is None:
+                        fields = None
+                    else:
+                        fields = old_fields.union(fields)
+                self._batch_touched[post] = fields
+            else:
+                self.notify_listeners(
+                    PostDBEvent(type='touch', post=post, fields=fields))
+
+    def _clear_lazy_data(self):
+        """Clears all lazy data attributes of the post database.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        self._posts = None
+        self._all = None
+        self._threadstruct = None
+        self._cycles = None
+        self._cycle_post_ids = None
+        self._roots = None
+        self._threads = None
+        self._thread_arrays = None
+        self._root_handles = None
+        self._depths = None
+        self._post_links = None
+        self._link_refs = None
+        self._post_index_keys = None
+        self._heap_index = None
+        self._author_index = None
+        self._tag_index = None
+        self._date_index = None
+        self._undated_handles = None
+        self._date_index_keys = None
+
+    def generation(self):
+        """Returns the generation of the post database.
+
+        The generation is increased each time the post database is touched
+        (see :func:`touch`) and each time a post is added to or removed from
+        it (see :func:`add_post_to_dicts` and :func:`remove_post_from_dicts`),
+        so data calculated from the post database can be reused as long as the
+        generation has not changed.
+
+        **Returns:** int
+        """
+
+        return self._generation
+
+    def pending_touched(self):
+        """Returns the posts touched in the currently open :func:`batch`
+        block, about which the listeners have not been notified yet.
+
+        **Returns:** {|Post|: frozenset(|PostField|) | ``None``} -- The
+        touched posts and their modified fields (``None`` means any field).
+        Empty if no batch block is open.
+        """
+
+        if self._batch_level > 0:
+            return self._batch_touched.copy()
+        else:
+            return {}
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Returns a context manager that collects the touch events of the
+        posts modified inside the ``with`` block.
+
+        The lazy data attributes are still updated at each modification, so
+        the post database can be used normally inside the block. But instead
+        of one ``'touch'`` event per modification, the listeners are notified
+        only once at the end of the block with a ``'batch_touch'`` event,
+        which contains all the touched posts and the union of the modified
+        fields. The blocks can be nested; the event is sent at the end of the
+        outermost block.
+
+        **Example:** ::
+
+            with postdb.batch():
+                for post in posts:
+                    post.add_tag('done')
+        """
+
+        self._batch_level += 1
+        try:
+            yield
+        finally:
+            self._batch_level -= 1
+            if self._batch_level == 0 and len(self._batch_touched) > 0:
+                touched = self._batch_touched
+                self._batch_touched = {}
+                fields = frozenset()
+                for post_fields in touched.itervalues():
+                    if post_fields is None:
+                        fields = None
+                        break
+                    fields = fields.union(post_fields)
+                self.notify_listeners(
+                    PostDBEvent(type='batch_touch',
+                                posts=PostSet(self, touched.keys()),
+                                fields=fields))
+
+    def _post_changed(self, post, fields=None):
+        """Updates the lazy data attributes after a post was changed, added
+        to the database or removed from it.
+
+        Each lazy data attribute is updated only if a field on which it depends
+        was modified: the list and set of all posts depend on
+        `POSTSET_FIELDS`, the thread structure and the data calculated from it
+        depend on `THREADSTRUCT_FIELDS`, the heap link index depends on
+        `LINK_INDEX_FIELDS`, the tag, author and heap indexes depend on
+        `FIELD_INDEX_FIELDS`, the date index depends on `DATE_INDEX_FIELDS`.
+
+        The list and set of all posts are cleared only if the post was added
+        or removed (or deleted or undeleted). The thread structure is patched
+        by :func:`_update_threadstruct`; the cycles, roots and threads are
+        cleared only if the thread structure has changed in a way that
+        affects them.
+
+        **Arguments:**
+
+        - `post` (|Post|)
+        - `fields` (frozenset(|PostField|) | ``None``) -- The fields of `post`
+          that were modified. ``None`` means that any field may have been
+          modified (or the post was added or removed).
+        """
+
+        post_id = post.post_id()
+
+        if fields is None or not POSTSET_FIELDS.isdisjoint(fields):
+            current = self.post_id_to_post.get(post_id)
+            present = current is post and not post.is_deleted()
+            if self._all is None:
+                self._posts = None
+            elif (post in self._all) != present:
+                self._posts = None
+                self._all = None
+
+        if fields is None or not LINK_INDEX_FIELDS.isdisjoint(fields):
+            self._update_link_index(post_id)
+
+        if fields is None or not FIELD_INDEX_FIELDS.isdisjoint(fields):
+            self._update_field_indexes(post_id)
+
+        if fields is None or not DATE_INDEX_FIELDS.isdisjoint(fields):
+            self._update_date_index(post_id)
+
+        if fields is not None and THREADSTRUCT_FIELDS.isdisjoint(fields):
+            return
+
+        self._update_threadstruct(post_id)
+
+    def notify_changed_messid(self, post, old_messid, new_messid):
+        """Should be called when the messid of a post changed.
+
+        **Argument:**
+
+        - `post` (|Post|) -- The post whose messid changed.
+        - `old_messid` (|Messageid|) -- The old messid.
+        - `new_messid` (|Messageid|) -- The new messid.
+        """
+
+        post_id = post.post_id()
+
+        # We should remove the old messid from messid_to_post_id only if `post`
+        # is stored as the owner of that messid
+        if self.messid_to_post_id.get(old_messid) == post_id:
+            del self.messid_to_post_id[old_messid]
+
+        self.messid_to_post_id.setdefault(new_messid, post_id)
+
+    # Get-set functions
+
+    def has_post_id(self, post_id):
+        """Returns whether there is a post with the given post id.
+
+        **Argument:**
+
+        - `post_id` (|PostId|)
+
+        **Returns:** bool
+        """
+
+        return self.post_id_to_post.has_key(post_id)
+
+    def heap_ids(self):
+        """Returns the heap ids.
+
+        **Returns:** [|HeapId|]
+        """
+
+        return self._heaps.keys()
+
+    def has_heap_id(self, heap_id):
+        """Returns whether there is a heap with the given heap id.
+
+        **Argument:**
+
+        - `heap_id` (|HeapId|)
+
+        **Returns:** bool
+        """
+
+        return self._heaps.has_key(heap_id)
+
+    def next_post_index(self, heap_id, prefix=''):
+        """Returns the next free post index with the form ``prefix + int``.
+
+        The "next" here means the post index with smallest number which is
+        larger than all numbers present in all other post indices with the
+        given prefix.
+
+        This function uses a caching mechanism to avoid iterating over all
+        posts on each calling. This cache is the `_next_heapid` data member,
+        a dictionary where the keys are the prefixes. The empty prefix is
+        always cached, while other prefixes are cached after the first lookup.
+
+        **Arguments**:
+
+        - `heap_id` (|HeapId|) -- The heap in which the next free post index
+          should be found.
+        - `prefix` (str) -- The prefix of the new heapid.
+
+        **Returns**: |PostIndex|
+        """
+
+        cache = self._next_post_index
+        key = (heap_id, prefix)
+
+        # If the heap_id+prefix pair is not in the cache, we put it there
+        if not cache.has_key(key):
+            numbers = []
+            for curr_post_id, _curr_post in self.post_id_to_post.iteritems():
+                curr_heap_id, curr_post_index = curr_post_id
+                if (curr_heap_id != heap_id or
+                    not curr_post_index.startswith(prefix)):
+                    continue
+                number_str = curr_post_index[len(prefix):]
+                try:
+                    numbers.append(int(number_str))
+                except ValueError:
+                    pass
+            if numbers == []:
+                cache[(heap_id, prefix)] = 1
+            else:
+                cache[(heap_id, prefix)] = max(numbers) + 1
+
+        # We find and return the first candidate index that is not used
+        while True:
+            next_candidate = prefix + str(cache[key])
+            cache[key] += 1
+            if not self.has_post_id((heap_id, next_candidate)):
+                return next_candidate
+
+    def invalidate_next_post_index_cache(self):
+        """Invalidates the "next post index" cache."""
+
+        self._next_post_index = {}
+
+    def real_posts(self):
+        """Returns the list of all posts, even the deleted ones.
+
+        **Returns:** [|Post|]
+        """
+
+        return self.post_id_to_post.values()
+
+    def posts(self):
+        """Returns the list of all posts that are not deleted.
+
+        The object returned by this function should not be modified.
+
+        **Returns:** [|Post|]
+        """
+
+        self._recalc_posts()
+        return self._posts
+
+    def _recalc_posts(self):
+        """Recalculates the `_posts` data attribute if needed.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._posts == None:
+            self._posts = \
+                [ p for p in self.real_posts() if not p.is_deleted() ]
+
+    def postset(self, posts, default_heap=None):
+        """Creates a PostSet that will contain the specified posts.
+
+        **Arguments:**
+
+        - `posts` (|PrePostSet|)
+        - `default_heap` (|HeapId| | ``None``)
+
+        **Returns:** |PostSet|
+        """
+
+        return PostSet(self, posts, default_heap)
+
+    def postbitset(self, posts, default_heap=None):
+        """Creates a PostBitSet that will contain the specified posts.
+
+        **Arguments:**
+
+        - `posts` (|PrePostSet|)
+        - `default_heap` (|HeapId| | ``None``)
+
+        **Returns:** |PostBitSet|
+        """
+
+        return PostBitSet(self, posts, default_heap)
+
+    def post_by_post_id(self, post_id):
+        """Finds a post by its post id.
+
+        **Argument:**
+
+        - `post_id` (|PostId|)
+
+        **Returns:** |Post| | ``None``
+        """
+
+        Post.assert_is_post_id(post_id)
+        return self.post_id_to_post.get(Post.unify_post_id(post_id))
+
+    def post_by_messid(self, messid):
+        """Finds a post by its message id.
+
+        **Argument:**
+
+        - `post_id` (|Messageid|)
+
+        **Returns:** |Post| | ``None``
+        """
+
+        post_id = self.messid_to_post_id.get(messid)
+        if post_id is None:
+            return None
+        else:
+            return self.post_by_post_id(post_id)
+
+    def post(self, prepost, default_heap=None, raise_exception=False):
+        """Converts a |PrePost| into a |Post|.
+
+        In other words, it returns the post specified by its post id or message
+        id or post index or the post itself. See the definition of |PrePost| on
+        how the conversion happens.
+
+        **Arguments:**
+
+        - `prepost` (|PrePost|)
+        - `default_heap` (|HeapId| | ``None``)
+        - `raise_exception` (bool) -- Specifies what should happen it the post
+          is not found. If raise_exception is ``False``, ``None`` will be
+          returned, otherwise a |PostNotFoundError| exception will be raised.
+
+        **Returns:** |Post| | ``None``
+
+        **Raises:**
+
+        - |PostNotFoundError| -- The post was not found and `raise_exception`
+          was ``True``.
+        """
+
+        # Is `prepost` the post itself?
+        if isinstance(prepost, Post):
+            return prepost
+
+        # Try with `prepost` as post id
+        if Post.is_post_id(prepost):
+            post = self.post_by_post_id(prepost)
+            if post is not None:
+                return post
+
+        # Try with `(default_heap, prepost)` as post id
+        if (default_heap is not None
+            and Post.is_post_id((default_heap, prepost))):
+
+            post = self.post_by_post_id((default_heap, prepost))
+            if post is not None:
+                return post
+
+        # Try with `prepost` as message id
+        if isinstance(prepost, str):
+            post = self.post_by_messid(prepost)
+            if post is not None:
+                return post
+
+        if raise_exception:
+            raise PostNotFoundError(prepost)
+        else:
+            return None
+
+    # Save, reload
+
+    def save(self):
+        """Saves all the posts that needs to be saved."""
+        for post in self.real_posts():
+            post.save()
+        for storage in self._storages.itervalues():
+            storage.flush()
+
+    def reload(self):
+        """Reloads the database from the disk.
+
+        The unsaved changes will be abandoned.
+        """
+
+        self.reload_heaps(sorted(self._heaps.keys()))
+
+    def reload_heaps(self, heap_ids):
+        """Reloads the posts of the given heaps that have changed.
+
+        The stamps of the stored posts are compared with the stamps of the
+        post objects (i.e. the stamps when they were read or written). Only
+        the posts whose stamp differs or which are modified in the memory are
+        read again; new posts are added and the posts that are not stored any
+        more are removed.
+
+        Only the posts that actually changed (and the new and removed posts)
+        are touched in a :func:`batch` block, so the listeners are notified
+        only about them. If the body of a post is not in the memory, only its
+        header is compared with the stored one, and the body will be read from
+        the post file when needed.
+
+        The unsaved changes will be abandoned.
+
+        **Argument:**
+
+        - `heap_ids` ([|HeapId|])
+        """
+
+        heap_posts = dict((heap_id, {}) for heap_id in heap_ids)
+        for post_id, post in self.post_id_to_post.iteritems():
+            heap_id, post_index = post_id
+            if heap_id in heap_posts:
+                heap_posts[heap_id][post_index] = post
+
+        # `to_read` will contain the posts to be read in the following format:
+        # [(heap_id, post_index, stamp)]
+        to_read = []
+        # `removed` will contain the posts that are not stored any more
+        removed = []
+        for heap_id in heap_ids:
+            posts = heap_posts[heap_id]
+            for post_index, stamp in \
+                self.storage(heap_id).stamps().iteritems():
+                post = posts.pop(post_index, None)
+                if post is None or post._stamp != stamp or post.is_modified():
+                    to_read.append((heap_id, post_index, stamp))
+            removed.extend(posts.itervalues())
+
+        read_body = not self._lazy_bodies
+        tasks = [ self.storage(heap_id).parse_task(post_index, read_body)
+                  for heap_id, post_index, _ in to_read ]
+        parsed_posts = self.parse_posts(tasks)
+
+        with self.batch():
+
+            # The removed posts are touched so that the listeners learn about
+            # their removal
+            for post in removed:
+                self.remove_post_from_dicts(post)
+                self.touch(post)
+
+            for (heap_id, post_index, stamp), parsed_post in \
+                zip(to_read, parsed_posts):
+
+                post_id = (heap_id, post_index)
+                header, body, body_offset = \
+                    self._create_parsed_post(post_id, parsed_post)
+                post = self.post_id_to_post.get(post_id)
+                if post is None:
+                    post = Post.from_parsed(header, body, post_id, self,
+                                            body_offset)
+                    self.add_post_to_dicts(post)
+                    self.touch(post)
+                else:
+                    # If the body of the post is in the memory, the new body
+                    # is needed to find out whether the post has changed;
+                    # otherwise only the headers are compared, and the body
+                    # will be read from its new position when needed
+                    if body is None and post.is_body_loaded():
+                        body = self.storage(heap_id).read_body(post_index,
+                                                               body_offset)
+                    changed = (post.is_modified() or header != post._header or
+                               (body is not None and body != post._body))
+                    resident = post in self._resident_bodies
+                    # The post is removed from the dictionaries while it is
+                    # changed, because its messid may change
+                    self.remove_post_from_dicts(post)
+                    post.read_parsed(header, body, True, body_offset)
+                    self.add_post_to_dicts(post)
+                    if resident:
+                        self.notify_body_loaded(post)
+                    # The post is the same as the stored one
+                    post._modified = False
+                    if changed:
+                        self.touch(post)
+                post._stamp = stamp
+
+        # We remove the entries about the given heaps from the
+        # next_post_index cache
+        for curr_heap_id, prefix in list(self._next_post_index.keys()):
+            if curr_heap_id in heap_ids:
+                del self._next_post_index[(curr_heap_id, prefix)]
+
+    # New posts
+
+    def add_new_post(self, post, heap_id, post_index=None, prefix=''):
+        """Adds a new post to the postdb.
+
+        **Arguments:**
+
+        - `post` (|Post|) -- The post to be added to the database.
+        - `heap_id` (|HeapId|) -- The heap to which the post is added.
+        - `post_index` (str | ``None``) -- The post should have this post
+          index. If ``None``, the post should get the next free post index
+          that starts with `prefix` (see the definition of "next free post
+          index" at :func:`next_post_index`).
+        - `prefix` (str) -- If `post_index` is ``None``, the post should get
+          the next free heapid that starts with `prefix`.
+
+        **Returns:** |Post|
+        """
+
+        if post_index == None:
+            post_index = self.next_post_index(heap_id, prefix=prefix)
+        post.add_to_postdb((heap_id, post_index), self)
+        self.add_post_to_dicts(post)
+        self.touch(post)
+        return post
+
+    # All posts
+
+    def all(self):
+        """Returns the post set of all posts that are not deleted.
+
+        The object returned by this function should not be modified. On the
+        other hand, the posts contained by it can be modified.
+
+        **Returns:** |PostSet|
+        """
+
+        self._recalc_all()
+        return self._all
+
+    def _recalc_all(self):
+        """Recalculates the `_all` data attribute if needed.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._all == None:
+            self._all = PostSet(self, self.posts())
+
+    # Thread structure
+
+    def threadstruct(self):
+        """Returns the thread structure of the post database.
+
+        The object returned by this function should not be modified.
+
+        **Returns:** |ThreadStruct|
+        """
+
+        self._recalc_threadstruct()
+        self._threadstruct_shared = True
+        return self._threadstruct
+
+    def parent(self, post):
+        """Returns the parent of the given post.
+
+        If there is no such post in the database, it returns ``None``.
+
+        The Parent headers are not resolved on each call: the post id of the
+        resolved parent is stored in `_thread_state`, which is updated only
+        when a Parent header, a messid or the set of posts changes.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** |Post| | ``None``
+        """
+
+        self._recalc_threadstruct()
+        post_id = post.post_id()
+        assert(post_id in self._thread_state)
+        _header, _refs, parent_id, _sort_key = self._thread_state[post_id]
+        if parent_id is None:
+            return None
+        return self.post_id_to_post[parent_id]
+
+    def _resolve_parent(self, post):
+        """Returns the parent of the given post without checking whether the
+        post is in the database.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** |Post| | ``None``
+        """
+
+        postparent = post.parent()
+
+        if postparent == '':
+            return None
+
+        parentpost = self.post(postparent, default_heap=post.heap_id())
+
+        # deleted posts do not count
+        if parentpost is not None and parentpost.is_deleted():
+            return None
+
+        return parentpost
+
+    def root(self, post):
+        """Returns the :ref:`root <glossary_root>` of a post.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** |Post| | ``None`` -- ``None`` is returned when the post
+        is in a cycle.
+        """
+
+        self._recalc_root_handles()
+        post_id = post.post_id()
+        assert(post_id in self._thread_state)
+        root_handle = self._root_handles[self._handles[post_id]]
+        if root_handle == -1:
+            return None
+        return self._handle_table[root_handle]
+
+    def depth(self, post):
+        """Returns the depth of a post in its thread, i.e. the number of its
+        ancestors.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** int | ``None`` -- ``None`` is returned when the post is in
+        a cycle.
+        """
+
+        self._recalc_root_handles()
+        post_id = post.post_id()
+        assert(post_id in self._thread_state)
+        depth = self._depths[self._handles[post_id]]
+        return depth if depth != -1 else None
+
+    def _recalc_thread_arrays(self):
+        """Recalculates the `_thread_arrays` data attribute if needed.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._thread_arrays is None:
+            self._recalc_threadstruct()
+            threadstruct = self._threadstruct
+            handles = self._handles
+            n = len(self._handle_table)
+
+            # offsets[h + 1] will be the number of children of post `h`, and
+            # then the prefix sums are calculated
+            offsets = array.array('i', [0]) * (n + 1)
+            for post_id, children in threadstruct.iteritems():
+                if post_id is not None:
+                    offsets[handles[post_id] + 1] = len(children)
+            for h in xrange(n):
+                offsets[h + 1] += offsets[h]
+
+            child_handles = array.array('i', [0]) * offsets[n]
+            for post_id, children in threadstruct.iteritems():
+                if post_id is not None:
+                    i = offsets[handles[post_id]]
+                    for child_id in children:
+                        child_handles[i] = handles[child_id]
+                        i += 1
+
+            root_handles = \
+                array.array('i', [ handles[post_id]
+                                   for post_id in threadstruct[None] ])
+            self._thread_arrays = (root_handles, offsets, child_handles)
+
+    def _recalc_root_handles(self):
+        """Recalculates the `_root_handles` and `_depths` data attributes if
+        needed.
+
+        The thread structure is walked once; the posts that are not reached
+        are in cycles.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._root_handles is None:
+            self._recalc_thread_arrays()
+            roots, offsets, child_handles = self._thread_arrays
+            n = len(offsets) - 1
+            root_handles = array.array('i', [-1]) * n
+            depths = array.array('i', [-1]) * n
+            for root in roots:
+                root_handles[root] = root
+                depths[root] = 0
+                stack = [root]
+                while len(stack) > 0:
+                    h = stack.pop()
+                    depth = depths[h] + 1
+                    for i in xrange(offsets[h], offsets[h + 1]):
+                        child = child_handles[i]
+                        root_handles[child] = root
+                        depths[child] = depth
+                        stack.append(child)
+            self._root_handles = root_handles
+            self._depths = depths
+
+    def _descendants(self, posts):
+        """Returns the given posts and all their descendants.
+
+        The thread structure is walked using `_thread_arrays`.
+
+        **Argument:**
+
+        - `posts` (iterable(|Post|))
+
+        **Returns:** set(|Post|)
+        """
+
+        self._recalc_thread_arrays()
+        _roots, offsets, child_handles = self._thread_arrays
+        handle_table = self._handle_table
+        result = set()
+        for post in posts:
+            assert(post.post_id() in self._thread_state)
+            if post in result:
+                continue
+            stack = [self._handles[post.post_id()]]
+            while len(stack) > 0:
+                h = stack.pop()
+                curr_post = handle_table[h]
+                if curr_post not in result:
+                    result.add(curr_post)
+                    stack.extend(child_handles[offsets[h]:offsets[h + 1]])
+        return result
+
+    def children(self, post, threadstruct=None):
+        """Returns the :ref:`children <glossary_parent_child>` of the given
+        post.
+
+        If `post` is ``None``, it returns the posts with no parents (i.e. whose
+        parent is ``None``).
+
+        **Arguments:**
+
+        - `post` (|Post| | ``None``)
+        - `threadstruct` (|ThreadStruct| | ``None``) -- The thread structure to
+          be used. If ``None``, the thread structure of the post database is
+          used. (Note: that is usually what we want.)
+
+        **Returns:** [Post]
+        """
+
+        assert(post == None or post in self.all())
+
+        if threadstruct is None:
+            threadstruct = self.threadstruct()
+
+        if post == None:
+            children_post_ids = threadstruct.get(None, [])
+        else:
+            children_post_ids = threadstruct.get(post.post_id(), [])
+
+        # This assertion can catch nasty bugs when the thread structure
+        # contains a string as a value instead of a list.
+        assert(isinstance(children_post_ids, list))
+
+        return [ self.post(post_id) for post_id in children_post_ids ]
+
+    def _recalc_threadstruct(self):
+        """Recalculates the `_threadstruct` data attribute if needed.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._threadstruct == None:
+
+            threads = {None: []} # dict(post_id,[answered:(timestamp,post_id)])
+            self._thread_state = {}
+            self._parent_refs = {}
+            for post in self.posts():
+                state = self._thread_post_state(post)
+                parent_header, _refs, parent_post_id, sort_key = state
+                self._thread_state[post.post_id()] = state
+                if parent_header != '':
+                    self._parent_refs.setdefault(parent_header, set()).\
+                        add(post.post_id())
+                if parent_post_id in threads:
+                    threads[parent_post_id].append(sort_key)
+                else:
+                    threads[parent_post_id] = [sort_key]
+            t = {}
+            for post_id in threads:
+                threads[post_id].sort()
+                t[post_id] = \
+                    [ post_id2 for timestamp, post_id2 in threads[post_id] ]
+            self._threadstruct = t
+            self._threadstruct_shared = False
+
+    def _post_refs(self, post):
+        """Returns the strings with which the Parent header of other posts
+        can refer to the given post: its post id string, its post index and
+        its messid (if the messid belongs to this post in
+        `messid_to_post_id`).
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** (str)
+        """
+
+        refs = [post.post_id_str(), post.post_index()]
+        messid = post.messid()
+        if (messid not in ('', None) and
+            self.messid_to_post_id.get(messid) == post.post_id()):
+            refs.append(messid)
+        return tuple(refs)
+
+    def _thread_post_state(self, post):
+        """Returns the information that determines the place of a
+        non-deleted post in the thread structure.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** (str, (str), |PostId| | ``None``, (int, |PostId|)) --
+        The Parent header, the references to the post (see
+        :func:`_post_refs`), the post id of the parent and the sort key of the
+        post.
+        """
+
+        parentpost = self._resolve_parent(post)
+        parent_post_id = parentpost.post_id() if parentpost != None else None
+        return (post.parent(), self._post_refs(post), parent_post_id,
+                post.sort_key())
+
+    def _update_threadstruct(self, post_id):
+        """Patches the thread structure after the post with the given post
+        id was changed, added or removed.
+
+        Only the child lists of the old and new parent of the post are
+        modified. If the post can be referred to in a different way than
+        before (e.g. it was added, deleted or its messid changed), the parents
+        of the posts whose Parent header may refer to it are resolved again.
+
+        The post itself is moved first, except when it is removed: then it is
+        moved after the posts that referred to it, so that the parents of the
+        posts are always in the thread structure while the cycles are updated.
+
+        The cycles are updated and the threads are cleared if a parent
+        changed; the roots are cleared if the list of root posts changed.
+
+        **Argument:**
+
+        - `post_id` (|PostId|)
+        """
+
+        if self._threadstruct is None:
+            return
+
+        post = self.post_id_to_post.get(post_id)
+        if post is not None and post.is_deleted():
+            post = None
+        old_state = self._thread_state.get(post_id)
+        new_state = \
+            self._thread_post_state(post) if post is not None else None
+        if old_state == new_state:
+            return
+
+        # The posts whose parent may have changed
+        changed_post_ids = set([post_id])
+        old_refs = old_state[1] if old_state is not None else ()
+        new_refs = new_state[1] if new_state is not None else ()
+        if old_refs != new_refs:
+            for ref in old_refs + new_refs:
+                changed_post_ids.update(self._parent_refs.get(ref, ()))
+
+        changed_post_ids.discard(post_id)
+        if new_state is not None:
+            self._move_in_threadstruct(post_id, old_state, new_state)
+        for changed_post_id in changed_post_ids:
+            changed_post = self.post_id_to_post[changed_post_id]
+            self._move_in_threadstruct(
+                changed_post_id,
+                self._thread_state[changed_post_id],
+                self._thread_post_state(changed_post))
+        if new_state is None:
+            self._move_in_threadstruct(post_id, old_state, new_state)
+
+    def _move_in_threadstruct(self, post_id, old_state, new_state):
+        """Moves a post from its old place in the thread structure to its new
+        place.
+
+        The child lists are never modified in place, so the thread structures
+        returned earlier by :func:`threadstruct` remain intact.
+
+        **Arguments:**
+
+        - `post_id` (|PostId|)
+        - `old_state` (tuple | ``None``) -- The old state of the post (see
+          :func:`_thread_post_state`). ``None`` if the post was not in the
+          thread structure.
+        - `new_state` (tuple | ``None``) -- The new state of the post.
+          ``None`` if the post should not be in the thread structure.
+        """
+
+        if old_state == new_state:
+            return
+
+        if self._threadstruct_shared:
+            self._threadstruct = dict(self._threadstruct)
+            self._threadstruct_shared = False
+        threadstruct = self._threadstruct
+
+        old_header, old_parent, old_key = \
+            (old_state[0], old_state[2], old_state[3]) \
+            if old_state is not None else ('', hkutils.NOT_SET, None)
+        new_header, new_parent, new_key = \
+            (new_state[0], new_state[2], new_state[3]) \
+            if new_state is not None else ('', hkutils.NOT_SET, None)
+
+        # Updating the Parent header index
+        if old_header != '':
+            post_ids = self._parent_refs[old_header]
+            post_ids.discard(post_id)
+            if len(post_ids) == 0:
+                del self._parent_refs[old_header]
+        if new_header != '':
+            self._parent_refs.setdefault(new_header, set()).add(post_id)
+
+        if old_parent == new_parent and old_key == new_key:
+            self._thread_state[post_id] = new_state
+            return
+
+        # Removing the post from its old place
+        if old_state is not None:
+            children = [ child for child in threadstruct[old_parent]
+                         if child != post_id ]
+            if len(children) > 0 or old_parent is None:
+                threadstruct[old_parent] = children
+            else:
+                del threadstruct[old_parent]
+            del self._thread_state[post_id]
+
+        # Inserting the post into its new place
+        if new_state is not None:
+            children = threadstruct.get(new_parent, [])
+            keys = [ self._thread_state[child][3] for child in children ]
+            index = bisect.bisect(keys, new_key)
+            threadstruct[new_parent] = \
+                children[:index] + [post_id] + children[index:]
+            self._thread_state[post_id] = new_state
+
+        self._thread_arrays = None
+        if old_parent != new_parent:
+            self._update_cycles(post_id, new_state)
+            self._threads = None
+            self._roots = None
+            self._root_handles = None
+            self._depths = None
+        elif new_parent is None:
+            # Only the order of the roots changed
+            self._roots = None
+
+    def _update_cycles(self, post_id, new_state):
+        """Updates `_cycle_post_ids` after the parent of a post changed.
+
+        Only the posts whose ancestor chain contains the moved post (i.e. the
+        post and its descendants) can get into or out of a cycle, and all of
+        them get into the same state as the post. The new state of the post is
+        determined by walking its new ancestor chain until one of the
+        following is found:
+
+        - the post itself or an ancestor already seen: the post is in a cycle;
+        - a root: the post is not in a cycle;
+        - an ancestor whose state differs from the old state of the post: it
+          is not a descendant of the post, so its state did not change, and
+          the post gets into the same state.
+
+        The descendants of the post are walked only if its state changed.
+
+        **Arguments:**
+
+        - `post_id` (|PostId|)
+        - `new_state` (tuple | ``None``) -- The new state of the post (see
+          :func:`_thread_post_state`). ``None`` if the post was removed from
+          the thread structure.
+        """
+
+        cycle_post_ids = self._cycle_post_ids
+        if cycle_post_ids is None:
+            return
+
+        old_in_cycle = post_id in cycle_post_ids
+        new_in_cycle = False
+        if new_state is not None:
+            visited = set()
+            ancestor = new_state[2]
+            while ancestor is not None:
+                if ancestor == post_id or ancestor in visited:
+                    new_in_cycle = True
+                    break
+                in_cycle = ancestor in cycle_post_ids
+                if in_cycle != old_in_cycle:
+                    new_in_cycle = in_cycle
+                    break
+                ancestor_state = self._thread_state.get(ancestor)
+                if ancestor_state is None:
+                    # The ancestor is not in the thread structure, the cycles
+                    # will be recalculated
+                    self._cycle_post_ids = None
+                    self._cycles = None
+                    return
+                visited.add(ancestor)
+                ancestor = ancestor_state[2]
+
+        if new_in_cycle == old_in_cycle:
+            return
+
+        # The state of the post and its descendants changed
+        threadstruct = self._threadstruct
+        descendants = set([post_id])
+        stack = [post_id]
+        while len(stack) > 0:
+            for child in threadstruct.get(stack.pop(), ()):
+                if child not in descendants:
+                    descendants.add(child)
+                    stack.append(child)
+        if new_in_cycle:
+            cycle_post_ids.update(descendants)
+        else:
+            cycle_post_ids.difference_update(descendants)
+        self._cycles = None
+
+    def iter_thread(self, post, threadstruct=None):
+        """Iterates over a thread.
+
+        The first element of the thread will be the post (except when the post
+        is None, which will not be yielded). All the consequenses of post will
+        be yielded in a preorder way. An example::
+
+            1 <- 2 <- 3
+              <- 4
+            5
+
+        The posts will be yielded in the following order: 1, 2, 3, 4, 5.
+
+        The posts can be modified during the iteration.
+
+        The thread is walked with an explicit stack, so yielding a post costs
+        the same regardless of its depth.
+
+        **Arguments:**
+
+        - `post` (|Post| | ``None``) -- The post whose (sub)thread should be
+          iterated.
+        - `threadstruct` (|ThreadStruct| | ``None``) -- The thread structure to
+          be used. If ``None``, the thread structure of the post database is
+          used. (Note: that is usually what we want.)
+
+        **Returns:** iterable(|Post|)
+        """
+
+        assert(post in self.all() or post == None)
+        if threadstruct == None:
+            threadstruct = self.threadstruct()
+            get_post = self.post_id_to_post.__getitem__
+        else:
+            get_post = self.post
+
+        if post != None:
+            stack = [post]
+        else:
+            stack = [ get_post(post_id)
+                      for post_id in reversed(threadstruct.get(None, [])) ]
+
+        while stack:
+            post = stack.pop()
+            yield post
+            child_post_ids = threadstruct.get(post.post_id(), ())
+            for i in xrange(len(child_post_ids) - 1, -1, -1):
+                stack.append(get_post(child_post_ids[i]))
+
+    def walk_thread(self, root, threadstruct=None, yield_inner=False,
+                    share_postitems=False):
+        """Walks a thread and yields its posts.
+
+        `walk_thread` walks the thread indicated by `root` with deep walk and
+        yields |PostItem| objects. A post item contains a post and some
+        additional information.
+
+        The post item contains the post's position, which can be ``begin`` or
+        ``end``. Each post is yielded twice during the walk. When the deep walk
+        enters the subthread of a post, the post is yielded with ``begin``
+        position. When the deep walk leaves its subthread, it is yielded with
+        ``end`` position.
+
+        The post item also contains the level of the post. The level of the
+        root post is 0, the level of its children is 1, etc. When the `root`
+        argument is ``None`` and the whole database is walked, the level of all
+        root posts is 0.
+
+        **Arguments:**
+
+        - `root` (|Post| | ``None``) -- The root of the thread to be walked. If
+          ``None``, the whole thread structure is walked.
+        - `threadstruct` (|ThreadStruct| | ``None``) -- The thread structure to
+          be used. If ``None``, the thread structure of the post database will
+          be used. (Note: that is usually what we want.)
+        - `yield_inner` (bool) -- If ``True``, each post is yielded a third
+          time with ``inner`` position right after its ``begin`` post item.
+        - `share_postitems` (bool) -- If ``True``, only one post item is
+          created for each post: it is yielded with all positions, and its
+          `pos` attribute is changed between them. This should be used only
+          when each post item is processed before the walk is continued.
+
+        **Returns:** iterable(|PostItem|)
+
+        **Example:**
+
+        The thread structure walked::
+
+            0 <- 1 <- 2
+              <- 3
+            4
+
+        The post items yielded (indentation is there only to help the human
+        reader)::
+
+            <PostItem: pos=begin, heapid='0', level=0>
+              <PostItem: pos=begin, heapid='1', level=1>
+                <PostItem: pos=begin, heapid='2', level=2>
+                <PostItem: pos=end, heapid='2', level=2>
+              <PostItem: pos=end, heapid='1', level=1>
+              <PostItem: pos=begin, heapid='3', level=1>
+              <PostItem: pos=end, heapid='3', level=1>
+            <PostItem: pos=end, heapid='0', level=0>
+            <PostItem: pos=begin, heapid='4', level=0>
+            <PostItem: pos=end, heapid='4', level=0>
+        """
+
+        # `stack` is initialized with the root posts, and `levels` contains
+        # the levels of the elements of `stack`.
+        # During the execution of the loop:
+        #  - the stack is popped,
+        #  - if we got a post, we yield a beginning `PostItem` for it, push
+        #    the matching ending `PostItem` (which is the marker of the end of
+        #    the subthread), and then push all the children of the post,
+        #  - if we got an ending `PostItem`, we yield it.
+        # This means that we will yield the ending `PostItem` once all the
+        # children (and their children etc.) are processed. No `PostItem` is
+        # created for a post before it is reached.
+
+        assert(root in self.all() or root == None)
+        if threadstruct == None:
+            threadstruct = self.threadstruct()
+            get_post = self.post_id_to_post.__getitem__
+        else:
+            get_post = self.post
+
+        if root is None:
+            stack = [ get_post(post_id)
+                      for post_id in reversed(threadstruct.get(None, [])) ]
+        else:
+            stack = [root]
+        levels = [0] * len(stack)
+
+        while stack:
+
+            level = levels.pop()
+            item = stack.pop()
+
+            if item.__class__ is PostItem:
+                if share_postitems:
+                    item.pos = 'end'
+                yield item
+                continue
+
+            postitem = PostItem('begin', item, level)
+            yield postitem
+
+            if share_postitems:
+                if yield_inner:
+                    postitem.pos = 'inner'
+                    yield postitem
+                postitem_end = postitem
+            else:
+                if yield_inner:
+                    postitem_inner = postitem.copy()
+                    postitem_inner.pos = 'inner'
+                    yield postitem_inner
+                postitem_end = postitem.copy()
+                postitem_end.pos = 'end'
+
+            # pushing the closing pair of postitem into the stack
+            stack.append(postitem_end)
+            levels.append(level)
+
+            # pushing the children of the post into the stack
+            child_post_ids = threadstruct.get(item.post_id(), ())
+            level += 1
+            for i in xrange(len(child_post_ids) - 1, -1, -1):
+                stack.append(get_post(child_post_ids[i]))
+                levels.append(level)
+
+    def cycles(self):
+        """Returns the posts that are in a :ref:`cycle <glossary_cycle>` of the
+        thread structure.
+
+        **Returns:** |PostSet|
+        """
+
+        self._recalc_cycles()
+        return self._cycles
+
+    def has_cycle(self):
+        """Returns whether there is a :ref:`cycle <glossary_cycle>` in the
+        thread structure.
+
+        **Returns:** bool
+        """
+
+        if self._cycle_post_ids is None:
+            self._recalc_cycles()
+        return len(self._cycle_post_ids) != 0
+
+    def _recalc_cycles(self):
+        """Recalculates the `_cycles` data attribute if needed.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._cycle_post_ids is None:
+            # A post is in a cycle <=> it cannot be accessed from the roots
+            self._recalc_root_handles()
+            root_handles = self._root_handles
+            handles = self._handles
+            self._cycle_post_ids = \
+                set([ post.post_id() for post in self.posts()
+                      if root_handles[handles[post.post_id()]] == -1 ])
+            self._cycles = None
+
+        if self._cycles is None:
+            self._cycles = \
+                PostSet(self,
+                        [ self.post_id_to_post[post_id]
+                          for post_id in self._cycle_post_ids ])
+
+    def walk_cycles(self):
+        """Walks and yields post items for the posts in :ref:`cycles
+        <glossary_cycle>`.
+
+        The ``pos`` attribute of the post items will be ``'flat'``. The
+        ``level`` attribute will be 0.
+
+        **Returns:** iterable(|PostItem|)
+        """
+
+        for post in self.cycles().sorted_list():
+            yield PostItem(pos='flat', post=post, level=0)
+
+    def roots(self):
+        """Returns the :ref:`root <glossary_root>` posts (i.e. the ones with no
+        parent).
+
+        **Returns:** |PostSet|
+        """
+
+        self._recalc_roots()
+        return self._roots
+
+    def _recalc_roots(self):
+        """Recalculates the `_roots` data attribute if needed.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._roots == None:
+            self._roots = [ self.post(post_id)
+                            for post_id in self.threadstruct()[None] ]
+
+    def threads(self):
+        """Returns a dictionary that assigns posts in a thread to the
+        :ref:`root <glossary_root>` of the thread.
+
+        **Returns:** {|Post|: |PostSet|}
+        """
+
+        self._recalc_threads()
+        return self._threads
+
+    def _recalc_threads(self):
+        """Recalculates the `_threads` data attribute if needed.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._threads == None:
+            self._threads = {}
+            for root in self.roots():
+                self._threads[root] = self.postset(root).expf()
+
+    # References
+
+    def _body_links(self, post):
+        """Returns the prepost ids of the heap links in the body of a post.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** (str)
+        """
+
+        links = set()
+        for segment in post.body_object().segments:
+            if segment.type == 'heap_link':
+                links.add(segment.get_prepost_id_str())
+        return tuple(sorted(links))
+
+    def _recalc_link_index(self):
+        """Recalculates the `_post_links` and `_link_refs` data attributes if
+        needed.
+
+        The bodies of all posts are parsed, so this is an expensive operation;
+        afterwards the index is updated only for the posts whose body changes.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._post_links is None:
+            self._post_links = {}
+            self._link_refs = {}
+            for post in self.posts():
+                links = self._body_links(post)
+                if len(links) > 0:
+                    post_id = post.post_id()
+                    self._post_links[post_id] = links
+                    for link in links:
+                        self._link_refs.setdefault(link, set()).add(post_id)
+
+    def _update_link_index(self, post_id):
+        """Updates the heap link index after the post with the given post id
+        was changed, added or removed.
+
+        **Argument:**
+
+        - `post_id` (|PostId|)
+        """
+
+        if self._post_links is None:
+            return
+
+        post = self.post_id_to_post.get(post_id)
+        if post is None or post.is_deleted():
+            new_links = ()
+        else:
+            new_links = self._body_links(post)
+        old_links = self._post_links.get(post_id, ())
+        if old_links == new_links:
+            return
+
+        for link in old_links:
+            post_ids = self._link_refs[link]
+            post_ids.discard(post_id)
+            if len(post_ids) == 0:
+                del self._link_refs[link]
+        for link in new_links:
+            self._link_refs.setdefault(link, set()).add(post_id)
+        if len(new_links) > 0:
+            self._post_links[post_id] = new_links
+        else:
+            del self._post_links[post_id]
+
+    def _referring_post_ids(self, refs):
+        """Returns the non-deleted posts whose Parent header or heap links
+        contain one of the given references.
+
+        **Argument:**
+
+        - `refs` (iterable(str)) -- Post id strings, post indices or messids.
+
+        **Returns:** set(|PostId|)
+        """
+
+        self._recalc_threadstruct()
+        self._recalc_link_index()
+        post_ids = set()
+        for ref in refs:
+            post_ids.update(self._parent_refs.get(ref, ()))
+            post_ids.update(self._link_refs.get(ref, ()))
+        return post_ids
+
+    def referring_posts(self, post):
+        """Returns the posts that refer to the given post either in their
+        Parent header or with a heap link in their body.
+
+        The posts are looked up in an index, so the bodies of the posts are
+        not parsed again on each call.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** |PostSet|
+        """
+
+        result = PostSet(self, [])
+        for post_id in self._referring_post_ids(self._post_refs(post)):
+            curr_post = self.post_id_to_post[post_id]
+            heap_id = curr_post.heap_id()
+            refs = [curr_post.parent()] + \
+                   list(self._post_links.get(post_id, ()))
+            for ref in refs:
+                if ref != '' and self.post(ref, default_heap=heap_id) is post:
+                    result.add(curr_post)
+                    break
+        return result
+
+    # Tag, author and heap indexes
+
+    def _recalc_field_indexes(self):
+        """Recalculates the `_post_index_keys`, `_heap_index`, `_author_index`
+        and `_tag_index` data attributes if needed.
+
+        Afterwards the indexes are updated only for the posts whose author or
+        tags change and for the posts that are added or removed.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._post_index_keys is None:
+            self._post_index_keys = {}
+            self._heap_index = {}
+            self._author_index = {}
+            self._tag_index = {}
+            for post_id in self.post_id_to_post:
+                self._update_field_indexes(post_id)
+
+    def _update_field_indexes(self, post_id):
+        """Updates the tag, author and heap indexes after the post with the
+        given post id was changed, added or removed.
+
+        **Argument:**
+
+        - `post_id` (|PostId|)
+        """
+
+        if self._post_index_keys is None:
+            return
+
+        post = self.post_id_to_post.get(post_id)
+        if post is None:
+            new_keys = None
+        else:
+            new_keys = (post.author(), tuple(post.tags()))
+        old_keys = self._post_index_keys.get(post_id)
+        if old_keys == new_keys:
+            return
+
+        def discard(index, key):
+            post_ids = index[key]
+            post_ids.discard(post_id)
+            if len(post_ids) == 0:
+                del index[key]
+
+        heap_id = post_id[0]
+        if old_keys is not None:
+            author, tags = old_keys
+            discard(self._heap_index, heap_id)
+            author_posts = self._author_index[normalize_author(author)]
+            discard(author_posts, author)
+            if len(author_posts) == 0:
+                del self._author_index[normalize_author(author)]
+            for tag in tags:
+                discard(self._tag_index, tag)
+            del self._post_index_keys[post_id]
+
+        if new_keys is not None:
+            author, tags = new_keys
+            self._heap_index.setdefault(heap_id, set()).add(post_id)
+            author_posts = \
+                self._author_index.setdefault(normalize_author(author), {})
+            author_posts.setdefault(author, set()).add(post_id)
+            for tag in tags:
+                self._tag_index.setdefault(tag, set()).add(post_id)
+            self._post_index_keys[post_id] = new_keys
+
+    def _non_deleted_postset(self, post_ids):
+        """Returns the post set of the non-deleted posts with the given post
+        ids.
+
+        **Argument:**
+
+        - `post_ids` (iterable(|PostId|))
+
+        **Returns:** |PostSet|
+        """
+
+        result = PostSet(self, [])
+        for post_id in post_ids:
+            post = self.post_id_to_post[post_id]
+            if not post.is_deleted():
+                result.add(post)
+        return result
+
+    def tag_names(self):
+        """Returns the tags that are used by the posts of the database
+        (including the deleted ones).
+
+        **Returns:** [|Tag|]
+        """
+
+        self._recalc_field_indexes()
+        return self._tag_index.keys()
+
+    def author_names(self):
+        """Returns the authors of the posts of the database (including the
+        deleted ones).
+
+        **Returns:** [str]
+        """
+
+        self._recalc_field_indexes()
+        return [ author
+                 for author_posts in self._author_index.itervalues()
+                 for author in author_posts ]
+
+    def post_ids_with_tag(self, tag):
+        """Returns the post ids of the posts that have the given tag,
+        including the deleted posts.
+
+        The returned object should not be modified.
+
+        **Argument:**
+
+        - `tag` (|Tag|)
+
+        **Returns:** set(|PostId|)
+        """
+
+        self._recalc_field_indexes()
+        return self._tag_index.get(tag, frozenset())
+
+    def post_ids_by_author(self, author):
+        """Returns the post ids of the posts whose author is the given author
+        after normalization (see :func:`normalize_author`), including the
+        deleted posts.
+
+        **Argument:**
+
+        - `author` (str)
+
+        **Returns:** set(|PostId|)
+        """
+
+        self._recalc_field_indexes()
+        result = set()
+        author_posts = self._author_index.get(normalize_author(author), {})
+        for post_ids in author_posts.itervalues():
+            result.update(post_ids)
+        return result
+
+    def post_ids_in_heap(self, heap_id):
+        """Returns the post ids of the posts in the given heap, including the
+        deleted posts.
+
+        The returned object should not be modified.
+
+        **Argument:**
+
+        - `heap_id` (|HeapId|)
+
+        **Returns:** set(|PostId|)
+        """
+
+        self._recalc_field_indexes()
+        return self._heap_index.get(heap_id, frozenset())
+
+    def posts_with_tag(self, tag):
+        """Returns the non-deleted posts that have the given tag.
+
+        The posts are looked up in the tag index, so the posts of the database
+        are not scanned.
+
+        **Argument:**
+
+        - `tag` (|Tag|)
+
+        **Returns:** |PostSet|
+        """
+
+        return self._non_deleted_postset(self.post_ids_with_tag(tag))
+
+    def posts_by_author(self, author):
+        """Returns the non-deleted posts whose author is the given author
+        after normalization (see :func:`normalize_author`).
+
+        The posts are looked up in the author index, so the posts of the
+        database are not scanned.
+
+        **Argument:**
+
+        - `author` (str)
+
+        **Returns:** |PostSet|
+        """
+
+        return self._non_deleted_postset(self.post_ids_by_author(author))
+
+    def posts_in_heap(self, heap_id):
+        """Returns the non-deleted posts of the given heap.
+
+        The posts are looked up in the heap index, so the posts of the
+        database are not scanned.
+
+        **Argument:**
+
+        - `heap_id` (|HeapId|)
+
+        **Returns:** |PostSet|
+        """
+
+        return self._non_deleted_postset(self.post_ids_in_heap(heap_id))
+
+    # Date index
+
+    def _recalc_date_index(self):
+        """Recalculates the `_date_index`, `_undated_handles` and
+        `_date_index_keys` data attributes if needed.
+
+        Afterwards the index is updated only for the posts whose date changes
+        and for the posts that are added or removed.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._date_index is None:
+            self._date_index = []
+            self._undated_handles = set()
+            self._date_index_keys = {}
+            for post_id, post in self.post_id_to_post.iteritems():
+                handle = self._handles[post_id]
+                timestamp = post.timestamp()
+                if timestamp == 0:
+                    self._undated_handles.add(handle)
+                else:
+                    self._date_index.append((timestamp, handle))
+                self._date_index_keys[handle] = timestamp
+            self._date_index.sort()
+
+    def _update_date_index(self, post_id):
+        """Updates the date index after the post with the given post id was
+        changed, added or removed.
+
+        **Argument:**
+
+        - `post_id` (|PostId|)
+        """
+
+        if self._date_index is None:
+            return
+
+        handle = self._handles.get(post_id)
+        if handle is None:
+            return
+        post = self.post_id_to_post.get(post_id)
+        if post is None:
+            new_timestamp = None
+        else:
+            new_timestamp = post.timestamp()
+        old_timestamp = self._date_index_keys.get(handle)
+        if old_timestamp == new_timestamp:
+            return
+
+        if old_timestamp == 0:
+            self._undated_handles.remove(handle)
+        elif old_timestamp is not None:
+            index = self._date_index
+            del index[bisect.bisect_left(index, (old_timestamp, handle))]
+
+        if new_timestamp is None:
+            del self._date_index_keys[handle]
+        else:
+            if new_timestamp == 0:
+                self._undated_handles.add(handle)
+            else:
+                bisect.insort(self._date_index, (new_timestamp, handle))
+            self._date_index_keys[handle] = new_timestamp
+
+    def _date_boundary(self, dt):
+        """Finds the posts in the date index that are around the boundary
+        between the posts that predate `dt` and those that do not.
+
+        The dates of the posts are compared with `dt` only at the positions
+        visited by a binary search. Since the local time of the posts may not
+        grow monotonically with their timestamps, the posts whose timestamp
+        is close to the boundary (see `DATE_INDEX_MARGIN`) are not classified.
+
+        **Argument:**
+
+        - `dt` (datetime.datetime)
+
+        **Returns:** (int, int) -- Positions in `_date_index`: the posts before
+        the first position predate `dt`, the posts from the second position do
+        not predate `dt`; the posts between them have to be compared with
+        `dt` one by one.
+        """
+
+        index = self._date_index
+        handle_table = self._handle_table
+        lo = 0
+        hi = len(index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if handle_table[index[mid][1]].datetime() < dt:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            start = 0
+        else:
+            start = bisect.bisect_left(
+                        index, (index[lo - 1][0] - DATE_INDEX_MARGIN, -1))
+        if lo == len(index):
+            end = len(index)
+        else:
+            end = bisect.bisect_left(
+                      index, (index[lo][0] + DATE_INDEX_MARGIN + 1, -1))
+        return start, end
+
+    def _date_range_handles(self, dts=None, dte=None):
+        """Returns the handles of the posts whose date is between the given
+        dates.
+
+        **Arguments:**
+
+        - `dts` (datetime.datetime | ``None``) -- The posts that predate
+          `dts` are not returned. ``None`` means no lower bound.
+        - `dte` (datetime.datetime | ``None``) -- Only the posts that predate
+          `dte` are returned. ``None`` means no upper bound.
+
+        **Returns:** [int] -- The handles of the posts with a date in the
+        order of their timestamps.
+        """
+
+        self._recalc_date_index()
+        index = self._date_index
+        handle_table = self._handle_table
+
+        def in_range(handle):
+            dt = handle_table[handle].datetime()
+            return ((dts is None or dts <= dt) and
+                    (dte is None or dt < dte))
+
+        if dts is None:
+            lo_start = lo_end = 0
+        else:
+            lo_start, lo_end = self._date_boundary(dts)
+        if dte is None:
+            hi_start = hi_end = len(index)
+        else:
+            hi_start, hi_end = self._date_boundary(dte)
+
+        if lo_end <= hi_start:
+            return \
+                ([ handle for _, handle in index[lo_start:lo_end]
+                   if in_range(handle) ] +
+                 [ handle for _, handle in index[lo_end:hi_start] ] +
+                 [ handle for _, handle in index[hi_start:hi_end]
+                   if in_range(handle) ])
+        else:
+            return [ handle for _, handle in index[lo_start:hi_end]
+                     if in_range(handle) ]
+
+    def post_ids_in_date_range(self, dts=None, dte=None):
+        """Returns the post ids of the posts whose date is between the given
+        dates, including the deleted posts.
+
+        A post is returned if both ``post.after(dts)`` and
+        ``post.before(dte)`` would be true for it. The posts are looked up in
+        the date index, so the posts of the database are not scanned.
+
+        **Arguments:**
+
+        - `dts` (datetime.datetime | ``None``) -- The posts that predate
+          `dts` are not returned. ``None`` means no lower bound.
+        - `dte` (datetime.datetime | ``None``) -- Only the posts that predate
+          `dte` are returned. ``None`` means no upper bound.
+
+        **Returns:** [|PostId|] -- The post ids of the posts with a date in
+        the order of their timestamps.
+        """
+
+        handle_table = self._handle_table
+        return [ handle_table[handle].post_id()
+                 for handle in self._date_range_handles(dts, dte) ]
+
+    def undated_post_ids(self):
+        """Returns the post ids of the posts that do not have a date,
+        including the deleted posts.
+
+        **Returns:** [|PostId|]
+        """
+
+        self._recalc_date_index()
+        handle_table = self._handle_table
+        return [ handle_table[handle].post_id()
+                 for handle in self._undated_handles ]
+
+    def posts_in_date_range(self, dts=None, dte=None):
+        """Returns the non-deleted posts whose date is between the given
+        dates.
+
+        See :func:`post_ids_in_date_range`.
+
+        **Arguments:**
+
+        - `dts` (datetime.datetime | ``None``)
+        - `dte` (datetime.datetime | ``None``)
+
+        **Returns:** |PostSet|
+        """
+
+        return self._non_deleted_postset(self.post_ids_in_date_range(dts, dte))
+
+    def newest_posts(self, n):
+        """Returns the newest non-deleted posts that have a date.
+
+        The posts are taken from the end of the date index, so the posts of
+        the database are not sorted.
+
+        **Argument:**
+
+        - `n` (int) -- The maximum number of posts to return.
+
+        **Returns:** [|Post|] -- The posts, the newest first.
+        """
+
+        self._recalc_date_index()
+        result = []
+        for i in xrange(len(self._date_index) - 1, -1, -1):
+            if len(result) >= n:
+                break
+            post = self._handle_table[self._date_index[i][1]]
+            if not post.is_deleted():
+                result.append(post)
+        return result
+
+    def oldest_posts(self, n):
+        """Returns the oldest non-deleted posts that have a date.
+
+        The posts are taken from the beginning of the date index, so the
+        posts of the database are not sorted.
+
+        **Argument:**
+
+        - `n` (int) -- The maximum number of posts to return.
+
+        **Returns:** [|Post|] -- The posts, the oldest first.
+        """
+
+        self._recalc_date_index()
+        result = []
+        for _, handle in self._date_index:
+            if len(result) >= n:
+                break
+            post = self._handle_table[handle]
+            if not post.is_deleted():
+                result.append(post)
+        return result
+
+    def move(self, post, new_post_id, placeholder=False):
+        """Moves a post by changing its post id.
+
+        This method should be used with care.
+
+        **Arguments:**
+
+        - `post` (|Post|)
+        - `new_post_id` (|PrePostId|) -- The new post id of the post.
+        - `placeholder` (bool) -- If ``True``, a placeholder post will be
+          created with the original post id of `post`. The placeholder post
+          will be marked as deleted.
+        """
+
+        Post.assert_is_post_id(new_post_id)
+        new_post_id = Post.unify_post_id(new_post_id)
+        new_heap_id, new_post_index = new_post_id
+
+        if self.post(new_post_id) is not None:
+            raise hkutils.HkException, \
+                  ('The given post id is already occupied: %s' %
+                   (new_post_id,))
+
+        if not self.has_heap_id(new_heap_id):
+            raise hkutils.HkException, \
+                  ('No such heap: %s' % (new_heap_id,))
+
+        old_post_id = post.post_id()
+
+        def new_reference(source_post, old_post_ref, old_post_id, new_post_id):
+            """Returns how a post reference should change when a post's id is
+            renamed.
+
+            **Arguments:**
+
+            - `source_post` (|Post|) -- The post that contains the post
+              reference.
+            - `old_post_ref` (str) -- The post reference whose modification is
+              in question.
+            - `old_post_id` (|PostId|) -- The old post id of the post to be
+              renamed.
+            - `new_post_id` (|PostId|) -- The new post id of the post to be
+              renamed.
+
+            **Returns:** str | ``None`` -- If ``None`` is returned, the post
+            reference should not be changed. If a string is returned, it is the
+            new post reference that will be correct after the post was moved.
+            It is a prepost id; it has one of the following forms: either
+            ``"<post index>"`` or ``"<heap id>/<post index>"``.
+            """
+
+            old_heap_id, old_post_index = old_post_id
+            old_post_id_str = '%s/%s' % old_post_id
+            new_heap_id, new_post_index = new_post_id
+            new_post_id_str = '%s/%s' % new_post_id
+
+            # The reference is a full post id to the moving post
+            if old_post_ref == old_post_id_str:
+                return new_post_id_str
+
+            # The reference if a post index to the moving post
+            elif (old_post_ref == old_post_index and
+                  source_post.heap_id() == old_heap_id):
+
+                # The target post stays in the heap
+                if new_heap_id == old_heap_id:
+                    return new_post_index
+
+                # The target post moves to another heap, so we need to set the
+                # full post id
+                else:
+                    return new_post_id_str
+
+
+        # Only the posts that contain a reference to the moving post (which is
+        # either its post id or its post index) are examined
+        referring_post_ids = \
+            self._referring_post_ids(('%s/%s' % old_post_id, old_post_id[1]))
+        referring_posts = \
+            [ self.post_id_to_post[post_id]
+              for post_id in sorted(referring_post_ids) ]
+
+        for curr_post in referring_posts:
+
+            # Modifying the Parent header item if necessary
+            new_ref = new_reference(curr_post, curr_post.parent(),
+                                    old_post_id, new_post_id)
+            if new_ref is not None:
+                curr_post.set_parent(new_ref)
+
+            # Modifying the heap links if necessary
+            body_object = curr_post.body_object()
+            modified = False
+            for segment in body_object.segments:
+                if segment.type == 'heap_link':
+                    new_ref = \
+                        new_reference(curr_post, segment.get_prepost_id_str(),
+                                      old_post_id, new_post_id)
+                    if new_ref is not None:
+                        segment.set_prepost_id_str(new_ref)
+                        modified = True
+
+            if modified:
+                body_str = body_object.body_str()
+                curr_post.set_body(body_str)
+
+        # The body has to be read from the old place of the post
+        post.body()
+        post._body_offset = None
+
+        self.remove_post_from_dicts(post)
+        # The post keeps its handle, so the post bit sets that contain it
+        # remain valid; the old post id will get a new handle if it is used
+        # again
+        self._handles[new_post_id] = self._handles.pop(old_post_id)
+        post._post_id = new_post_id
+        post.touch()
+        self.add_post_to_dicts(post)
+
+        if placeholder:
+            placeholder_post = Post.create_empty(old_post_id, self)
+            placeholder_post.delete()
+            self.add_post_to_dicts(placeholder_post)
+
+        with self.batch():
+            self.touch(post)
+            if placeholder:
+                self.touch(placeholder_post)
+
+    # Filenames
+
+    def postfile_name(self, post):
+        """Returns the name of the file in which the post is (or should be)
+        stored.
+
+        For heaps stored in directories, it is ``<heap dir>/<post
+        index>.post``. See also :func:`HeapStorage.postfile_name`.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** str
+        """
+
+        return self.storage(post.heap_id()).postfile_name(post.post_index())
+
+    def html_dir(self):
+        """Return the directory in which the generator HTML files are stored.
+
+        **Returns:** str | ``None``
+        """
+
+        return self._html_dir
+
+    def cache_dir(self):
+        """Return the directory in which the heap snapshots are stored.
+
+        **Returns:** str | ``None``
+        """
+
+        return self._cache_dir
+
+    # Cache files
+
+    def cache_file_name(self, heap_id, extension):
+        """Returns the name of the file that stores cached data of the given
+        heap, which is ``<cache dir>/<heap id>.<extension>``.
+
+        **Arguments:**
+
+        - `heap_id` (|HeapId|)
+        - `extension` (str) -- The kind of the cached data (e.g.
+          ``'snapshot'``).
+
+        **Returns:** str | ``None`` -- ``None`` is returned if there is no
+        cache directory.
+        """
+
+        if self._cache_dir is None:
+            return None
+        else:
+            return os.path.join(self._cache_dir, heap_id + '.' + extension)
+
+    def read_cache_file(self, heap_id, extension, version):
+        """Reads a cache file of the given heap.
+
+        If the cache file does not exist, it is corrupt, or it was written for
+        another heap directory or with another version, ``None`` is returned.
+
+        **Arguments:**
+
+        - `heap_id` (|HeapId|)
+        - `extension` (str) -- The kind of the cached data.
+        - `version` (object) -- The version of the format of the cached data.
+
+        **Returns:** object | ``None``
+        """
+
+        filename = self.cache_file_name(heap_id, extension)
+        if filename is None or not os.path.exists(filename):
+            return None
+
+        # Catch "Exception" # pylint: disable=W0703
+        try:
+            with open(filename, 'rb') as f:
+                file_version, heap_dir, data = cPickle.load(f)
+        except Exception:
+            hkutils.log('Warning: corrupt %s file ignored: "%s"' %
+                        (extension, filename))
+            return None
+
+        if (file_version != version or
+            heap_dir != os.path.abspath(self._heaps[heap_id])):
+            return None
+        return data
+
+    def write_cache_file(self, heap_id, extension, version, data):
+        """Writes a cache file of the given heap.
+
+        The data is written into a temporary file first, which is renamed
+        afterwards, so an interrupted write cannot leave a truncated file
+        behind.
+
+        **Arguments:**
+
+        - `heap_id` (|HeapId|)
+        - `extension` (str) -- The kind of the cached data.
+        - `version` (object) -- The version of the format of the cached data.
+        - `data` (object) -- The data to be written. It has to be picklable.
+        """
+
+        filename = self.cache_file_name(heap_id, extension)
+        if filename is None:
+            return
+
+        heap_dir = os.path.abspath(self._heaps[heap_id])
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            cPickle.dump((version, heap_dir, data), f,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, filename)
+
+    # Snapshots
+
+    def snapshot_file_name(self, heap_id):
+        """Returns the name of the file that stores the snapshot of the given
+        heap, which is ``<cache dir>/<heap id>.snapshot``.
+
+        **Argument:**
+
+        - `heap_id` (|HeapId|)
+
+        **Returns:** str | ``None`` -- ``None`` is returned if there is no
+        cache directory.
+        """
+
+        return self.cache_file_name(heap_id, 'snapshot')
+
+    def read_snapshot(self, heap_id):
+        """Reads the snapshot of the given heap.
+
+        If the snapshot file does not exist, it is corrupt, or it was written
+        for another heap directory or by another version of Heapkeeper, an
+        empty snapshot is returned, which means that all post files will be
+        parsed.
+
+        **Argument:**
+
+        - `heap_id` (|HeapId|)
+
+        **Returns:** |Snapshot|
+        """
+
+        snapshot = self.read_cache_file(heap_id, 'snapshot', SNAPSHOT_VERSION)
+        return snapshot if snapshot is not None else {}
+
+    def write_snapshot(self, heap_id, snapshot):
+        """Writes the snapshot of the given heap.
+
+        **Arguments:**
+
+        - `heap_id` (|HeapId|)
+        - `snapshot` (|Snapshot|)
+        """
+
+        self.write_cache_file(heap_id, 'snapshot', SNAPSHOT_VERSION, snapshot)
+
+
+class PostItem(object):
+
+    """Represents a post when performing walk on posts.
+
+    Used for example by :func:`PostDB.walk_thread`. For information about what
+    exactly the values of the data attributes will be during a walk, please
+    read the documenation of the function that performs the walk.
+
+    The data attributes below are stored in slots. Other data attributes can
+    be also set on a post item (e.g. by the generators); the dictionary
+    holding them is created only when the first one is set.
+
+    **Data attributes:**
+
+    - `pos` (str) -- The position of the post item. Possible values:
+      ``'begin'``, ``'end'``, ``'inner'``, ``'flat'``.
+    - `post` (Post) -- The post represented by the post item.
+    - `level` (int) -- The level of the post.
+    """
+
+    __slots__ = ('pos', 'post', 'level', '__dict__')
+
+    def __init__(self, pos, post, level=0):
+        """Constructor.
+
+        **Arguments:**
+
+        - `pos` (str) -- Initializes the `pos` data attribute.
+        - `post` (Post) -- Initializes the `post` data attribute.
+        - `level` (int) -- Initializes the `level` data attribute.
+        """
+
+        assert(pos in ['begin', 'end', 'inner', 'flat'])
+        self.pos = pos
+        self.post = post
+        self.level = level
+
+    def copy(self):
+        """Creates a shallow copy of the post item.
+
+        **Returns:** |PostItem|
+        """
+
+        p = PostItem(pos=self.pos,
+                     post=self.post,
+                     level=self.level)
+        if self.__dict__:
+            p.__dict__ = self.__dict__.copy()
+        return p
+
+    def __str__(self):
+        """Returns the string representation of the PostItem.
+
+        **Returns:** str
+
+        **Example:** ``<PostItem: pos=begin, heapid='42', level=0>``
+        """
+
+        post_id = self.post.post_id()
+        if post_id is None:
+            post_id_str = 'None'
+        else:
+            post_id_str = "%s/%s" % post_id
+
+        s = ('<PostItem: pos=%s, post_id=%s, level=%d' %
+             (self.pos, post_id_str, self.level))
+
+        for attr, value in self.__dict__.items():
+            s += ', %s=%s' % (attr, value)
+
+        s += '>'
+        return s
+
+    def __eq__(self, other):
+        """Returns whether the post item is equal to another post item.
+
+        Two post items are considered equal if they have the same position,
+        level, etc. and point to the same post.
+
+        **Returns:** bool
+        """
+
+        return (self.pos == other.pos and
+                self.post == other.post and
+                self.level == other.level and
+                self.__dict__ == other.__dict__)
+
+
+##### PostSet #####
+
+class PostSet(set):
+
+    """A set of posts.
+
+    **Data attributes:**
+
+    - `_postdb` (|PostDB|) -- The post database.
+    """
+
+    def __init__(self, postdb, posts, default_heap=None):
+        """Constructor.
+
+        **Arguments:**
+
+        - `postdb` (| PostDB|) -- The post database.
+        - `posts` ( |PrePostSet|) -- The set of posts to be initially
+          contained.
         - `default_heap` (|HeapId| | ``None``) -- Default heap for `posts`.
         """
 
-        initpostset = PostSet._to_set(postdb, posts, default_heap)
-        super(PostSet, self).__init__(initpostset)
-        self._postdb = postdb
+        initpostset = PostSet._to_set(postdb, posts, default_heap)
+        super(PostSet, self).__init__(initpostset)
+        self._postdb = postdb
+
+    def empty_clone(self):
+        """Returns an empty post set that has the same post database as this
+        one.
+
+        **Returns:** |PostSet|
+        """
+
+        return PostSet(self._postdb, [])
+
+    def copy(self):
+        """Returns a copy of the post set.
+
+        The returned |PostSet| object will be different, but the posts
+        contained by it will be the same objects.
+
+        **Returns:** |PostSet|
+        """
+
+        return PostSet(self._postdb, self)
+
+    def postdb(self):
+        """Returns the post database of the post set.
+
+        **Returns:** |PostDB|
+        """
+
+        return self._postdb
+
+    @staticmethod
+    def _to_set(postdb, prepostset, default_heap=None):
+        """Converts a |PrePostSet| object to a set of posts.
+
+        **Arguments:**
+
+        - `prepostset` (|PrePostSet|) -- The PrePostSet to be converted.
+
+        **Returns:** set(|Post|) | PostSet
+        """
+
+        def is_prepost(prepost):
+            return (isinstance(prepost, str) or
+                    isinstance(prepost, int) or
+                    isinstance(prepost, tuple) or
+                    isinstance(prepost, Post))
+
+        if isinstance(prepostset, PostSet):
+            return prepostset
+        elif is_prepost(prepostset): # we have a prepost
+            return set([postdb.post(prepostset,
+                                    default_heap,
+                                    raise_exception=True)])
+        else: # we have a list of preposts
+            result = set()
+            for prepost in prepostset:
+                if prepost is None:
+                    continue
+                if is_prepost(prepost):
+                    result.add(postdb.post(prepost,
+                                           default_heap,
+                                           raise_exception=True))
+                else:
+                    raise hkutils.HkException, \
+                          ("Object type not compatible with Post: %s" % \
+                           (prepost,))
+            return result
+
+    def is_set(self, s):
+        """The given set equals to the set of contained posts.
+
+        **Arguments:**
+
+        - `s` (|PrePostSet|)
+
+        **Returns:** bool
+        """
+
+        return set.__eq__(self, PostSet._to_set(self._postdb, s))
 
-    def empty_clone(self):
-        """Returns an empty post set that has the same post database as this
-        one.
+    def __getattr__(self, funname):
+        """Returns delegates when `funname` is ``'forall'`` or ``'collect'``.
+
+        **Argument:**
+
+        - `funname` (str)
+
+        **Returns:** :class:`PostSetForallDelegate` |
+                     :class:`PostSetCollectDelegate`
+
+        **Raises:** AttributeError
+        """
+
+        if funname == 'forall':
+            return PostSetForallDelegate(self)
+        if funname == 'collect':
+            return PostSetCollectDelegate(self)
+        else:
+            raise AttributeError, \
+                  ("'PostSet' object has no attribute '%s'" % funname)
+
+    def expb(self):
+        """Expand backwards: returns all :ref:`ancestors <glossary_ancestor>`
+        of the posts in the post set.
 
         **Returns:** |PostSet|
         """
 
-        return PostSet(self._postdb, [])
+        result = PostSet(self._postdb, [])
+        for post in self:
+            # if a post is in result, then it has already been processed
+            # (and all its ancestors have been added to result)
+            while post is not None and post not in result:
+                result.add(post)
+                post = self._postdb.parent(post)
+        return result
 
-    def copy(self):
-        """Returns a copy of the post set.
+    def thread_roots(self):
+        """Returns the roots of the threads that contain the posts of the
+        post set.
 
-        The returned |PostSet| object will be different, but the posts
-        contained by it will be the same objects.
+        The result is the same as the result of
+        ``self.expb().collect.is_root()``, but it is calculated using
+        :func:`PostDB.root`.
 
         **Returns:** |PostSet|
         """
 
-        return PostSet(self._postdb, self)
+        result = PostSet(self._postdb, [])
+        for post in self:
+            root = self._postdb.root(post)
+            if root is not None:
+                result.add(root)
+        return result
 
-    @staticmethod
-    def _to_set(postdb, prepostset, default_heap=None):
-        """Converts a |PrePostSet| object to a set of posts.
+    def expf(self):
+        """Expand forward: returns all :ref:`descendants <glossary_descendant>`
+        of the posts in the post set.
+
+        **Returns:** |PostSet|
+        """
+
+        return PostSet(self._postdb, self._postdb._descendants(self))
+
+    def exp(self):
+        """Expand: returns all :ref:`thread mates <glossary_thread_mate>` of
+        the posts in the post set.
+
+        **Returns:** |PostSet|
+        """
+
+        return self.expb().expf()
+
+    def sorted_list(self):
+        """Returns the sorted list of posts in the post set.
+
+        The posts are sorted by :func:`Post.sort_key`.
+
+        **Returns:** [|Post|]
+        """
+
+        return sorted(self, key=Post.sort_key)
+
+    # Overriding set's methods
+
+    def construct(self, methodname, other):
+        """Constructs a new post set by calling the specified method of the set
+        class with `self` and `other`.
+
+        **Arguments:**
+
+        - `methodname` (str) -- A name of a method of the `set` class
+        - `other` (|PrePostSet|)
+
+        **Returns:** |PostSet|
+        """
+
+        try:
+            other = self._postdb.postset(other)
+        except TypeError:
+            return NotImplemented
+        result = getattr(set, methodname)(self, other)
+        result._postdb = self._postdb
+        return result
+
+    # TODO doc
+    def __and__(self, other):
+        return self.construct('__and__', other)
+
+    # TODO doc
+    def __eq__(self, other):
+        if isinstance(other, PostSet):
+            return set.__eq__(self, other)
+        else:
+            return False
+
+    # TODO doc
+    def __ne__(self, other):
+        return not self == other
+
+    # TODO doc
+    def __or__(self, other):
+        return self.construct('__or__', other)
+
+    # TODO doc
+    def __sub__(self, other):
+        return self.construct('__sub__', other)
+
+    # TODO doc
+    def __xor__(self, other):
+        return self.construct('__xor__', other)
+
+    # TODO doc
+    def difference(self, other):
+        return self.construct('difference', other)
+
+    # TODO doc
+    def intersection(self, other):
+        return self.construct('intersection', other)
+
+    # TODO doc
+    def symmetric_difference(self, other):
+        return self.construct('symmetric_difference', other)
+
+    # TODO doc
+    def union(self, other):
+        return self.construct('union', other)
+
+    # TODO doc
+    def __rand__(self, other):
+        return self.construct('__rand__', other)
+
+    # TODO doc
+    def __ror__(self, other):
+        return self.construct('__ror__', other)
+
+    # TODO doc
+    def __rsub__(self, other):
+        return self.construct('__rsub__', other)
+
+    # TODO doc
+    def __rxor__(self, other):
+        return self.construct('__rxor__', other)
+
+    # Methods inherited from set.
+    #
+    # These functions does not have to be overriden, because they do not
+    # construct a new PostSet object (as opposed to most of the overriden
+    # functions).
+    #
+    # __contains__(...)
+    # __iand__(...)
+    # __ior__(...)
+    # __isub__(...)
+    # __ixor__(...)
+    # __iter__(...)
+    # __len__(...)
+    # add(...)
+    # clear(...)
+    # difference_update(...)
+    # discard(...)
+    # intersection_update(...)
+    # issubset(...)
+    # issuperset(...)
+    # pop(...)
+    # remove(...)
+    # symmetric_difference_update(...)
+    # update(...)
+
+    #  Methods inherited from set which should not be used (yet?)
+    #
+    # TODO: These method should be reviewed whether they should be inherited,
+    # overriden or removed.
+    #
+    # __cmp__(...)
+    # __ge__(...)
+    # __getattribute__(...)
+    # __gt__(...)
+    # __hash__(...)
+    # __le__(...)
+    # __lt__(...)
+    # __reduce__(...)
+    # __repr__(...)
+
+
+class PostBitSet(object):
+
+    """A set of posts that stores the membership of the posts as a bitmap
+    over the handles of the posts in the post database.
+
+    The union, intersection and difference of post bit sets are bitwise
+    operations on integers, so they are much faster than those of |PostSet|
+    when large sets are combined. Post bit sets provide the same methods as
+    |PostSet| (e.g. `collect`, `forall`, :func:`exp`, :func:`sorted_list`),
+    and they can be combined with |PrePostSet| objects. They can contain only
+    posts that are in the post database.
+
+    **Data attributes:**
+
+    - `_postdb` (|PostDB|) -- The post database.
+    - `_bits` (long) -- The bit with index ``h`` is set if the post with
+      handle ``h`` is in the set. The bits of the posts that were removed from
+      the post database are ignored.
+    """
+
+    def __init__(self, postdb, posts, default_heap=None):
+        """Constructor.
+
+        **Arguments:**
+
+        - `postdb` (|PostDB|) -- The post database.
+        - `posts` (|PrePostSet|) -- The set of posts to be initially
+          contained.
+        - `default_heap` (|HeapId| | ``None``) -- Default heap for `posts`.
+        """
+
+        super(PostBitSet, self).__init__()
+        self._postdb = postdb
+        self._bits = self._to_bits(posts, default_heap)
+
+    def _handle(self, post):
+        """Returns the handle of a post.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** int
+
+        **Raises:**
+
+        - hkutils.HkException -- The post is not in the post database.
+        """
+
+        handle = self._postdb._handles.get(post.post_id())
+        if handle is None or self._postdb._handle_table[handle] is not post:
+            raise hkutils.HkException, \
+                  ('Post is not in the post database: %s' % (post,))
+        return handle
+
+    def _to_bits(self, prepostset, default_heap=None):
+        """Converts a |PrePostSet| object to a bitmap.
+
+        **Arguments:**
+
+        - `prepostset` (|PrePostSet|)
+        - `default_heap` (|HeapId| | ``None``)
+
+        **Returns:** long
+        """
+
+        if (isinstance(prepostset, PostBitSet) and
+            prepostset._postdb is self._postdb):
+            return prepostset._bits
+        bits = 0L
+        for post in PostSet._to_set(self._postdb, prepostset, default_heap):
+            bits |= 1L << self._handle(post)
+        return bits
+
+    def _from_bits(self, bits):
+        """Creates a post bit set with the given bitmap.
+
+        **Argument:**
+
+        - `bits` (long)
+
+        **Returns:** |PostBitSet|
+        """
+
+        result = PostBitSet(self._postdb, [])
+        result._bits = bits
+        return result
+
+    def empty_clone(self):
+        """Returns an empty post bit set that has the same post database as
+        this one.
+
+        **Returns:** |PostBitSet|
+        """
+
+        return PostBitSet(self._postdb, [])
+
+    def copy(self):
+        """Returns a copy of the post bit set.
+
+        **Returns:** |PostBitSet|
+        """
 
-        **Arguments:**
+        return self._from_bits(self._bits)
 
-        - `prepostset` (|PrePostSet|) -- The PrePostSet to be converted.
+    def postset(self):
+        """Returns a |PostSet| with the same posts.
 
-        **Returns:** set(|Post|) | PostSet
+        **Returns:** |PostSet|
         """
 
-        def is_prepost(prepost):
-            return (isinstance(prepost, str) or
-                    isinstance(prepost, int) or
-                    isinstance(prepost, tuple) or
-                    isinstance(prepost, Post))
-
-        if isinstance(prepostset, PostSet):
-            return prepostset
-        elif is_prepost(prepostset): # we have a prepost
-            return set([postdb.post(prepostset,
-                                    default_heap,
-                                    raise_exception=True)])
-        else: # we have a list of preposts
-            result = set()
-            for prepost in prepostset:
-                if prepost is None:
-                    continue
-                if is_prepost(prepost):
-                    result.add(postdb.post(prepost,
-                                           default_heap,
-                                           raise_exception=True))
-                else:
-                    raise hkutils.HkException, \
-                          ("Object type not compatible with Post: %s" % \
-                           (prepost,))
-            return result
+        return PostSet(self._postdb, list(self))
 
     def is_set(self, s):
         """The given set equals to the set of contained posts.
@@ -2695,7 +5872,7 @@ class PostSet(set):
         **Returns:** bool
         """
 
-        return set.__eq__(self, PostSet._to_set(self._postdb, s))
+        return self._bits == self._to_bits(s)
 
     def __getattr__(self, funname):
         """Returns delegates when `funname` is ``'forall'`` or ``'collect'``.
@@ -2716,182 +5893,261 @@ class PostSet(set):
             return PostSetCollectDelegate(self)
         else:
             raise AttributeError, \
-                  ("'PostSet' object has no attribute '%s'" % funname)
+                  ("'PostBitSet' object has no attribute '%s'" % funname)
+
+    # Thread operations
 
     def expb(self):
         """Expand backwards: returns all :ref:`ancestors <glossary_ancestor>`
         of the posts in the post set.
 
-        **Returns:** |PostSet|
+        **Returns:** |PostBitSet|
         """
 
-        result = PostSet(self._postdb, [])
-        for post in self:
-            # if post is in result, then it has already been processed
-            # (and all its consequences has been added to result)
-            if post not in result:
-                while True:
-                    result.add(post)
-                    post = self._postdb.parent(post)
-                    if post == None:
-                        break
-        return result
+        return PostBitSet(self._postdb, PostSet(self._postdb, self).expb())
 
     def expf(self):
-        """Expand forward: returns all :ref:`descendants <glossary_descendant>`
-        of the posts in the post set.
+        """Expand forward: returns all :ref:`descendants
+        <glossary_descendant>` of the posts in the post set.
 
-        **Returns:** |PostSet|
+        **Returns:** |PostBitSet|
         """
 
-        result = PostSet(self._postdb, [])
-        for post in self:
-            # if post is in result, then it has already been processed
-            # (and all its consequences has been added to result)
-            if post not in result:
-                for post2 in self._postdb.iter_thread(post):
-                    result.add(post2)
-        return result
+        return PostBitSet(self._postdb, self._postdb._descendants(self))
 
     def exp(self):
         """Expand: returns all :ref:`thread mates <glossary_thread_mate>` of
         the posts in the post set.
 
-        **Returns:** |PostSet|
+        **Returns:** |PostBitSet|
         """
 
         return self.expb().expf()
 
+    def thread_roots(self):
+        """Returns the roots of the threads that contain the posts of the
+        post set.
+
+        **Returns:** |PostBitSet|
+        """
+
+        return PostBitSet(self._postdb,
+                          PostSet(self._postdb, self).thread_roots())
+
     def sorted_list(self):
         """Returns the sorted list of posts in the post set.
 
+        The posts are sorted by :func:`Post.sort_key`.
+
         **Returns:** [|Post|]
         """
 
-        posts = list(self)
-        posts.sort()
-        return posts
+        return sorted(self, key=Post.sort_key)
 
-    # Overriding set's methods
+    # Set operations
 
-    def construct(self, methodname, other):
-        """Constructs a new post set by calling the specified method of the set
-        class with `self` and `other`.
+    def __iter__(self):
+        """Iterates over the posts of the post bit set.
 
-        **Arguments:**
+        The posts are yielded in the order of their handles.
 
-        - `methodname` (str) -- A name of a method of the `set` class
-        - `other` (|PrePostSet|)
+        **Returns:** iterable(|Post|)
+        """
 
-        **Returns:** |PostSet|
+        handle_table = self._postdb._handle_table
+        # The hexadecimal representation is processed from the lowest digit,
+        # so that the bitmap is not shifted for each post
+        hex_str = '%x' % (self._bits,)
+        last = len(hex_str) - 1
+        for i in xrange(last, -1, -1):
+            digit = int(hex_str[i], 16)
+            if digit != 0:
+                base = (last - i) * 4
+                for bit in xrange(4):
+                    if digit & (1 << bit):
+                        post = handle_table[base + bit]
+                        if post is not None:
+                            yield post
+
+    def __len__(self):
+        """Returns the number of posts in the post bit set.
+
+        **Returns:** int
         """
 
-        try:
-            other = self._postdb.postset(other)
-        except TypeError:
-            return NotImplemented
-        result = getattr(set, methodname)(self, other)
-        result._postdb = self._postdb
-        return result
+        return bin(self._bits & ~self._postdb._removed_handles).count('1')
 
-    # TODO doc
-    def __and__(self, other):
-        return self.construct('__and__', other)
+    def __nonzero__(self):
+        """Returns whether the post bit set is not empty.
 
-    # TODO doc
-    def __eq__(self, other):
-        if isinstance(other, PostSet):
-            return set.__eq__(self, other)
-        else:
+        **Returns:** bool
+        """
+
+        return (self._bits & ~self._postdb._removed_handles) != 0
+
+    def __contains__(self, post):
+        """Returns whether the post bit set contains the given post.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** bool
+        """
+
+        if not isinstance(post, Post):
             return False
+        handle = self._postdb._handles.get(post.post_id())
+        return (handle is not None and
+                self._postdb._handle_table[handle] is post and
+                (self._bits >> handle) & 1 == 1)
 
-    # TODO doc
-    def __ne__(self, other):
-        return not self == other
+    def add(self, post):
+        """Adds a post to the post bit set.
+
+        **Argument:**
+
+        - `post` (|Post|)
+        """
+
+        self._bits |= 1L << self._handle(post)
+
+    def discard(self, post):
+        """Removes a post from the post bit set if it is present.
+
+        **Argument:**
+
+        - `post` (|Post|)
+        """
+
+        if post in self:
+            self._bits &= ~(1L << self._handle(post))
+
+    def remove(self, post):
+        """Removes a post from the post bit set.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Raises:** KeyError -- The post is not in the post bit set.
+        """
+
+        if post not in self:
+            raise KeyError(post)
+        self.discard(post)
+
+    def update(self, other):
+        """Adds the given posts to the post bit set.
+
+        **Argument:**
+
+        - `other` (|PrePostSet|)
+        """
+
+        self._bits |= self._to_bits(other)
+
+    def __and__(self, other):
+        """Returns the intersection of the post bit set and `other`.
+
+        **Argument:**
+
+        - `other` (|PrePostSet|)
+
+        **Returns:** |PostBitSet|
+        """
+
+        return self._from_bits(self._bits & self._to_bits(other))
 
-    # TODO doc
     def __or__(self, other):
-        return self.construct('__or__', other)
+        """Returns the union of the post bit set and `other`.
+
+        **Argument:**
+
+        - `other` (|PrePostSet|)
+
+        **Returns:** |PostBitSet|
+        """
+
+        return self._from_bits(self._bits | self._to_bits(other))
 
-    # TODO doc
     def __sub__(self, other):
-        return self.construct('__sub__', other)
+        """Returns the posts of the post bit set that are not in `other`.
 
-    # TODO doc
-    def __xor__(self, other):
-        return self.construct('__xor__', other)
+        **Argument:**
 
-    # TODO doc
-    def difference(self, other):
-        return self.construct('difference', other)
+        - `other` (|PrePostSet|)
 
-    # TODO doc
-    def intersection(self, other):
-        return self.construct('intersection', other)
+        **Returns:** |PostBitSet|
+        """
 
-    # TODO doc
-    def symmetric_difference(self, other):
-        return self.construct('symmetric_difference', other)
+        return self._from_bits(self._bits & ~self._to_bits(other))
 
-    # TODO doc
-    def union(self, other):
-        return self.construct('union', other)
+    def __xor__(self, other):
+        """Returns the symmetric difference of the post bit set and
+        `other`.
 
-    # TODO doc
-    def __rand__(self, other):
-        return self.construct('__rand__', other)
+        **Argument:**
 
-    # TODO doc
-    def __ror__(self, other):
-        return self.construct('__ror__', other)
+        - `other` (|PrePostSet|)
+
+        **Returns:** |PostBitSet|
+        """
+
+        return self._from_bits(self._bits ^ self._to_bits(other))
 
-    # TODO doc
     def __rsub__(self, other):
-        return self.construct('__rsub__', other)
+        """Returns the posts of `other` that are not in the post bit set.
 
-    # TODO doc
-    def __rxor__(self, other):
-        return self.construct('__rxor__', other)
+        **Argument:**
 
-    # Methods inherited from set.
-    #
-    # These functions does not have to be overriden, because they do not
-    # construct a new PostSet object (as opposed to most of the overriden
-    # functions).
-    #
-    # __contains__(...)
-    # __iand__(...)
-    # __ior__(...)
-    # __isub__(...)
-    # __ixor__(...)
-    # __iter__(...)
-    # __len__(...)
-    # add(...)
-    # clear(...)
-    # difference_update(...)
-    # discard(...)
-    # intersection_update(...)
-    # issubset(...)
-    # issuperset(...)
-    # pop(...)
-    # remove(...)
-    # symmetric_difference_update(...)
-    # update(...)
+        - `other` (|PrePostSet|)
 
-    #  Methods inherited from set which should not be used (yet?)
-    #
-    # TODO: These method should be reviewed whether they should be inherited,
-    # overriden or removed.
-    #
-    # __cmp__(...)
-    # __ge__(...)
-    # __getattribute__(...)
-    # __gt__(...)
-    # __hash__(...)
-    # __le__(...)
-    # __lt__(...)
-    # __reduce__(...)
-    # __repr__(...)
+        **Returns:** |PostBitSet|
+        """
+
+        return self._from_bits(self._to_bits(other) & ~self._bits)
+
+    __rand__ = __and__
+    __ror__ = __or__
+    __rxor__ = __xor__
+    intersection = __and__
+    union = __or__
+    difference = __sub__
+    symmetric_difference = __xor__
+
+    def __eq__(self, other):
+        """Returns whether the post bit set contains the same posts as
+        `other`.
+
+        **Argument:**
+
+        - `other` (|PostBitSet| | |PostSet|)
+
+        **Returns:** bool
+        """
+
+        if isinstance(other, (PostBitSet, PostSet)):
+            return self._bits == self._to_bits(other)
+        else:
+            return False
+
+    def __ne__(self, other):
+        """Returns whether the post bit set does not contain the same posts
+        as `other`.
+
+        **Returns:** bool
+        """
+
+        return not self == other
+
+    def __repr__(self):
+        """Returns the string representation of the post bit set.
+
+        **Returns:** str
+        """
+
+        return 'PostBitSet(%r)' % (list(self),)
 
 
 class PostSetForallDelegate(object):
@@ -3017,7 +6273,30 @@ class PostSetCollectDelegate(object):
 
     def is_root(self):
         """Returns the posts that are roots of a thread."""
-        return self.__call__(lambda p: self._postset._postdb.parent(p) == None)
+        postdb = self._postset._postdb
+        return self.__call__(lambda p: postdb.root(p) is p)
+
+    def has_tag(self, tag):
+        """Returns the posts that have the given tag.
+
+        The posts are looked up in the tag index of the post database.
+
+        **Argument:**
+
+        - `tag` (|Tag|)
+
+        **Returns:** |PostSet|
+        """
+
+        assert(isinstance(tag, str))
+        postset = self._postset
+        post_id_to_post = postset._postdb.post_id_to_post
+        result = postset.empty_clone()
+        for post_id in postset._postdb.post_ids_with_tag(tag):
+            post = post_id_to_post[post_id]
+            if post in postset:
+                result.add(post)
+        return result
 
     def __getattr__(self, funname):
         """Returns a function that collects posts whose return value is true
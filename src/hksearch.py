@@ -15,12 +15,49 @@
 
 # Copyright (C) 2010 Csaba Hoch
 
-"""|hksearch| searches in the post database."""
+"""|hksearch| searches in the post database.
 
+Pseudo-types
+''''''''''''
 
+|hksearch| has pseudo-types that are not real Python types, but we use them as
+types in the documentation so we can talk about them easily.
+
+.. _hksearch_IndexField:
+
+- **IndexField** -- A field of the posts that is indexed by |SearchIndex|.
+  Possible values: ``'author'``, ``'subject'``, ``'tags'``, ``'body'``.
+
+  Real type: str
+
+.. _hksearch_TargetCompiler:
+
+- **TargetCompiler** -- A function that prepares a |Target| for matching posts
+  (e.g. compiles its pattern) and returns the function that decides whether a
+  post matches the target. It is called only once for each target of a
+  |Query|.
+
+  Real type: fun(|Target|) -> fun(|Post|) -> bool
+"""
+
+
+import array
+import atexit
+import datetime
+import heapq
+import math
+import mmap
+import multiprocessing
+import os
 import re
+import sre_constants
+import sre_parse
+import struct
+import tempfile
+import time
 
 import hkutils
+import hklib
 
 
 ##### Regular expressions #####
@@ -76,17 +113,45 @@ def whole_target_matches(post, pattern):
     **Returns:** bool
     """
 
-    fields = \
-        (post.author(),
+    return matches_any(pattern, whole_target_strings(post))
+
+def whole_target_strings(post):
+    """Returns the strings searched by :func:`whole_target_matches`.
+
+    **Argument:**
+
+    - `post` (|Post|)
+
+    **Returns:** [str]
+    """
+
+    strings = \
+        [post.author(),
          post.subject(),
          post.messid(),
          post.date_str(),
          post.parent(),
          post.post_id_str(),
-         post.body())
+         post.body()]
+    strings.extend(post.tags())
+    return strings
+
+def unindexed_whole_fields(post):
+    """Returns the fields searched by :func:`whole_target_matches` that are
+    not indexed by |SearchIndex|.
+
+    **Argument:**
+
+    - `post` (|Post|)
+
+    **Returns:** (str)
+    """
+
     return \
-        (matches_any(pattern, fields) or
-         matches_any(pattern, post.tags()))
+        (post.messid(),
+         post.date_str(),
+         post.parent(),
+         post.post_id_str())
 
 def date_match(target_type, post, pattern):
     """Returns whether the post matches the given date.
@@ -111,6 +176,24 @@ def date_match(target_type, post, pattern):
         msg = 'Incorrect date: %s\n%s' % (repr(pattern), str(e))
         raise hkutils.HkException(msg)
 
+def parse_target_date(pattern):
+    """Parses the pattern of a 'before' or 'after' target.
+
+    **Argument:**
+
+    - `pattern` (str): The description of the date as described in
+      :func:`hkutils.parse_date`.
+
+    **Returns:** datetime.datetime
+    """
+
+    dt_args = hkutils.parse_date(pattern)
+    try:
+        return datetime.datetime(*dt_args)
+    except Exception, e:
+        msg = 'Incorrect date: %s\n%s' % (repr(pattern), str(e))
+        raise hkutils.HkException(msg)
+
 target_types = \
     {'whole': whole_target_matches,
      'heap': lambda post, pattern: matches(pattern, post.heap_id()),
@@ -123,7 +206,107 @@ target_types = \
      'before': lambda post, pattern: date_match('before', post, pattern),
      'after': lambda post, pattern: date_match('after', post, pattern)}
 
-def add_target_type(name, fun):
+# The target types defined by hksearch
+builtin_target_types = dict(target_types)
+
+def regexp_target_compiler(get_strings):
+    """Returns a target compiler that compiles the pattern of the target as a
+    regular expression and matches it against the given strings of the posts.
+
+    The compiled regular expression is stored in the `regexp` data attribute
+    of the target.
+
+    **Argument:**
+
+    - `get_strings` (fun(|Post|) -> iterable(str)) -- Returns the strings of
+      a post in which the pattern is searched.
+
+    **Returns:** |TargetCompiler|
+    """
+
+    def compile_target(target):
+        target.regexp = re.compile(target.pattern, regexp_options)
+        search = target.regexp.search
+        def target_matches(post):
+            for s in get_strings(post):
+                if search(s):
+                    return True
+            return False
+        return target_matches
+    return compile_target
+
+def date_target_compiler(target_type):
+    """Returns a target compiler that parses the pattern of the target as a
+    date and compares the date of the posts with it.
+
+    The posts are compared in the same way as by :func:`hklib.Post.before`
+    and :func:`hklib.Post.after`. The parsed date is stored in the `datetime`
+    data attribute of the target.
+
+    **Argument:**
+
+    - `target_type` (str): Either 'before' or 'after'.
+
+    **Returns:** |TargetCompiler|
+    """
+
+    def compile_target(target):
+        dt = parse_target_date(target.pattern)
+        target.datetime = dt
+        if target_type == 'before':
+            def target_matches(post):
+                post_dt = post.datetime()
+                return post_dt is not None and post_dt < dt
+        else:
+            def target_matches(post):
+                post_dt = post.datetime()
+                return post_dt is None or dt <= post_dt
+        return target_matches
+    return compile_target
+
+target_compilers = \
+    {'whole': regexp_target_compiler(whole_target_strings),
+     'heap': regexp_target_compiler(lambda post: (post.heap_id(),)),
+     'postid': regexp_target_compiler(lambda post: (post.post_id_str(),)),
+     'author': regexp_target_compiler(lambda post: (post.author(),)),
+     'subject': regexp_target_compiler(lambda post: (post.subject(),)),
+     'tag': regexp_target_compiler(lambda post: post.tags()),
+     'message-id': regexp_target_compiler(lambda post: (post.messid(),)),
+     'body': regexp_target_compiler(lambda post: (post.body(),)),
+     'before': date_target_compiler('before'),
+     'after': date_target_compiler('after')}
+
+# The target compilers defined by hksearch
+builtin_target_compilers = dict(target_compilers)
+
+# The estimated cost of matching a post against a target of a target type,
+# relative to the other target types
+target_costs = \
+    {'whole': 30,
+     'heap': 1,
+     'postid': 1,
+     'author': 2,
+     'subject': 3,
+     'tag': 2,
+     'message-id': 2,
+     'body': 20,
+     'before': 1,
+     'after': 1}
+
+# The estimated cost of the target types that are not in `target_costs`
+default_target_cost = 10
+
+# The candidates of the targets (see `Target.candidates`) are looked up in the
+# whole post database, so `QueryPlan` looks them up only if the searched post
+# set contains at least this fraction of the posts of the post database
+CANDIDATE_LOOKUP_MIN_RATIO = 0.1
+
+# Increased each time a target type is added by `add_target_type`, so that
+# the queries compiled with the old target types are not reused by
+# |QueryCache|
+target_types_version = 0
+
+def add_target_type(name, fun, compiler=None, cost=None):
     """Adds a new target type.
 
     **Arguments:**
@@ -131,79 +314,1929 @@ def add_target_type(name, fun):
     - `name` (str) -- The name of the target type.
     - `fun` (fun(|Post|, str) -> bool) -- The function that decides whether a
       post matches a pattern.
+    - `compiler` (|TargetCompiler| | ``None``) -- The function used by |Query|
+      to prepare the targets of this type. If ``None``, `fun` will be called
+      with the pattern of the target for each post.
+    - `cost` (int | ``None``) -- The estimated cost of matching a post against
+      a target of this type (see `target_costs`). If ``None``,
+      `default_target_cost` is used.
     """
 
+    global target_types_version
+    target_types_version += 1
     target_types[name] = fun
+    if compiler is None:
+        target_compilers.pop(name, None)
+    else:
+        target_compilers[name] = compiler
+    if cost is None:
+        target_costs.pop(name, None)
+    else:
+        target_costs[name] = cost
 
 
-##### search #####
+##### Search index #####
 
-def search(term, postset):
-    """Returns a subset of the given post set that satisfies all search targets
-    in the given search term.
+SEARCH_INDEX_VERSION = 2
+
+# The strings in the indexed fields of a post
+index_fields = \
+    {'author': lambda post: (post.author(),),
+     'subject': lambda post: (post.subject(),),
+     'tags': lambda post: post.tags(),
+     'body': lambda post: (post.body(),)}
+
+# The indexed fields in which the built-in target types search (the author and
+# tag targets are looked up in the indexes of the post database instead)
+indexed_target_types = \
+    {'whole': ('author', 'subject', 'tags', 'body'),
+     'subject': ('subject',),
+     'body': ('body',)}
+
+# The indexed fields whose trigrams are also indexed
+trigram_fields = ('subject', 'body')
+
+# The fields in which the built-in target types search whose trigrams are
+# indexed
+trigram_target_types = \
+    {'whole': ('subject', 'body'),
+     'subject': ('subject',),
+     'body': ('body',)}
+
+token_regexp = re.compile('[a-z0-9_]+')
+plain_word_regexp = re.compile('[A-Za-z0-9_]+\\Z')
+
+def tokenize(strings):
+    """Returns the tokens of the given strings.
+
+    A token is a maximal sequence of ASCII letters, digits and underscores,
+    converted to lower case.
+
+    **Argument:**
+
+    - `strings` (iterable(str))
+
+    **Returns:** frozenset(str)
+    """
+
+    return frozenset(token_regexp.findall(' '.join(strings).lower()))
+
+def is_plain_word(pattern):
+    """Returns whether the pattern consists only of ASCII letters, digits and
+    underscores, so it can be looked up in the search index.
+
+    Such a pattern can match a string only inside one of its tokens.
+
+    **Argument:**
+
+    - `pattern` (str)
+
+    **Returns:** bool
+    """
+
+    return plain_word_regexp.match(pattern) is not None
+
+def trigrams(strings):
+    """Returns the trigrams of the given strings.
+
+    A trigram is a sequence of three consecutive characters of one of the
+    strings, converted to lower case.
+
+    **Argument:**
+
+    - `strings` (iterable(str))
+
+    **Returns:** frozenset(str)
+    """
+
+    result = set()
+    for s in strings:
+        s = s.lower()
+        result.update([s[i:i + 3] for i in xrange(len(s) - 2)])
+    return frozenset(result)
+
+def required_literals(parsed_pattern, literals):
+    """Collects literal strings that are contained by every string that
+    matches a parsed regular expression.
+
+    Only ASCII characters are collected, converted to lower case, so that the
+    literals are contained by the matching strings even when case is ignored.
+    Alternatives and optional parts of the regular expression are skipped.
 
     **Arguments:**
 
-    - `term` (str)
-    - `postset` (|PostSet|)
+    - `parsed_pattern` (sre_parse.SubPattern) -- A regular expression parsed
+      by :func:`sre_parse.parse`.
+    - `literals` ([str]) -- The literals are appended to this list.
+    """
 
-    **Returns:** |PostSet|
+    run = []
+    for op, av in parsed_pattern:
+        if op == sre_constants.LITERAL and av < 128:
+            run.append(chr(av).lower())
+            continue
+        literals.append(''.join(run))
+        run = []
+        if op == sre_constants.SUBPATTERN:
+            required_literals(av[1], literals)
+        elif (op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and
+              av[0] >= 1):
+            required_literals(av[2], literals)
+    literals.append(''.join(run))
+
+def required_trigrams(pattern, flags=regexp_options):
+    """Returns trigrams that are contained by every string that matches a
+    regular expression.
+
+    **Arguments:**
+
+    - `pattern` (str) -- A regular expression.
+    - `flags` (int) -- The flags with which the regular expression is used.
+
+    **Returns:** frozenset(str) -- The trigrams are in lower case. An empty
+    set is returned if no trigram is found or the regular expression is
+    invalid.
     """
 
-    # StrTarget examples: 'cont.*ent', 'heap:myheap'
-    # Target examples: ('regexp', 'cont.*ent'), ('heap', 'myheap')
+    try:
+        parsed_pattern = sre_parse.parse(pattern, flags)
+    except sre_constants.error:
+        return frozenset()
+    literals = []
+    required_literals(parsed_pattern, literals)
+    return trigrams(literals)
 
-    str_targets = term.split() # [StrTarget]
-    targets = [] # [Target]
-    for str_target in str_targets:
-        new_target_type = None
-        new_pattern = None
 
-        # If str_target has the form of "<target_type>:<str>", then we will put
-        # (<target_type>, <regexp for str>) into `new_target`
-        for target_type in target_types.keys():
-            if str_target.startswith(target_type + ':'):
-                # We found the target type of the current target
-                new_target_type = target_type
-                new_pattern = str_target[(len(target_type) + 1):]
-                break
+class SearchIndex(object):
 
-        # Otherwise the target should be searched in the whole post
-        if new_target_type is None:
-            new_target_type = 'whole'
-            new_pattern = str_target
+    """A token and trigram index of the posts of a post database.
 
-        # If the pattern starts with a '-' sign, the effect of the search
-        # should be negated (i.e. posts that don't match the pattern should
-        # be found)
-        if new_pattern.startswith('-'):
-            new_pattern = new_pattern[1:]
-            new_is_positive = False
-        else:
-            new_is_positive = True
+    The index assigns the posts to the tokens that occur in their indexed
+    fields (see |IndexField|), and to the trigrams that occur in the fields
+    listed in `trigram_fields`. The tokens and trigrams of a post are
+    calculated again when the post is touched; when the whole post database is
+    touched, the index is rebuilt when it is used next time.
+
+    When the index is rebuilt, the tokens and trigrams of the posts that have
+    not changed since the index was saved are read from the cache directory of
+    the post database (``<cache dir>/<heap id>.index``), so that the bodies of
+    those posts do not have to be read and tokenized.
+
+    **Implements:** |PostDBEventListener|
+
+    **Data attributes:**
+
+    - `_postdb` (|PostDB|) -- The post database.
+    - `_postings` ({|IndexField|: {str: set(|PostId|)}} | ``None``) --
+      Assigns the post ids of the posts that contain the token to each token
+      of each field. ``None`` if the index should be rebuilt.
+    - `_post_tokens` ({|PostId|: {|IndexField|: frozenset(str)}} | ``None``)
+      -- The tokens of the indexed posts. It is calculated together with
+      `_postings`.
+    - `_trigram_postings` ({|IndexField|: {str: set(|PostId|)}} | ``None``)
+      -- Assigns the post ids of the posts that contain the trigram to each
+      trigram of each field in `trigram_fields`. It is calculated together
+      with `_postings`.
+    - `_post_trigrams` ({|PostId|: {|IndexField|: frozenset(str)}} |
+      ``None``) -- The trigrams of the indexed posts. It is calculated
+      together with `_postings`.
+    - `_token_trigrams` ({|IndexField|: {str: set(str)}} | ``None``) --
+      Assigns the tokens of `_postings` that contain the trigram to each
+      trigram of each field, so that the tokens that contain a word can be
+      found without walking all tokens. It is calculated together with
+      `_postings`.
+    - `_indexed_posts` ({|PostId|: |Post|} | ``None``) -- The indexed posts.
+      It is calculated together with `_postings`.
+    - `_indexed_post_ids` ({|Post|: |PostId|} | ``None``) -- The post ids by
+      which the posts were indexed, so that a moved post can be removed from
+      the index by its old post id. It is calculated together with
+      `_postings`.
+    """
+
+    def __init__(self, postdb):
+        """Constructor.
+
+        The index subscribes to the events of the post database.
+
+        **Argument:**
+
+        - `postdb` (|PostDB|)
+        """
+
+        super(SearchIndex, self).__init__()
+        self._postdb = postdb
+        self._postings = None
+        self._post_tokens = None
+        self._trigram_postings = None
+        self._post_trigrams = None
+        self._token_trigrams = None
+        self._indexed_posts = None
+        self._indexed_post_ids = None
+        postdb.listeners.append(self)
+
+    def close(self):
+        """Unsubscribes from the events of the post database."""
 
-        targets.append((new_target_type, new_pattern, new_is_positive))
+        self._postdb.listeners.remove(self)
 
-    def post_matches_any(post):
-        """Returns whether the given post matches any regexp in the `targets`
-        list.
+    def __call__(self, e):
+        """The event handler method.
+
+        **Argument:**
+
+        - `e` (|PostDBEvent|)
+        """
+
+        if not isinstance(e, hklib.PostDBEvent):
+            pass
+        elif e.type == 'touch_all':
+            self._postings = None
+            self._post_tokens = None
+            self._trigram_postings = None
+            self._post_trigrams = None
+            self._token_trigrams = None
+            self._indexed_posts = None
+            self._indexed_post_ids = None
+        elif e.type == 'touch':
+            self._update_post(e.post, e.fields)
+        elif e.type == 'batch_touch':
+            for post in e.posts:
+                self._update_post(post, e.fields)
+
+    def _post_field_tokens(self, post):
+        """Returns the tokens of the indexed fields of a post.
 
         **Argument:**
 
         - `post` (|Post|)
 
-        **Returns:** bool
+        **Returns:** {|IndexField|: frozenset(str)}
         """
 
-        for (target_type, pattern, positive) in targets:
-            matches = target_types[target_type](post, pattern)
+        return dict((field, tokenize(get_strings(post)))
+                    for field, get_strings in index_fields.iteritems())
 
-            # (matches != positive) <=>
-            # (matches and not positive) or (not matches and positive) =>
-            # this post should not be in the search result
-            if matches != positive:
-                return False
+    def _post_field_trigrams(self, post):
+        """Returns the trigrams of the fields of a post that are listed in
+        `trigram_fields`.
 
-        return True
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** {|IndexField|: frozenset(str)}
+        """
+
+        return dict((field, trigrams(index_fields[field](post)))
+                    for field in trigram_fields)
+
+    def _add_post(self, post, post_id, field_tokens, field_trigrams):
+        """Adds a post to the index.
+
+        **Arguments:**
+
+        - `post` (|Post|)
+        - `post_id` (|PostId|) -- The post id of `post`.
+        - `field_tokens` ({|IndexField|: frozenset(str)})
+        - `field_trigrams` ({|IndexField|: frozenset(str)})
+        """
+
+        for field, tokens in field_tokens.iteritems():
+            postings = self._postings[field]
+            token_trigrams = self._token_trigrams[field]
+            for token in tokens:
+                post_ids = postings.get(token)
+                if post_ids is None:
+                    post_ids = postings[token] = set()
+                    for trigram in trigrams([token]):
+                        token_trigrams.setdefault(trigram, set()).add(token)
+                post_ids.add(post_id)
+        for field, keys in field_trigrams.iteritems():
+            postings = self._trigram_postings[field]
+            for key in keys:
+                postings.setdefault(key, set()).add(post_id)
+        self._post_tokens[post_id] = field_tokens
+        self._post_trigrams[post_id] = field_trigrams
+        self._indexed_posts[post_id] = post
+        self._indexed_post_ids[post] = post_id
+
+    def _remove_post(self, post_id):
+        """Removes a post from the index if it is there.
+
+        **Argument:**
+
+        - `post_id` (|PostId|)
+        """
+
+        field_tokens = self._post_tokens.pop(post_id, None)
+        if field_tokens is None:
+            return
+        field_trigrams = self._post_trigrams.pop(post_id)
+        post = self._indexed_posts.pop(post_id)
+        if self._indexed_post_ids.get(post) == post_id:
+            del self._indexed_post_ids[post]
+
+        for field, tokens in field_tokens.iteritems():
+            postings = self._postings[field]
+            token_trigrams = self._token_trigrams[field]
+            for token in tokens:
+                post_ids = postings[token]
+                post_ids.discard(post_id)
+                if len(post_ids) == 0:
+                    del postings[token]
+                    for trigram in trigrams([token]):
+                        tokens_with_trigram = token_trigrams[trigram]
+                        tokens_with_trigram.discard(token)
+                        if len(tokens_with_trigram) == 0:
+                            del token_trigrams[trigram]
+        for field, keys in field_trigrams.iteritems():
+            postings = self._trigram_postings[field]
+            for key in keys:
+                post_ids = postings[key]
+                post_ids.discard(post_id)
+                if len(post_ids) == 0:
+                    del postings[key]
+
+    def _update_post(self, post, fields=None):
+        """Updates the tokens and trigrams of a post after it was touched.
+
+        **Arguments:**
+
+        - `post` (|Post|)
+        - `fields` (frozenset(|PostField|) | ``None``) -- The modified fields
+          of the post. ``None`` means that any field may have been modified.
+        """
+
+        if self._postings is None:
+            return
+        post_id = post.post_id()
+        old_post_id = self._indexed_post_ids.get(post)
+        if (fields is not None and fields.isdisjoint(index_fields) and
+            old_post_id == post_id):
+            return
+        if old_post_id is not None:
+            # The post may have been moved since it was indexed
+            self._remove_post(old_post_id)
+        self._remove_post(post_id)
+        if self._postdb.post_id_to_post.get(post_id) is post:
+            self._add_post(post, post_id, self._post_field_tokens(post),
+                           self._post_field_trigrams(post))
+
+    def _flush_batch(self):
+        """Updates the posts that were touched in the currently open
+        :func:`PostDB.batch` block of the post database.
+
+        The ``'batch_touch'`` event is sent only when the outermost batch
+        block exits, so without this, a search performed inside a batch block
+        would use the postings of the posts from before the block. The posts
+        are updated again when the event arrives.
+        """
+
+        for post, fields in self._postdb.pending_touched().iteritems():
+            self._update_post(post, fields)
+
+    def _recalc_postings(self):
+        """Recalculates the `_postings`, `_post_tokens`, `_trigram_postings`
+        and `_post_trigrams` data attributes if needed.
+
+        The tokens and trigrams saved by :func:`save` are used for the posts
+        whose stamp has not changed since then. If some posts had to be
+        tokenized, the index is saved.
+
+        See also the :ref:`lazy_data_calculation_pattern` pattern.
+        """
+
+        if self._postings is not None:
+            return
+
+        self._postings = dict((field, {}) for field in index_fields)
+        self._post_tokens = {}
+        self._trigram_postings = dict((field, {}) for field in trigram_fields)
+        self._post_trigrams = {}
+        self._token_trigrams = dict((field, {}) for field in index_fields)
+        self._indexed_posts = {}
+        self._indexed_post_ids = {}
+        postdb = self._postdb
+        saved = {}
+        changed = False
+        for heap_id in postdb.heap_ids():
+            saved[heap_id] = postdb.read_cache_file(heap_id, 'index',
+                                                    SEARCH_INDEX_VERSION)
+            if saved[heap_id] is None:
+                saved[heap_id] = {}
+
+        for post_id, post in postdb.post_id_to_post.iteritems():
+            heap_id, post_index = post_id
+            entry = saved.get(heap_id, {}).get(post_index)
+            if (entry is not None and not post.is_modified() and
+                post.stamp() is not None and entry[0] == post.stamp()):
+                field_tokens, field_trigrams = entry[1:]
+            else:
+                field_tokens = self._post_field_tokens(post)
+                field_trigrams = self._post_field_trigrams(post)
+                changed = True
+            self._add_post(post, post_id, field_tokens, field_trigrams)
+
+        if changed:
+            self.save()
+
+    def save(self):
+        """Saves the tokens and trigrams of the posts into the cache directory
+        of the post database.
+
+        Only the posts that are not modified in the memory are saved, since
+        the tokens and trigrams of a post are used only if the stamp of the
+        post is the same when the index is rebuilt.
+        """
+
+        if self._postings is None:
+            return
+        postdb = self._postdb
+        entries = dict((heap_id, {}) for heap_id in postdb.heap_ids())
+        for post_id, field_tokens in self._post_tokens.iteritems():
+            post = postdb.post_id_to_post.get(post_id)
+            if (post is not None and not post.is_modified() and
+                post.stamp() is not None):
+                heap_id, post_index = post_id
+                entries[heap_id][post_index] = \
+                    (post.stamp(), field_tokens, self._post_trigrams[post_id])
+        for heap_id, heap_entries in entries.iteritems():
+            postdb.write_cache_file(heap_id, 'index', SEARCH_INDEX_VERSION,
+                                    heap_entries)
+
+    def candidates(self, fields, word):
+        """Returns the post ids of the posts that contain the given word in
+        the given fields.
+
+        The word is searched as a substring of the tokens, so the posts
+        returned are exactly those whose fields contain the word when case is
+        ignored. The word itself is looked up in the postings directly; the
+        other tokens that contain it are found by intersecting the tokens that
+        contain its trigrams (see `_token_trigrams`).
+
+        **Arguments:**
+
+        - `fields` (iterable(|IndexField|))
+        - `word` (str) -- A pattern for which :func:`is_plain_word` is true.
+
+        **Returns:** set(|PostId|) | ``None`` -- ``None`` if the word is
+        shorter than three characters, so it does not have any trigram.
+        """
+
+        word = word.lower()
+        word_trigrams = trigrams([word])
+        if len(word_trigrams) == 0:
+            return None
+        self._recalc_postings()
+        self._flush_batch()
+        result = set()
+        for field in fields:
+            postings = self._postings[field]
+            token_trigrams = self._token_trigrams[field]
+            post_ids = postings.get(word)
+            if post_ids is not None:
+                result.update(post_ids)
+            token_sets = \
+                [ token_trigrams.get(trigram) for trigram in word_trigrams ]
+            if None in token_sets:
+                continue
+            token_sets.sort(key=len)
+            for token in set.intersection(*token_sets):
+                if token != word and word in token:
+                    result.update(postings[token])
+        return result
+
+    def regexp_candidates(self, fields, pattern, flags=regexp_options):
+        """Returns the post ids of the posts whose given fields may match the
+        given regular expression.
+
+        The trigrams required by the regular expression (see
+        :func:`required_trigrams`) are looked up in the index: only the posts
+        that contain all of them in one of the fields may match it.
+
+        **Arguments:**
+
+        - `fields` (iterable(|IndexField|)) -- Fields listed in
+          `trigram_fields`.
+        - `pattern` (str) -- A regular expression.
+        - `flags` (int) -- The flags with which the regular expression is
+          used.
+
+        **Returns:** set(|PostId|) | ``None`` -- ``None`` if the regular
+        expression does not require any trigram, so any post may match it.
+        """
+
+        required = required_trigrams(pattern, flags)
+        if len(required) == 0:
+            return None
+        self._recalc_postings()
+        self._flush_batch()
+        result = set()
+        for field in fields:
+            postings = self._trigram_postings[field]
+            post_id_sets = [postings.get(trigram) for trigram in required]
+            if None not in post_id_sets:
+                post_id_sets.sort(key=len)
+                result.update(set.intersection(*post_id_sets))
+        return result
+
+
+# The search indexes used by `search`
+search_indexes = {} # {PostDB: SearchIndex}
+
+def enable_index(postdb):
+    """Creates a search index for the given post database, which will be used
+    by :func:`search`.
+
+    **Argument:**
+
+    - `postdb` (|PostDB|)
+
+    **Returns:** |SearchIndex|
+    """
+
+    index = search_indexes.get(postdb)
+    if index is None:
+        index = SearchIndex(postdb)
+        search_indexes[postdb] = index
+    return index
+
+def disable_index(postdb):
+    """Closes and drops the search index of the given post database.
+
+    **Argument:**
+
+    - `postdb` (|PostDB|)
+    """
+
+    index = search_indexes.pop(postdb, None)
+    if index is not None:
+        index.close()
+
+
+##### Parallel search #####
+
+# The fields of the posts in the snapshots of |SearchPool|, in the order in
+# which `whole_target_strings` returns them. Each tag of a post is a separate
+# string of the 'tags' field.
+parallel_fields = \
+    ('author', 'subject', 'messid', 'date', 'parent', 'postid', 'body', 'tags')
+
+# The fields searched by |SearchPool| for the target types that can use it
+parallel_target_types = \
+    {'whole': parallel_fields,
+     'body': ('body',)}
+
+# By default, the parallel search is used only if the post database contains
+# at least this many posts
+DEFAULT_PARALLEL_SEARCH_MIN_POSTS = 5000
+
+# The posts are divided into this many chunks per worker process, so that the
+# load of the processes is balanced
+CHUNKS_PER_SEARCH_PROCESS = 4
+
+# The format of the trailer of a snapshot file: the number of posts, the
+# number of strings and the offset of the arrays
+SNAPSHOT_TRAILER_FORMAT = '=qqq'
+
+# The snapshot of |SearchPool| is written again completely if its delta would
+# contain more posts than this ratio of the posts of the snapshot
+SNAPSHOT_DELTA_MAX_RATIO = 0.1
+
+# The number of snapshot files kept mapped into the memory of a worker process,
+# so that a snapshot and its delta can be searched alternately
+WORKER_SNAPSHOTS = 2
+
+# The snapshots mapped into the memory of the current worker process, the most
+# recently used one being the last: [(str, mmap.mmap, array('l'), array('l'))]
+_worker_snapshots = []
+
+def write_snapshot(posts):
+    """Writes the strings of the given posts into a new snapshot file.
+
+    The snapshot file contains the strings of the posts (see
+    :func:`whole_target_strings`), followed by two arrays: the index of the
+    first string of each post (and the number of strings), and the offset of
+    each string (and the length of the strings). The last part of the file is
+    a trailer of the `SNAPSHOT_TRAILER_FORMAT` format.
+
+    **Argument:**
+
+    - `posts` (iterable(|Post|))
+
+    **Returns:** str -- The name of the snapshot file.
+    """
+
+    post_count = 0
+    post_starts = array.array('l', [0])
+    string_offsets = array.array('l', [0])
+    fd, filename = tempfile.mkstemp(prefix='hksearch-', suffix='.snapshot')
+    f = os.fdopen(fd, 'wb')
+    try:
+        offset = 0
+        for post in posts:
+            post_count += 1
+            strings = whole_target_strings(post)
+            for s in strings:
+                f.write(s)
+                offset += len(s)
+                string_offsets.append(offset)
+            post_starts.append(post_starts[-1] + len(strings))
+        f.write(post_starts.tostring())
+        f.write(string_offsets.tostring())
+        f.write(struct.pack(SNAPSHOT_TRAILER_FORMAT,
+                            post_count, len(string_offsets) - 1, offset))
+    finally:
+        f.close()
+    return filename
+
+def map_snapshot(filename):
+    """Maps a snapshot file written by :func:`write_snapshot` into the memory
+    of the current process.
+
+    **Argument:**
+
+    - `filename` (str)
+
+    **Returns:** (mmap.mmap, array('l'), array('l')) -- The mapped file, the
+    index of the first string of each post and the offsets of the strings.
+    """
+
+    f = open(filename, 'rb')
+    try:
+        snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    trailer_size = struct.calcsize(SNAPSHOT_TRAILER_FORMAT)
+    post_count, string_count, arrays_offset = \
+        struct.unpack(SNAPSHOT_TRAILER_FORMAT, snapshot[-trailer_size:])
+    item_size = array.array('l').itemsize
+    offsets_offset = arrays_offset + (post_count + 1) * item_size
+    offsets_end = offsets_offset + (string_count + 1) * item_size
+    post_starts = array.array('l')
+    post_starts.fromstring(snapshot[arrays_offset:offsets_offset])
+    string_offsets = array.array('l')
+    string_offsets.fromstring(snapshot[offsets_offset:offsets_end])
+    return snapshot, post_starts, string_offsets
+
+def snapshot_strings(mapped_snapshot, post_index):
+    """Returns the strings of a post of a mapped snapshot.
+
+    **Arguments:**
+
+    - `mapped_snapshot` ((mmap.mmap, array('l'), array('l'))) -- A snapshot
+      mapped by :func:`map_snapshot`.
+    - `post_index` (int) -- The index of the post in the snapshot.
+
+    **Returns:** [str]
+    """
+
+    snapshot, post_starts, string_offsets = mapped_snapshot
+    return [ snapshot[string_offsets[i]:string_offsets[i + 1]]
+             for i in xrange(post_starts[post_index],
+                             post_starts[post_index + 1]) ]
+
+def load_snapshot(filename):
+    """Maps a snapshot file into the memory of the current worker process.
+
+    The last `WORKER_SNAPSHOTS` snapshots loaded are kept mapped; the least
+    recently used one is closed when a new one is loaded.
+
+    **Argument:**
+
+    - `filename` (str)
+
+    **Returns:** (str, mmap.mmap, array('l'), array('l')) -- The file name,
+    the mapped file, the index of the first string of each post and the
+    offsets of the strings.
+    """
+
+    for i, worker_snapshot in enumerate(_worker_snapshots):
+        if worker_snapshot[0] == filename:
+            del _worker_snapshots[i]
+            _worker_snapshots.append(worker_snapshot)
+            return worker_snapshot
+
+    worker_snapshot = (filename,) + map_snapshot(filename)
+    _worker_snapshots.append(worker_snapshot)
+    while len(_worker_snapshots) > WORKER_SNAPSHOTS:
+        _worker_snapshots.pop(0)[1].close()
+    return worker_snapshot
+
+def parallel_search_task(task):
+    """Searches for a pattern in a chunk of the posts of a snapshot; it is
+    executed by the worker processes of |SearchPool|.
+
+    **Argument:**
+
+    - `task` ((str, (int), str, int, int, int)) -- The file name of the
+      snapshot, the indexes of the searched fields in `parallel_fields`, the
+      regular expression, its flags, and the index of the first post and the
+      post after the last post of the chunk.
+
+    **Returns:** [int] -- The indexes of the posts of the chunk that match the
+    pattern in any of the searched fields.
+    """
+
+    filename, field_indexes, pattern, flags, start, end = task
+    _, snapshot, post_starts, string_offsets = load_snapshot(filename)
+    regexp = re.compile(pattern, flags)
+    field_indexes = frozenset(field_indexes)
+    tags_index = len(parallel_fields) - 1
+    result = []
+    for post_index in xrange(start, end):
+        first_string = post_starts[post_index]
+        for string_index in xrange(first_string, post_starts[post_index + 1]):
+            if min(string_index - first_string, tags_index) in field_indexes:
+                s = snapshot[string_offsets[string_index]:
+                             string_offsets[string_index + 1]]
+                if regexp.search(s):
+                    result.append(post_index)
+                    break
+    return result
+
+
+class SearchPool(object):
+
+    """A pool of worker processes that search for regular expressions in the
+    posts of a post database.
+
+    The strings of the posts are written into a snapshot file, which is
+    mapped into the memory of the worker processes (see
+    :func:`load_snapshot`), so the posts are shipped to the workers only once
+    and not with each search. The posts of a search are divided into chunks,
+    which are searched by the worker processes in parallel.
+
+    The snapshot is updated only if the post database has changed since it
+    was updated last time (see :func:`hklib.PostDB.generation`), and then
+    only the posts touched since then are checked. The posts whose strings
+    differ from the ones in the snapshot (and the new posts) are written into
+    a small delta snapshot, and their entries in the snapshot are ignored.
+    The snapshot is written again completely only if the whole post database
+    was touched or the delta would be too large (see
+    `SNAPSHOT_DELTA_MAX_RATIO`).
 
-    return postset.collect(post_matches_any)
+    **Implements:** |PostDBEventListener|
+
+    **Data attributes:**
+
+    - `processes` (int) -- The number of worker processes.
+    - `min_posts` (int) -- The pool is used only if the post database contains
+      at least this many posts (see :func:`is_used`).
+    - `_postdb` (|PostDB|) -- The post database in which the pool searches.
+    - `_pool` (multiprocessing.Pool | ``None``) -- The worker processes. They
+      are started by the first search.
+    - `_snapshot_file` (str | ``None``) -- The name of the snapshot file.
+    - `_snapshot` ((mmap.mmap, array('l'), array('l')) | ``None``) -- The
+      snapshot file mapped into the memory of the current process, so that
+      the strings of the touched posts can be compared to it.
+    - `_snapshot_post_ids` ([|PostId|]) -- The posts of the snapshot in the
+      order in which they were written into it.
+    - `_snapshot_indexes` ({|Post|: int}) -- The index of each post of the
+      snapshot.
+    - `_outdated` (set(int)) -- The indexes of the posts of the snapshot that
+      were changed or removed since the snapshot was written.
+    - `_delta_file` (str | ``None``) -- The name of the delta snapshot file.
+      ``None`` if there is no delta.
+    - `_delta_posts` ([|Post|]) -- The posts of the delta snapshot, i.e. the
+      posts that were added or changed since the snapshot was written.
+    - `_snapshot_generation` (int | ``None``) -- The generation of the post
+      database when the snapshot files were updated.
+    - `_touched` (set(|Post|) | ``None``) -- The posts touched since the
+      snapshot files were updated. ``None`` if the whole post database was
+      touched.
+    - `_post_ids` ([|PostId| | ``None``]) -- The posts of the snapshot
+      followed by the posts of the delta snapshot. The outdated posts of the
+      snapshot are ``None``.
+    """
+
+    def __init__(self, postdb, processes=0,
+                 min_posts=DEFAULT_PARALLEL_SEARCH_MIN_POSTS):
+        """Constructor.
+
+        The pool subscribes to the events of the post database.
+
+        **Arguments:**
+
+        - `postdb` (|PostDB|)
+        - `processes` (int) -- The number of worker processes. If 0, it will
+          be the number of CPUs.
+        - `min_posts` (int)
+        """
+
+        super(SearchPool, self).__init__()
+        if processes == 0:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.min_posts = min_posts
+        self._postdb = postdb
+        self._pool = None
+        self._snapshot_file = None
+        self._snapshot = None
+        self._snapshot_post_ids = []
+        self._snapshot_indexes = {}
+        self._outdated = set()
+        self._delta_file = None
+        self._delta_posts = []
+        self._snapshot_generation = None
+        self._touched = set()
+        self._post_ids = []
+        postdb.listeners.append(self)
+
+    def close(self):
+        """Stops the worker processes, removes the snapshot files and
+        unsubscribes from the events of the post database."""
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._remove_snapshot()
+        if self in self._postdb.listeners:
+            self._postdb.listeners.remove(self)
+
+    def __call__(self, e):
+        """The event handler method.
+
+        **Argument:**
+
+        - `e` (|PostDBEvent|)
+        """
+
+        if not isinstance(e, hklib.PostDBEvent) or self._touched is None:
+            pass
+        elif e.type == 'touch_all':
+            self._touched = None
+        elif e.type == 'touch':
+            self._touched.add(e.post)
+        elif e.type == 'batch_touch':
+            self._touched.update(e.posts)
+
+    def _remove_delta(self):
+        """Removes the delta snapshot file."""
+
+        if self._delta_file is not None:
+            os.remove(self._delta_file)
+            self._delta_file = None
+
+    def _remove_snapshot(self):
+        """Removes the snapshot files."""
+
+        self._remove_delta()
+        if self._snapshot_file is not None:
+            self._snapshot[0].close()
+            os.remove(self._snapshot_file)
+            self._snapshot_file = None
+            self._snapshot = None
+            self._snapshot_post_ids = []
+            self._snapshot_indexes = {}
+            self._outdated = set()
+            self._delta_posts = []
+            self._snapshot_generation = None
+            self._post_ids = []
+
+    def is_used(self):
+        """Returns whether the searches in the post database should be
+        performed by the pool.
+
+        **Returns:** bool
+        """
+
+        return (self.processes > 1 and
+                len(self._postdb.post_id_to_post) >= self.min_posts)
+
+    def _write_snapshot(self):
+        """Writes the snapshot file again with all posts of the post database
+        (including the deleted ones) and drops the delta snapshot."""
+
+        self._remove_snapshot()
+        posts = self._postdb.real_posts()
+        self._snapshot_file = write_snapshot(posts)
+        self._snapshot = map_snapshot(self._snapshot_file)
+        self._snapshot_post_ids = [ post.post_id() for post in posts ]
+        self._snapshot_indexes = \
+            dict((post, i) for i, post in enumerate(posts))
+        self._post_ids = list(self._snapshot_post_ids)
+
+    def _update_delta(self, touched):
+        """Writes the delta snapshot again after the given posts were touched.
+
+        A touched post is written into the delta snapshot if it is in the post
+        database, and its post id or strings differ from the ones in the
+        snapshot.
+
+        **Argument:**
+
+        - `touched` (set(|Post|))
+
+        **Returns:** bool -- ``False`` if the delta would be too large, so
+        the snapshot should be written again instead (in this case nothing is
+        modified).
+        """
+
+        postdb = self._postdb
+        outdated = set(self._outdated)
+        delta_posts = set(self._delta_posts)
+        for post in touched:
+            post_id = post.post_id()
+            present = postdb.post_id_to_post.get(post_id) is post
+            index = self._snapshot_indexes.get(post)
+            if (present and index is not None and
+                self._snapshot_post_ids[index] == post_id and
+                (snapshot_strings(self._snapshot, index) ==
+                 list(whole_target_strings(post)))):
+                # The post is the same as in the snapshot
+                outdated.discard(index)
+                delta_posts.discard(post)
+                continue
+            if index is not None:
+                outdated.add(index)
+            if present:
+                delta_posts.add(post)
+            else:
+                delta_posts.discard(post)
+
+        max_size = len(self._snapshot_post_ids) * SNAPSHOT_DELTA_MAX_RATIO
+        if len(outdated) + len(delta_posts) > max_size:
+            return False
+
+        self._remove_delta()
+        self._outdated = outdated
+        self._delta_posts = \
+            sorted(delta_posts, key=lambda post: post.post_id())
+        if len(self._delta_posts) > 0:
+            self._delta_file = write_snapshot(self._delta_posts)
+        self._post_ids = list(self._snapshot_post_ids)
+        for index in outdated:
+            self._post_ids[index] = None
+        self._post_ids.extend([ post.post_id() for post in self._delta_posts ])
+        return True
+
+    def _update_snapshot(self):
+        """Updates the snapshot files if the post database has changed since
+        they were updated last time.
+
+        If only some posts were touched since then, only the delta snapshot is
+        written again (see :func:`_update_delta`); otherwise the snapshot is
+        written again (see :func:`_write_snapshot`).
+        """
+
+        postdb = self._postdb
+        generation = postdb.generation()
+        if (self._snapshot_file is not None and
+            self._snapshot_generation == generation):
+            return
+
+        touched = self._touched
+        if touched is not None:
+            # The posts touched in an open batch block are not reported until
+            # the block exits
+            touched = touched.union(postdb.pending_touched())
+        if (self._snapshot_file is None or touched is None or
+            not self._update_delta(touched)):
+            self._write_snapshot()
+        self._snapshot_generation = generation
+        self._touched = set()
+
+    def search(self, fields, pattern, flags=regexp_options):
+        """Returns the posts of the post database that match the given regular
+        expression in any of the given fields.
+
+        **Arguments:**
+
+        - `fields` (iterable(str)) -- Elements of `parallel_fields`.
+        - `pattern` (str) -- Regular expression.
+        - `flags` (int) -- The flags of the regular expression.
+
+        **Returns:** set(|PostId|)
+        """
+
+        self._update_snapshot()
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        field_indexes = tuple([ parallel_fields.index(field)
+                                for field in fields ])
+        snapshot_size = len(self._snapshot_post_ids)
+        snapshots = [(self._snapshot_file, 0, snapshot_size)]
+        if self._delta_file is not None:
+            snapshots.append(
+                (self._delta_file, snapshot_size, len(self._delta_posts)))
+        chunk_count = self.processes * CHUNKS_PER_SEARCH_PROCESS
+        chunk_size = \
+            max(1, (len(self._post_ids) + chunk_count - 1) / chunk_count)
+        tasks = []
+        task_firsts = []
+        for filename, first, post_count in snapshots:
+            for start in xrange(0, post_count, chunk_size):
+                tasks.append((filename, field_indexes, pattern, flags,
+                              start, min(post_count, start + chunk_size)))
+                task_firsts.append(first)
+        post_ids = self._post_ids
+        result = set()
+        task_results = self._pool.map(parallel_search_task, tasks)
+        for first, post_indexes in zip(task_firsts, task_results):
+            for i in post_indexes:
+                post_id = post_ids[first + i]
+                if post_id is not None:
+                    result.add(post_id)
+        return result
+
+
+# The search pools used by `search` and `hkshell.grep`
+search_pools = {} # {PostDB: SearchPool}
+
+def enable_parallel_search(postdb, processes=0,
+                           min_posts=DEFAULT_PARALLEL_SEARCH_MIN_POSTS):
+    """Creates a search pool for the given post database, which will be used
+    by :func:`search` and :func:`hkshell.grep` if the post database is large
+    enough.
+
+    **Arguments:**
+
+    - `postdb` (|PostDB|)
+    - `processes` (int) -- The number of worker processes. If 0, it will be
+      the number of CPUs.
+    - `min_posts` (int) -- The pool is used only if the post database
+      contains at least this many posts.
+
+    **Returns:** |SearchPool|
+    """
+
+    disable_parallel_search(postdb)
+    pool = SearchPool(postdb, processes, min_posts)
+    search_pools[postdb] = pool
+    return pool
+
+def disable_parallel_search(postdb):
+    """Closes and drops the search pool of the given post database.
+
+    **Argument:**
+
+    - `postdb` (|PostDB|)
+    """
+
+    pool = search_pools.pop(postdb, None)
+    if pool is not None:
+        pool.close()
+
+def parallel_search_pool(postdb):
+    """Returns the search pool that should be used for searching in the given
+    post database.
+
+    **Argument:**
+
+    - `postdb` (|PostDB|)
+
+    **Returns:** |SearchPool| | ``None`` -- ``None`` if the post database
+    has no search pool or it is too small for using it.
+    """
+
+    pool = search_pools.get(postdb)
+    if pool is not None and pool.is_used():
+        return pool
+    else:
+        return None
+
+def close_search_pools():
+    """Closes all search pools; it is called when the program exits."""
+
+    for postdb in search_pools.keys():
+        disable_parallel_search(postdb)
+
+atexit.register(close_search_pools)
+
+
+##### Ranking #####
+
+# The weights of the fields of the posts when the relevance of the posts is
+# calculated
+rank_field_weights = \
+    {'author': 1.0,
+     'subject': 3.0,
+     'tags': 2.0,
+     'body': 1.0}
+
+# The fields in which the matches of the targets of the target types are
+# counted when the relevance of the posts is calculated
+rank_target_fields = \
+    {'whole': ('author', 'subject', 'tags', 'body'),
+     'author': ('author',),
+     'subject': ('subject',),
+     'tag': ('tags',),
+     'body': ('body',)}
+
+# The weight of the recency of the posts in their score
+rank_recency_weight = 1.0
+
+# The recency of a post halves when its age grows by this many seconds
+RANK_RECENCY_HALF_LIFE = 30 * 24 * 60 * 60
+
+def rank_posts(query, postset, k):
+    """Returns the `k` posts of the post set that have the highest score for
+    the given query.
+
+    The posts are selected using a heap whose size is bounded by `k`, so the
+    posts are not sorted.
+
+    **Arguments:**
+
+    - `query` (|Query|)
+    - `postset` (|PostSet|)
+    - `k` (int)
+
+    **Returns:** [(float, |Post|)] -- The scores and the posts, ordered by
+    the score in descending order. Posts with the same score are ordered by
+    their date, the newest first.
+    """
+
+    newest_posts = postset.postdb().newest_posts(1)
+    if len(newest_posts) > 0:
+        newest_timestamp = newest_posts[0].timestamp()
+    else:
+        newest_timestamp = 0
+    scored_posts = \
+        ((query.score(post, newest_timestamp), post.timestamp(),
+          post.post_id(), post)
+         for post in postset)
+    return [ (score, post)
+             for score, _, _, post in heapq.nlargest(
+                 k, scored_posts, key=lambda item: item[:3]) ]
+
+
+##### search #####
+
+class Target(object):
+
+    """A compiled search target, e.g. ``'body:-cont.*ent'``.
+
+    **Data attributes:**
+
+    - `type` (str) -- The target type.
+    - `pattern` (str) -- The pattern of the target, without the leading ``-``
+      sign.
+    - `positive` (bool) -- ``False`` if the target was negated, i.e. the posts
+      that do not match the pattern should be found.
+    - `regexp` (re.RegexObject | ``None``) -- The compiled pattern, if it is
+      used as a regular expression by the compiler of the target type.
+    - `datetime` (datetime.datetime | ``None``) -- The parsed pattern, if it
+      is used as a date by the compiler of the target type.
+    - `matches` (fun(|Post|) -> bool) -- The function that decides whether a
+      post matches the pattern.
+    - `cost` (int) -- The estimated cost of matching a post against the
+      target (see `target_costs`).
+    """
+
+    def __init__(self, str_target):
+        """Constructor.
+
+        The pattern is compiled by the compiler of the target type.
+
+        **Argument:**
+
+        - `str_target` (str) -- A target of a search term, e.g.
+          ``'cont.*ent'`` or ``'heap:myheap'``.
+        """
+
+        super(Target, self).__init__()
+        self.type = None
+        self.pattern = None
+
+        # If str_target has the form of "<target_type>:<str>", then
+        # <target_type> is the type of the target and <str> is the pattern
+        for target_type in target_types.keys():
+            if str_target.startswith(target_type + ':'):
+                # We found the target type of the current target
+                self.type = target_type
+                self.pattern = str_target[(len(target_type) + 1):]
+                break
+
+        # Otherwise the target should be searched in the whole post
+        if self.type is None:
+            self.type = 'whole'
+            self.pattern = str_target
+
+        # If the pattern starts with a '-' sign, the effect of the search
+        # should be negated (i.e. posts that don't match the pattern should
+        # be found)
+        if self.pattern.startswith('-'):
+            self.pattern = self.pattern[1:]
+            self.positive = False
+        else:
+            self.positive = True
+
+        self.regexp = None
+        self.datetime = None
+        self.cost = target_costs.get(self.type, default_target_cost)
+        compiler = target_compilers.get(self.type)
+        if compiler is None:
+            fun = target_types[self.type]
+            pattern = self.pattern
+            self.matches = lambda post: fun(post, pattern)
+        else:
+            self.matches = compiler(self)
+
+    def is_builtin(self):
+        """Returns whether the target type of the target is a built-in one
+        that was not overridden.
+
+        **Returns:** bool
+        """
+
+        compiler = target_compilers.get(self.type)
+        return (compiler is not None and
+                compiler is builtin_target_compilers.get(self.type))
+
+    def candidates(self, postdb):
+        """Returns the posts of the post database that may match the target,
+        if they can be found without matching all posts against it.
+
+        The heap, author and tag targets are matched against the heap ids,
+        authors and tags of the post database, and the posts are looked up in
+        its indexes (see e.g. :func:`hklib.PostDB.post_ids_with_tag`). The
+        posts of the date targets are looked up in the date index of the post
+        database (see :func:`hklib.PostDB.post_ids_in_date_range`). If the
+        post database has a search index (see :func:`enable_index`), the
+        plain words of the other target types are looked up in it by their
+        tokens, other regular expressions by the trigrams they require.
+        Otherwise the posts of the 'whole' and 'body' targets may be found by
+        the search pool of the post database (see
+        :func:`enable_parallel_search`).
+
+        **Argument:**
+
+        - `postdb` (|PostDB|)
+
+        **Returns:** (set(|PostId|), (|IndexField|)) | ``None`` -- Only the
+        posts in the first element can match the pattern in the fields listed
+        in the second element; for the target types other than 'whole', the
+        other posts cannot match the target at all. ``None`` if the
+        candidates cannot be found.
+        """
+
+        if not self.is_builtin():
+            return None
+        if self.type in ('heap', 'author', 'tag'):
+            if self.type == 'heap':
+                keys = postdb.heap_ids()
+                get_post_ids = postdb.post_ids_in_heap
+            elif self.type == 'author':
+                keys = postdb.author_names()
+                get_post_ids = postdb.post_ids_by_author
+            else:
+                keys = postdb.tag_names()
+                get_post_ids = postdb.post_ids_with_tag
+            post_ids = set()
+            for key in keys:
+                if self.regexp.search(key):
+                    post_ids.update(get_post_ids(key))
+            return (post_ids, ())
+        elif self.type == 'before':
+            return (set(postdb.post_ids_in_date_range(dte=self.datetime)), ())
+        elif self.type == 'after':
+            post_ids = set(postdb.post_ids_in_date_range(dts=self.datetime))
+            post_ids.update(postdb.undated_post_ids())
+            return (post_ids, ())
+        index = search_indexes.get(postdb)
+        if index is not None:
+            if (self.type in indexed_target_types and
+                is_plain_word(self.pattern)):
+                fields = indexed_target_types[self.type]
+                post_ids = index.candidates(fields, self.pattern)
+                if post_ids is not None:
+                    return (post_ids, fields)
+            elif self.type in trigram_target_types:
+                fields = trigram_target_types[self.type]
+                post_ids = index.regexp_candidates(fields, self.pattern)
+                if post_ids is not None:
+                    return (post_ids, fields)
+        pool = parallel_search_pool(postdb)
+        if pool is not None and self.type in parallel_target_types:
+            post_ids = \
+                pool.search(parallel_target_types[self.type], self.pattern)
+            if self.type == 'whole':
+                # All fields were searched
+                return (post_ids, tuple(index_fields))
+            else:
+                return (post_ids, ('body',))
+        return None
+
+    def __repr__(self):
+        sign = '' if self.positive else '-'
+        return '<target %s:%s%s>' % (self.type, sign, self.pattern)
+
+
+class Query(object):
+
+    """A compiled search term.
+
+    The search term is split into targets and their patterns are compiled
+    (e.g. regular expressions are compiled and dates are parsed) only once,
+    when the query is created. Afterwards the query can be used to search in
+    any number of post sets.
+
+    **Data attributes:**
+
+    - `term` (str) -- The search term.
+    - `targets` ([|Target|]) -- The targets of the search term. A post
+      satisfies the query if it satisfies all of its targets.
+    """
+
+    def __init__(self, term):
+        """Constructor.
+
+        **Argument:**
+
+        - `term` (str)
+        """
+
+        super(Query, self).__init__()
+        self.term = term
+        self.targets = [ Target(str_target) for str_target in term.split() ]
+
+    def matches(self, post):
+        """Returns whether the given post satisfies all targets of the query.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** bool
+        """
+
+        for target in self.targets:
+            if target.matches(post) != target.positive:
+                return False
+        return True
+
+    def search(self, postset, explain=False):
+        """Returns the subset of the given post set that satisfies the query.
+
+        The query is executed according to a |QueryPlan|.
+
+        **Arguments:**
+
+        - `postset` (|PostSet|)
+        - `explain` (bool) -- If ``True``, the plan and the time spent on each
+          target are logged (see :func:`QueryPlan.explain`).
+
+        **Returns:** |PostSet|
+        """
+
+        plan = QueryPlan(self, postset)
+        result = plan.execute(timed=explain)
+        if explain:
+            hkutils.log(plan.explain())
+        return result
+
+    def score(self, post, newest_timestamp=0):
+        """Returns the score of a post that satisfies the query.
+
+        The score is the sum of the relevance and the recency of the post.
+        The relevance is calculated from the matches of the patterns of the
+        positive targets whose target types are in `rank_target_fields`: if
+        a field of the post matches a pattern ``n`` times, its weight in
+        `rank_field_weights` multiplied by ``1 + log(n)`` is added to the
+        relevance. The recency of the newest post is `rank_recency_weight`,
+        and it halves for each `RANK_RECENCY_HALF_LIFE` seconds of age.
+
+        **Arguments:**
+
+        - `post` (|Post|)
+        - `newest_timestamp` (int) -- The timestamp of the newest post. If 0,
+          the recency is not calculated.
+
+        **Returns:** float
+        """
+
+        score = 0.0
+        for target in self.targets:
+            fields = rank_target_fields.get(target.type)
+            if (not target.positive or target.regexp is None or
+                fields is None):
+                continue
+            for field in fields:
+                weight = rank_field_weights[field]
+                for s in index_fields[field](post):
+                    count = len(target.regexp.findall(s))
+                    if count > 0:
+                        score += weight * (1 + math.log(count))
+
+        timestamp = post.timestamp()
+        if newest_timestamp > 0 and timestamp > 0:
+            age = max(0, newest_timestamp - timestamp)
+            score += (rank_recency_weight *
+                      0.5 ** (float(age) / RANK_RECENCY_HALF_LIFE))
+        return score
+
+    def ranked_search(self, postset, k):
+        """Returns the `k` posts of the given post set that satisfy the query
+        and have the highest score (see :func:`score`).
+
+        **Arguments:**
+
+        - `postset` (|PostSet|)
+        - `k` (int)
+
+        **Returns:** [(float, |Post|)] -- See :func:`rank_posts`.
+        """
+
+        return rank_posts(self, self.search(postset), k)
+
+
+class QueryPlan(object):
+
+    """The plan of executing a |Query| on a post set.
+
+    First the candidates of the targets are looked up (see
+    :func:`Target.candidates`), unless the post set is small compared to the
+    post database (see `CANDIDATE_LOOKUP_MIN_RATIO`). The posts that can
+    satisfy the query are
+    restricted to the candidates of the positive targets whose candidates
+    contain all posts that may match them. Afterwards the posts are matched
+    against the targets; the targets are ordered by their estimated cost and
+    selectivity, so that a post is matched against expensive targets only if
+    the cheaper ones did not reject it.
+
+    **Data attributes:**
+
+    - `query` (|Query|) -- The query to be executed.
+    - `postset` (|PostSet|) -- The post set in which the query searches.
+    - `restricted_posts` (set(|PostId|) | ``None``) -- Only these posts can
+      satisfy the query. ``None`` if all posts of `postset` can.
+    - `steps` ([|QueryStep|]) -- The targets in the order in which the posts
+      are matched against them.
+    - `result_count` (int | ``None``) -- The number of posts found by the
+      last execution. ``None`` if the plan has not been executed.
+    """
+
+    def __init__(self, query, postset):
+        """Constructor.
+
+        **Arguments:**
+
+        - `query` (|Query|)
+        - `postset` (|PostSet|)
+        """
+
+        super(QueryPlan, self).__init__()
+        self.query = query
+        self.postset = postset
+        self.restricted_posts = None
+        self.result_count = None
+        postdb = postset.postdb()
+
+        # Looking up the candidates takes time proportional to the size of
+        # the post database, so it is not worth doing when a small post set
+        # (e.g. a thread) is searched
+        lookup_candidates = \
+            (len(postset) >=
+             len(postdb.post_id_to_post) * CANDIDATE_LOOKUP_MIN_RATIO)
+
+        steps = []
+        for target in query.targets:
+            if lookup_candidates:
+                candidates = target.candidates(postdb)
+            else:
+                candidates = None
+            step = QueryStep(target, candidates)
+            steps.append(step)
+            if step.is_restricting():
+                if self.restricted_posts is None:
+                    self.restricted_posts = set(step.candidates[0])
+                else:
+                    self.restricted_posts &= step.candidates[0]
+
+        if self.restricted_posts is None:
+            post_count = len(postset)
+        else:
+            post_count = min(len(postset), len(self.restricted_posts))
+        for step in steps:
+            step.estimate_rank(post_count)
+        steps.sort(key=lambda step: step.rank)
+        self.steps = steps
+
+    def posts(self):
+        """Returns the posts that have to be matched against the targets.
+
+        **Returns:** iterable(|Post|)
+        """
+
+        restricted_posts = self.restricted_posts
+        if restricted_posts is None:
+            return self.postset
+        elif len(restricted_posts) < len(self.postset):
+            post_id_to_post = self.postset.postdb().post_id_to_post
+            posts = [ post_id_to_post.get(post_id)
+                      for post_id in restricted_posts ]
+            return [ post for post in posts if post in self.postset ]
+        else:
+            return [ post for post in self.postset
+                     if post.post_id() in restricted_posts ]
+
+    def execute(self, timed=False):
+        """Executes the plan.
+
+        **Argument:**
+
+        - `timed` (bool) -- If ``True``, the time spent on each step is
+          measured.
+
+        **Returns:** |PostSet|
+        """
+
+        steps = self.steps
+        for step in steps:
+            step.reset()
+            if timed:
+                step.time = 0.0
+
+        def post_matches_all(post):
+            """Returns whether the given post matches all targets.
+
+            **Argument:**
+
+            - `post` (|Post|)
+
+            **Returns:** bool
+            """
+
+            for step in steps:
+                if timed:
+                    start_time = time.time()
+                    matches = step.matches(post)
+                    step.time += time.time() - start_time
+                else:
+                    matches = step.matches(post)
+                step.post_count += 1
+
+                # (matches != positive) <=>
+                # (matches and not positive) or (not matches and positive) =>
+                # this post should not be in the search result
+                if matches != step.target.positive:
+                    step.rejected_count += 1
+                    return False
+
+            return True
+
+        postdb = self.postset.postdb()
+        result = \
+            hklib.PostSet(postdb,
+                          [ post for post in self.posts()
+                            if post_matches_all(post) ])
+        self.result_count = len(result)
+        return result
+
+    def explain(self):
+        """Returns the description of the plan.
+
+        If the plan has been executed, the number of posts matched against
+        each target, the number of posts rejected by it and the time spent on
+        it (if the execution was timed) are also described.
+
+        **Returns:** str
+
+        **Example:** ::
+
+            Query: 'body:foo heap:myheap'
+            Posts: 1200, restricted to 300
+            1. heap:myheap (cost: 1, candidates: 300) -- 300 posts, 0 rejected,
+               0.0012 s
+            2. body:foo (cost: 20) -- 300 posts, 285 rejected, 0.0250 s
+            Result: 15 posts
+        """
+
+        lines = ['Query: %s' % (repr(self.query.term),)]
+        if self.restricted_posts is None:
+            lines.append('Posts: %d' % (len(self.postset),))
+        else:
+            lines.append('Posts: %d, restricted to %d' %
+                         (len(self.postset), len(self.posts())))
+        for i, step in enumerate(self.steps):
+            line = '%d. %s:%s%s (cost: %d' % \
+                   (i + 1, step.target.type,
+                    '' if step.target.positive else '-',
+                    step.target.pattern, step.target.cost)
+            if step.candidates is not None:
+                line += ', candidates: %d' % (len(step.candidates[0]),)
+            line += ')'
+            if self.result_count is not None:
+                line += ' -- %d posts, %d rejected' % \
+                        (step.post_count, step.rejected_count)
+                if step.time is not None:
+                    line += ', %.4f s' % (step.time,)
+            lines.append(line)
+        if self.result_count is not None:
+            lines.append('Result: %d posts' % (self.result_count,))
+        return '\n'.join(lines)
+
+
+class QueryStep(object):
+
+    """A target of a |QueryPlan| together with its candidates and statistics.
+
+    **Data attributes:**
+
+    - `target` (|Target|)
+    - `candidates` ((set(|PostId|), (|IndexField|)) | ``None``) -- The
+      candidates of the target (see :func:`Target.candidates`).
+    - `rank` (float) -- The estimated cost of matching the remaining posts
+      against the target per post rejected by it. The steps with lower rank
+      are executed first.
+    - `post_count` (int) -- The number of posts matched against the target
+      during the last execution of the plan.
+    - `rejected_count` (int) -- The number of posts rejected by the target
+      during the last execution of the plan.
+    - `time` (float | ``None``) -- The time spent on matching the posts
+      against the target during the last execution of the plan. ``None`` if
+      the execution was not timed.
+    """
+
+    def __init__(self, target, candidates):
+        """Constructor.
+
+        **Arguments:**
+
+        - `target` (|Target|)
+        - `candidates` ((set(|PostId|), (|IndexField|)) | ``None``)
+        """
+
+        super(QueryStep, self).__init__()
+        self.target = target
+        self.candidates = candidates
+        self.rank = None
+        self.reset()
+
+    def reset(self):
+        """Resets the statistics of the step."""
+
+        self.post_count = 0
+        self.rejected_count = 0
+        self.time = None
+
+    def is_restricting(self):
+        """Returns whether only the candidates of the step can satisfy the
+        query.
+
+        **Returns:** bool
+        """
+
+        return (self.candidates is not None and
+                self.target.positive and
+                self.target.type != 'whole')
+
+    def estimate_rank(self, post_count):
+        """Estimates the rank of the step.
+
+        The probability that a post is rejected by the target is estimated
+        from the number of its candidates if they are known; otherwise it is
+        assumed to be one half.
+
+        **Argument:**
+
+        - `post_count` (int) -- The number of posts that have to be matched
+          against the targets.
+        """
+
+        if self.candidates is None or self.target.type == 'whole':
+            reject_rate = 0.5
+        else:
+            match_rate = \
+                min(1.0, float(len(self.candidates[0])) / max(1, post_count))
+            if self.target.positive:
+                reject_rate = 1.0 - match_rate
+            else:
+                reject_rate = match_rate
+        self.rank = self.target.cost / max(reject_rate, 0.01)
+
+    def matches(self, post):
+        """Returns whether the given post matches the target of the step.
+
+        **Argument:**
+
+        - `post` (|Post|)
+
+        **Returns:** bool
+        """
+
+        target = self.target
+        candidates = self.candidates
+        if candidates is None or post.post_id() in candidates[0]:
+            return target.matches(post)
+        elif target.type == 'whole':
+            # The post does not match the pattern in the fields that were
+            # looked up in the index, so only the other fields are searched
+            strings = list(unindexed_whole_fields(post))
+            for field, get_strings in index_fields.iteritems():
+                if field not in candidates[1]:
+                    strings.extend(get_strings(post))
+            for s in strings:
+                if target.regexp.search(s):
+                    return True
+            return False
+        else:
+            return False
+
+
+def search(term, postset, explain=False):
+    """Returns a subset of the given post set that satisfies all search targets
+    in the given search term.
+
+    It is a shorthand for ``Query(term).search(postset, explain)``; use a
+    |Query| to search with the same term more than once.
+
+    **Arguments:**
+
+    - `term` (str)
+    - `postset` (|PostSet|)
+    - `explain` (bool) -- If ``True``, the plan of the query and the time
+      spent on each target are logged.
+
+    **Returns:** |PostSet|
+    """
+
+    return Query(term).search(postset, explain)
+
+def ranked_search(term, postset, k):
+    """Returns the `k` posts of the given post set that satisfy the search
+    term and have the highest score.
+
+    It is a shorthand for ``Query(term).ranked_search(postset, k)``.
+
+    **Arguments:**
+
+    - `term` (str)
+    - `postset` (|PostSet|)
+    - `k` (int)
+
+    **Returns:** [(float, |Post|)] -- See :func:`rank_posts`.
+    """
+
+    return Query(term).ranked_search(postset, k)
+
+
+class QueryCache(object):
+
+    """A cache of the results of search terms.
+
+    The cached results are valid only while the generation of the post
+    database (see :func:`hklib.PostDB.generation`) is the same as it was when
+    they were calculated. When the post database changes, the result is
+    calculated again using the already compiled |Query|. When the cache is
+    full, the least recently used result is dropped.
+
+    **Data attributes:**
+
+    - `max_size` (int) -- The maximum number of cached results.
+    - `_entries` ({(|PostDB|, str): [int, int, int, |Query|, |PostSet|,
+      |PostSet| | ``None``, [(float, |Post|)] | ``None``]}) -- Assigns the
+      following data to the post databases and the search terms: the time of
+      the last usage of the entry, the generation of the post database and
+      `target_types_version` when the result was calculated, the compiled
+      query, the result, the expanded result and the best posts of the
+      result (see :func:`ranked_search`). The last two are ``None`` if they
+      have not been calculated yet.
+    - `_time` (int) -- Increased each time an entry is used.
+    - `_hits` (int) -- The number of times a valid result was found in the
+      cache.
+    - `_misses` (int) -- The number of times the result had to be calculated.
+    """
+
+    def __init__(self, max_size=100):
+        """Constructor.
+
+        **Argument:**
+
+        - `max_size` (int)
+        """
+
+        super(QueryCache, self).__init__()
+        self.max_size = max_size
+        self.clear()
+
+    def clear(self):
+        """Removes all entries from the cache and resets the statistics."""
+
+        self._entries = {}
+        self._time = 0
+        self._hits = 0
+        self._misses = 0
+
+    def _entry(self, term, postdb):
+        """Returns the valid cache entry that belongs to the given search term
+        and post database.
+
+        If there is no valid entry, the result is calculated and stored in the
+        cache.
+
+        **Arguments:**
+
+        - `term` (str)
+        - `postdb` (|PostDB|)
+
+        **Returns:** [int, int, int, |Query|, |PostSet|, |PostSet| | ``None``,
+        [(float, |Post|)] | ``None``]
+        """
+
+        self._time += 1
+        key = (postdb, term)
+        entry = self._entries.get(key)
+        generation = postdb.generation()
+        if entry is not None and entry[2] != target_types_version:
+            entry = None
+        if (entry is not None and entry[1] == generation):
+            self._hits += 1
+            entry[0] = self._time
+            return entry
+
+        self._misses += 1
+        if entry is None:
+            query = Query(term)
+        else:
+            query = entry[3]
+        result = query.search(postdb.all())
+        entry = [self._time, generation, target_types_version, query, result,
+                 None, None]
+        self._entries[key] = entry
+        while len(self._entries) > self.max_size:
+            lru_key = min(self._entries,
+                          key=lambda key: self._entries[key][0])
+            del self._entries[lru_key]
+        return entry
+
+    def search(self, term, postdb):
+        """Returns the posts of the post database that satisfy the given search
+        term.
+
+        The returned post set should not be modified.
+
+        **Arguments:**
+
+        - `term` (str)
+        - `postdb` (|PostDB|)
+
+        **Returns:** |PostSet|
+        """
+
+        return self._entry(term, postdb)[4]
+
+    def search_exp(self, term, postdb):
+        """Returns the expanded result of the given search term (see
+        :func:`hklib.PostSet.exp`).
+
+        The returned post set should not be modified.
+
+        **Arguments:**
+
+        - `term` (str)
+        - `postdb` (|PostDB|)
+
+        **Returns:** |PostSet|
+        """
+
+        entry = self._entry(term, postdb)
+        if entry[5] is None:
+            entry[5] = entry[4].exp()
+        return entry[5]
+
+    def ranked_search(self, term, postdb, k):
+        """Returns the `k` posts with the highest score among the results of
+        the given search term (see :func:`Query.ranked_search`).
+
+        The best posts are cached together with the result, so they are
+        calculated again only if more posts are needed.
+
+        **Arguments:**
+
+        - `term` (str)
+        - `postdb` (|PostDB|)
+        - `k` (int)
+
+        **Returns:** [(float, |Post|)]
+        """
+
+        entry = self._entry(term, postdb)
+        best = entry[6]
+        if best is None or (len(best) < k and len(best) < len(entry[4])):
+            best = rank_posts(entry[3], entry[4], k)
+            entry[6] = best
+        return best[:k]
+
+    def stats(self):
+        """Returns statistics about the cache.
+
+        **Returns:** {str: int | float} -- The number of cached results
+        (``'size'``), `max_size` (``'max_size'``), the number of hits
+        (``'hits'``) and misses (``'misses'``), and the ratio of the hits to
+        all lookups (``'hit_rate'``, 0.0 if there was no lookup).
+        """
+
+        lookups = self._hits + self._misses
+        if lookups == 0:
+            hit_rate = 0.0
+        else:
+            hit_rate = float(self._hits) / lookups
+        return {'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': hit_rate}
@@ -173,6 +173,8 @@ types in the documentation so we can talk about them easily.
   Real type: str
 """
 
+from __future__ import with_statement
+
 console_help = """\
 Types
 -----
@@ -257,6 +259,7 @@ import hkconfig
 import hkemail
 import hklib
 import hkgen
+import hksearch
 
 
 ##### Callbacks #####
@@ -640,7 +643,9 @@ def postset_operation(operation):
                 return
             event('postset_calculated', command, postset=posts)
             if len(posts) != 0:
-                result = operation(posts, *args, **kw)
+                # The listeners of the post database are notified only once
+                with postdb().batch():
+                    result = operation(posts, *args, **kw)
         finally:
             event('after', command, postset=posts)
         return result
@@ -696,6 +701,8 @@ class ModificationListener(object):
             self._posts = self._postdb.postset([])
         elif isinstance(e, hklib.PostDBEvent) and e.type == 'touch':
             self._posts.add(e.post)
+        elif isinstance(e, hklib.PostDBEvent) and e.type == 'batch_touch':
+            self._posts.update(e.posts)
 
     def touched_posts(self):
         """Returns the posts modified since the beginning of the latest
@@ -762,6 +769,8 @@ class PostPageListener(object):
             self._posts.remove(e.post)
         elif isinstance(e, hklib.PostDBEvent) and e.type == 'touch':
             self._posts.add(e.post)
+        elif isinstance(e, hklib.PostDBEvent) and e.type == 'batch_touch':
+            self._posts.update(e.posts)
 
     def outdated_post_pages(self):
         """Returns the posts whose post pages are outdated.
@@ -1421,7 +1430,16 @@ def edit_posts(pps):
     - `pps` (|PrePostSet|)
     """
 
-    posts = pps.sorted_list()
+    # Only the posts that have their own post files can be edited
+    posts = []
+    for post in pps.sorted_list():
+        if isinstance(postdb().storage(post.heap_id()),
+                      hklib.DirectoryHeapStorage):
+            posts.append(post)
+        else:
+            hkutils.log('Post "%s" is not stored in a post file, it cannot '
+                        'be edited.' % (post.post_id_str(),))
+
     if posts == []:
         hkutils.log('No post to edit.')
     else:
@@ -1772,6 +1790,9 @@ def cSr(posts):
 def grep(pattern, pps=None):
     """Searches for `pattern` in `pps`.
 
+    If the post database is large enough, the posts are searched in parallel
+    by its search pool (see :func:`hksearch.enable_parallel_search`).
+
     **Arguments:**
 
     - `pattern` (str) -- Regular expression.
@@ -1802,15 +1823,33 @@ def grep(pattern, pps=None):
         ps = postdb().postset(pps)
 
     r = re.compile(pattern)
+
+    # If the post database is large enough, the posts are searched by its
+    # search pool
+    pool = hksearch.parallel_search_pool(postdb())
+    if pool is not None:
+        post_ids = pool.search(hksearch.parallel_fields, pattern, 0)
+        return ps.collect(lambda post: post.post_id() in post_ids)
+
+    # If the post database has a search index, only the posts in `candidates`
+    # can match the pattern in their subject or body
+    index = hksearch.search_indexes.get(postdb())
+    if index is None:
+        candidates = None
+    else:
+        candidates = \
+            index.regexp_candidates(hksearch.trigram_fields, pattern, 0)
+
     def has_pattern(post):
         if (r.search(post.author()) or
-            r.search(post.subject()) or
             r.search(post.messid()) or
             r.search(post.date_str()) or
             r.search(post.parent()) or
-            r.search(post.post_id_str()) or
-            r.search(post.body())):
+            r.search(post.post_id_str())):
             return True
+        if candidates is None or post.post_id() in candidates:
+            if r.search(post.subject()) or r.search(post.body()):
+                return True
         for tag in post.tags():
             if r.search(tag):
                 return True
@@ -1854,6 +1893,15 @@ def read_postdb(configfile):
     hkconfig.unify_config(configdict)
     postdb = hklib.PostDB()
     postdb.read_config(configdict)
+    postdb_config = configdict.get('postdb', {})
+    if postdb_config.get('search_index', False):
+        hksearch.enable_index(postdb)
+    search_processes = postdb_config.get('search_processes', 0)
+    if search_processes != 1:
+        hksearch.enable_parallel_search(
+            postdb, search_processes,
+            postdb_config.get('parallel_search_min_posts',
+                              hksearch.DEFAULT_PARALLEL_SEARCH_MIN_POSTS))
 
     # If there is only one heap, select it
     if len(postdb.heap_ids()) == 1:
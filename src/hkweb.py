@@ -51,6 +51,7 @@ import re
 import socket
 import sys
 import threading
+import urllib
 import web as webpy
 
 import hkutils
@@ -78,6 +79,13 @@ urls = [
     r'/search.*', 'Search',
     ]
 
+# Caches the results of the search terms used on the search page. Its
+# statistics can be obtained with ``search_cache.stats()``.
+search_cache = hksearch.QueryCache()
+
+# The default number of search results shown on a search page
+SEARCH_PAGE_SIZE = 50
+
 
 ##### HTTP basic authentication #####
 
@@ -679,6 +687,41 @@ class SearchPageGenerator(PostPageGenerator):
         # Printing the page
         return self.print_postitems(xpostitems)
 
+    def print_page_links(self, term, offset, limit, found):
+        """Prints the links to the previous and the next page of the search
+        results.
+
+        **Arguments:**
+
+        - `term` (str) -- The search term.
+        - `offset` (int) -- The index of the first result on the current
+          page.
+        - `limit` (int) -- The number of results on a page.
+        - `found` (int) -- The number of all results.
+
+        **Returns:** |HtmlText|
+        """
+
+        def page_url(page_offset):
+            query = urllib.urlencode([('term', term),
+                                      ('offset', page_offset),
+                                      ('limit', limit)])
+            return '/search?' + query.replace('&', '&amp;')
+
+        links = []
+        if offset > 0:
+            previous_offset = max(0, min(offset, found) - limit)
+            links.append(self.print_link(page_url(previous_offset),
+                                         'Previous page'))
+        if offset + limit < found:
+            if len(links) > 0:
+                links.append(' | ')
+            links.append(self.print_link(page_url(offset + limit),
+                                         'Next page'))
+        if len(links) == 0:
+            return ''
+        return self.enclose(links, 'div', 'page-links')
+
     def print_search_page(self):
         """Prints the search page.
 
@@ -834,6 +877,10 @@ class Search(HkPageServer):
     """Serves the search pages.
 
     Served URL: ``/search``
+
+    The results of a search term are ordered by their score (see
+    :func:`hksearch.Query.score`) and shown page by page; the page is
+    specified by the ``offset`` and ``limit`` query parameters.
     """
 
     def __init__(self):
@@ -849,9 +896,21 @@ class Search(HkPageServer):
         try:
             args = get_web_args()
             preposts = self.get_posts(args)
+            offset, limit = self.get_page_args(args)
         except hkutils.HkException, e:
             return str(e)
 
+        # The results of a search term are shown page by page, ordered by
+        # their score
+        term = args.get('term')
+        paged = (args.get('posts') is None and preposts is not None)
+        if paged:
+            found = len(preposts)
+            preposts = \
+                [ post for _, post in
+                  search_cache.ranked_search(term, self._postdb,
+                                             offset + limit)[offset:] ]
+
         if preposts is None:
             # `preposts` is None if there was no search performed. However, in
             # this function, we want to have `preposts` as a list of preposts,
@@ -866,7 +925,9 @@ class Search(HkPageServer):
             show = 'normal'
 
         generator = SearchPageGenerator(self._postdb, preposts)
-        if (show == 'normal' and len(generator.posts) == 0):
+        if not paged:
+            found = len(generator.posts)
+        if show == 'normal' and found == 0:
             show = 'no_post_found'
 
         if show == 'no_search':
@@ -876,12 +937,24 @@ class Search(HkPageServer):
         elif show == 'normal':
             active = len(generator.posts)
             all = len(generator.posts.exp())
-            numbers = ('Posts found: %d<br/>'
-                       'All posts shown: %d' % (active, all))
+            if paged:
+                if active > 0:
+                    page_range = '%d-%d' % (offset + 1, offset + active)
+                else:
+                    page_range = 'none'
+                numbers = ('Posts found: %d<br/>'
+                           'Posts on this page: %s<br/>'
+                           'All posts shown: %d' % (found, page_range, all))
+                page_links = \
+                    generator.print_page_links(term, offset, limit, found)
+            else:
+                numbers = ('Posts found: %d<br/>'
+                           'All posts shown: %d' % (active, all))
+                page_links = ''
             numbers_box = generator.enclose(numbers, 'div', 'info-box')
-            main_content = (numbers_box, generator.print_search_page())
+            main_content = (numbers_box, page_links,
+                            generator.print_search_page(), page_links)
 
-        term = args.get('term')
         if term is not None:
             # We use json to make sure that `term` is represented in a format
             # readable by JavaScript
@@ -911,8 +984,8 @@ class Search(HkPageServer):
 
         If the ``posts`` query parameter is specified, the posts described in
         that will be returned. If the ``term`` query parameter is specified,
-        the result of that query will be returned. Otherwise ``None`` will be
-        returned.
+        the result of that query will be returned (see `search_cache`).
+        Otherwise ``None`` will be returned.
 
         **Returns:** |PostSet| | ``None``
         """
@@ -923,10 +996,33 @@ class Search(HkPageServer):
 
         term = args.get('term')
         if term is not None:
-            return hksearch.search(term, self._postdb.all())
+            return search_cache.search(term, self._postdb)
 
         return None # only the search bar will be shown
 
+    def get_page_args(self, args):
+        """Gets the page of the search results to be displayed.
+
+        The page is specified by the ``offset`` and ``limit`` query
+        parameters. The default offset is 0, the default limit is
+        `SEARCH_PAGE_SIZE`.
+
+        **Returns:** (int, int) -- The offset and the limit.
+        """
+
+        try:
+            offset = int(args.get('offset', 0))
+            limit = int(args.get('limit', SEARCH_PAGE_SIZE))
+        except (TypeError, ValueError):
+            raise hkutils.HkException(
+                      'Error: the "offset" and "limit" parameters should be '
+                      'integers.')
+        if offset < 0 or limit < 1:
+            raise hkutils.HkException(
+                      'Error: the "offset" parameter should not be negative '
+                      'and the "limit" parameter should be positive.')
+        return offset, limit
+
     def GET(self):
         """Serves a HTTP GET request.
 
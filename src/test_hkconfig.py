@@ -134,6 +134,38 @@ class Test__config(unittest.TestCase):
               'nicknames': {},
               'accounts': {}})
 
+        # Testing the postdb section
+        self.assertEqual(
+             hkconfig.unify_config(
+                 {'paths': {'html_dir': '-html_dir'},
+                  'heaps': {},
+                  'postdb': {'load_processes': '4',
+                             'lazy_bodies': 'true',
+                             'max_resident_bodies': '1000',
+                             'search_index': 'false',
+                             'search_processes': '2',
+                             'parallel_search_min_posts': '100'}}),
+             {'paths': {'html_dir': '-html_dir'},
+              'heaps': {},
+              'postdb': {'load_processes': 4,
+                         'lazy_bodies': True,
+                         'max_resident_bodies': 1000,
+                         'search_index': False,
+                         'search_processes': 2,
+                         'parallel_search_min_posts': 100},
+              'nicknames': {},
+              'accounts': {}})
+        self.assertRaises(
+            hkutils.HkException,
+            lambda: hkconfig.unify_config(
+                        {'heaps': {},
+                         'postdb': {'lazy_bodies': 'yes'}}))
+        self.assertRaises(
+            hkutils.HkException,
+            lambda: hkconfig.unify_config(
+                        {'heaps': {},
+                         'postdb': {'search_index': '1'}}))
+
         # Testing several heaps
         self.assertRaises(
             KeyError,
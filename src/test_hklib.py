@@ -28,12 +28,14 @@ Usage:
 
 from __future__ import with_statement
 
+import datetime
 import itertools
 import os
 import os.path
 import shutil
 import StringIO
 import tempfile
+import time
 import unittest
 
 import hkutils
@@ -874,7 +876,8 @@ class Test_Post(unittest.TestCase, PostDBHandler):
         d4 = from_str('Date: Sun, 19 Oct 2008 18:56:36 +0200', 'my_heap/7')
         d5 = from_str('Date: Sun, 19 Oct 2008 18:56:36 +0200', 'my_heap/8')
 
-        order = [d1, d2, d3, n3, n2, n1, d4, d5]
+        # The posts without a date precede the posts with a date
+        order = [n3, n2, n1, d1, d2, d3, d4, d5]
         for p1, p2 in itertools.combinations(order, 2):
             self.assertTrue(p1 < p2)
             self.assertFalse(p2 < p1)
@@ -888,6 +891,36 @@ class Test_Post(unittest.TestCase, PostDBHandler):
             self.assertTrue(p1 != p2)
             self.assertFalse(p2 == p1)
             self.assertFalse(p1 == p2)
+        self.assertEqual(sorted(reversed(order)), order)
+        self.assertEqual(sorted(order, key=hklib.Post.sort_key), order)
+
+    def test_sort_key(self):
+        """Tests the following functions:
+
+        - :func:`hklib.Post.timestamp`
+        - :func:`hklib.Post.date_str`
+        - :func:`hklib.Post.sort_key`
+        """
+
+        p = hklib.Post.from_str('Date: Thu, 16 Oct 2008 18:56:36 +0200',
+                                'my_heap/3')
+        timestamp = int(hkutils.calc_timestamp(p.date()))
+        self.assertEqual(p.timestamp(), timestamp)
+        self.assertEqual(p.sort_key(), (timestamp, ('my_heap', '3')))
+        date_str = p.date_str()
+        self.assertNotEqual(date_str, '')
+
+        # The cached values are recalculated when the date changes
+        p.set_date('Fri, 17 Oct 2008 18:56:36 +0200')
+        self.assertEqual(p.timestamp(), timestamp + 24 * 60 * 60)
+        self.assertEqual(p.sort_key(), (timestamp + 24 * 60 * 60,
+                                        ('my_heap', '3')))
+        self.assertNotEqual(p.date_str(), date_str)
+
+        p.set_date('')
+        self.assertEqual(p.timestamp(), 0)
+        self.assertEqual(p.date_str(), '')
+        self.assertEqual(p.sort_key(), (0, ('my_heap', '3')))
 
     def test__filenames(self):
         """Tests the following functions:
@@ -1234,6 +1267,248 @@ class Test_PostDB(unittest.TestCase, PostDBHandler):
             postdb.next_post_index('my_new_heap'),
             '2')
 
+    def test_snapshot(self):
+        """Tests the following functions:
+
+        - :func:`hklib.PostDB.load_heap`
+        - :func:`hklib.PostDB.read_snapshot`
+        - :func:`hklib.PostDB.write_snapshot`
+        """
+
+        postdb = self._postdb
+        postdb.save()
+        cache_dir = os.path.join(self._dir, 'cache_dir')
+        os.mkdir(cache_dir)
+        postdb.set_cache_dir(cache_dir)
+        snapshot_file = postdb.snapshot_file_name('my_heap')
+        self.assertEqual(
+            snapshot_file,
+            os.path.join(cache_dir, 'my_heap.snapshot'))
+
+        # Loading the heap creates the snapshot
+        postdb.load_heap('my_heap')
+        self.assertTrue(os.path.exists(snapshot_file))
+        snapshot = postdb.read_snapshot('my_heap')
+        self.assertEqual(
+            sorted(snapshot.keys()),
+            ['0', '1', '2', '3', '4'])
+        stamp, header, body, body_offset = snapshot['1']
+        self.assertEqual(header, self.p(1)._header)
+        self.assertEqual(body, 'body1\n')
+        self.assertEqual(body_offset, self.p(1)._body_offset)
+
+        # The snapshot entry is used if the post file did not change. (We
+        # prove that by modifying the entry.)
+        header['Subject'] = 'from snapshot'
+        postdb.write_snapshot('my_heap', snapshot)
+        postdb.load_heap('my_heap')
+        self.assertEqual(self.p(1).subject(), 'from snapshot')
+
+        # The post file is parsed again if it changed
+        hkutils.string_to_file(
+            'Subject: changed\n\nbody1',
+            os.path.join(self._myheap_dir, '1.post'))
+        postdb.load_heap('my_heap')
+        self.assertEqual(self.p(1).subject(), 'changed')
+        self.assertEqual(
+            postdb.read_snapshot('my_heap')['1'][1]['Subject'],
+            'changed')
+
+        # Removed post files are removed from the snapshot
+        os.remove(os.path.join(self._myheap_dir, '4.post'))
+        postdb.load_heap('my_heap')
+        self.assertEqual(self.p(4), None)
+        self.assertEqual(
+            sorted(postdb.read_snapshot('my_heap').keys()),
+            ['0', '1', '2', '3'])
+
+        # A corrupt snapshot is ignored
+        hkutils.string_to_file('corrupt', snapshot_file)
+        postdb.load_heap('my_heap')
+        self.assertEqual(
+            self.pop_log(),
+            'Warning: corrupt snapshot file ignored: "%s"' % (snapshot_file,))
+        self.assertEqual(self.p(1).subject(), 'changed')
+        self.assertEqual(
+            sorted(postdb.read_snapshot('my_heap').keys()),
+            ['0', '1', '2', '3'])
+
+        # The snapshot of another heap directory is not used
+        postdb._heaps['my_heap'] = self._myotherheap_dir
+        self.assertEqual(postdb.read_snapshot('my_heap'), {})
+
+    def test_load_heaps(self):
+        """Tests the following functions:
+
+        - :func:`hklib.PostDB.load_heaps`
+        - :func:`hklib.PostDB.parse_posts`
+        - :func:`hklib.PostDB.set_load_processes`
+        - :func:`hklib.parse_post_file`
+        - :func:`hklib.read_post_body`
+        """
+
+        postdb = self._postdb
+        postdb.save()
+
+        def post_data():
+            return sorted([ (post.post_id(), post._header, post._body)
+                            for post in postdb.all() ])
+
+        postdb.load_heaps(['my_heap', 'my_other_heap'])
+        serial_data = post_data()
+
+        # Loading the heaps with several processes gives the same result
+        old_min_files = hklib.MIN_FILES_PER_LOAD_PROCESS
+        hklib.MIN_FILES_PER_LOAD_PROCESS = 1
+        try:
+            postdb.set_load_processes(2)
+            postdb.load_heaps(['my_heap', 'my_other_heap'])
+            self.assertEqual(post_data(), serial_data)
+
+            # Errors are reported by the parent process
+            hkutils.string_to_file(
+                'Incorrect line\n\nbody',
+                os.path.join(self._myheap_dir, '1.post'))
+            self.assertRaises(
+                hkutils.HkException,
+                lambda: postdb.load_heaps(['my_heap', 'my_other_heap']))
+        finally:
+            hklib.MIN_FILES_PER_LOAD_PROCESS = old_min_files
+
+        self.assertEqual(
+            hklib.parse_post_file(os.path.join(self._myheap_dir, '1.post')),
+            (None, 'Error parsing the following line: "Incorrect line"',
+             None))
+        post2_file = os.path.join(self._myheap_dir, '2.post')
+        body_offset = hkutils.file_to_string(post2_file).index('\n\n') + 2
+        raw_header = \
+            {'Parent': ['1@'], 'Author': ['author2'],
+             'Subject': ['subject2'], 'Message-Id': ['2@'],
+             'Date': ['Wed, 20 Aug 2008 17:41:02 +0200']}
+        self.assertEqual(
+            hklib.parse_post_file(post2_file),
+            (raw_header, 'body2\n', body_offset))
+        self.assertEqual(
+            hklib.parse_post_file(post2_file, read_body=False),
+            (raw_header, None, body_offset))
+        self.assertEqual(
+            hklib.read_post_body(post2_file, body_offset),
+            'body2\n')
+
+        # 0 means the number of CPUs
+        postdb.set_load_processes(0)
+        self.assertTrue(postdb._load_processes >= 1)
+
+    def test_lazy_bodies(self):
+        """Tests the following functions:
+
+        - :func:`hklib.PostDB.set_lazy_bodies`
+        - :func:`hklib.PostDB.notify_body_loaded`
+        - :func:`hklib.Post.body`
+        - :func:`hklib.Post.is_body_loaded`
+        - :func:`hklib.Post.unload_body`
+        """
+
+        postdb = self._postdb
+        postdb.save()
+        postdb.set_lazy_bodies(True, max_resident_bodies=2)
+        postdb.load_heap('my_heap')
+
+        # The existing posts keep their bodies
+        self.assertTrue(self.p(1).is_body_loaded())
+
+        # New post objects do not read their bodies until needed
+        postdb = hklib.PostDB()
+        postdb.set_lazy_bodies(True, max_resident_bodies=2)
+        postdb.add_heap('my_heap', self._myheap_dir)
+        self._postdb = postdb
+        for i in range(5):
+            self.assertFalse(self.p(i).is_body_loaded())
+            self.assertFalse(self.p(i).is_modified())
+
+        # Threading does not need the bodies
+        self.assertEqual(postdb.root(self.p(2)), self.p(0))
+        self.assertFalse(self.p(2).is_body_loaded())
+
+        # Bodies are read on demand
+        self.assertEqual(self.p(1).body(), 'body1\n')
+        self.assertEqual(self.p(2).meta_dict(), {})
+        self.assertTrue(self.p(1).is_body_loaded())
+        self.assertTrue(self.p(2).is_body_loaded())
+
+        # The earliest read body is dropped when there are too many
+        self.p(4).body()
+        self.assertFalse(self.p(1).is_body_loaded())
+        self.assertTrue(self.p(2).is_body_loaded())
+        self.assertTrue(self.p(4).is_body_loaded())
+        self.assertEqual(self.p(1).body(), 'body1\n')
+        self.assertFalse(self.p(2).is_body_loaded())
+
+        # A body read again after unloading it is counted only once; removed
+        # posts are forgotten
+        self.assertTrue(self.p(4).unload_body())
+        self.assertEqual(postdb._resident_bodies.keys(), [self.p(1)])
+        self.p(4).body()
+        self.p(4).unload_body()
+        self.p(4).body()
+        self.assertEqual(len(postdb._resident_bodies), 2)
+        self.assertTrue(self.p(1).is_body_loaded())
+        self.assertTrue(self.p(4).is_body_loaded())
+        p1 = self.p(1)
+        postdb.remove_post_from_dicts(p1)
+        self.assertEqual(postdb._resident_bodies.keys(), [self.p(4)])
+        postdb.add_post_to_dicts(p1)
+        self.assertTrue(self.p(1).unload_body())
+        self.p(2).body()
+        self.p(1).body()
+        self.assertFalse(self.p(4).is_body_loaded())
+        self.p(4).body()
+        self.assertFalse(self.p(2).is_body_loaded())
+        self.assertEqual(
+            sorted(postdb._resident_bodies.keys()), [self.p(1), self.p(4)])
+        self.assertTrue(len(postdb._resident_order) <=
+                        2 * len(postdb._resident_bodies))
+
+        # Modified posts keep their bodies
+        self.p(3).set_body('new body3')
+        self.p(4).set_subject('new subject4')
+        self.p(0).body()
+        self.p(2).body()
+        self.assertTrue(self.p(3).is_body_loaded())
+        self.assertTrue(self.p(4).is_body_loaded())
+        self.assertFalse(self.p(4).unload_body())
+
+        # Saving a post whose body has not been read keeps the body
+        self.assertTrue(self.p(0).unload_body())
+        self.p(0).set_subject('new subject0')
+        postdb.save()
+        self.assertEqual(
+            self.p(0).postfile_str(),
+            hkutils.file_to_string(self.p(0).postfilename()))
+        self.assertEqual(self.p(0).body(), 'body0\n')
+        self.assertFalse(self.p(0).unload_body())
+        self.assertEqual(self.p(3).body(), 'new body3\n')
+
+        # Reloading
+        hkutils.string_to_file(
+            'Subject: subject1\n\nchanged body1',
+            os.path.join(self._myheap_dir, '1.post'))
+        self.p(2).set_body('modified body2')
+        postdb.load_heap('my_heap')
+        self.assertEqual(self.p(1).body(), 'changed body1\n')
+        self.assertEqual(self.p(2).body(), 'body2\n')
+
+        # A body whose post file has changed since the post was read is not
+        # read from its old position
+        self.assertTrue(self.p(0).unload_body())
+        hkutils.string_to_file(
+            'Subject: a much longer subject line here\nAuthor: x\n\n'
+            'changed body0',
+            os.path.join(self._myheap_dir, '0.post'))
+        self.assertRaises(hkutils.HkException, self.p(0).body)
+        postdb.reload()
+        self.assertEqual(self.p(0).body(), 'changed body0\n')
+
     def test_add_heap(self):
         """Tests :func:`add_heap`."""
 
@@ -1306,6 +1581,25 @@ class Test_PostDB(unittest.TestCase, PostDBHandler):
             postdb._html_dir,
             html_dir_2)
 
+    def test_set_cache_dir(self):
+        """Tests :func:`set_cache_dir`."""
+
+        postdb = self._postdb
+        self.assertEqual(postdb.cache_dir(), None)
+        self.assertEqual(postdb.snapshot_file_name('my_heap'), None)
+        self.assertEqual(postdb.read_snapshot('my_heap'), {})
+
+        # Non-existing directory
+        cache_dir = os.path.join(self._dir, 'cache_dir')
+        postdb.set_cache_dir(cache_dir)
+        self.assertEqual(postdb.cache_dir(), cache_dir)
+        self.assertTrue(os.path.isdir(cache_dir))
+        self.assertEqual(
+            self.pop_log(),
+            ('Warning: cache directory does not exists: "%s"\n'
+             'Cache directory has been created.'
+             % (cache_dir,)))
+
     def test_get_heaps_from_config(self):
         """Tests :func:`hklib.PostDB.get_heaps_from_config`."""
 
@@ -1561,6 +1855,129 @@ class Test_PostDB(unittest.TestCase, PostDBHandler):
             'Subject: sub1\n\n\n')
         self.assertEqual(postdb.post('my_heap/x').subject(), 'sub_new')
 
+    def test_load_heaps_events(self):
+        """Tests that :func:`hklib.PostDB.load_heaps` and
+        :func:`hklib.PostDB.move` notify the listeners only about the posts
+        that changed."""
+
+        postdb = self._postdb
+        postdb.save()
+        events = []
+        def listener(e):
+            if e.type == 'batch_touch':
+                post_ids = sorted([ post.post_id_str() for post in e.posts ])
+                events.append((e.type, post_ids))
+            elif e.type == 'touch':
+                events.append((e.type, e.post.post_id_str()))
+            else:
+                events.append(e.type)
+        postdb.listeners.append(listener)
+
+        # Nothing has changed
+        postdb.load_heap('my_heap')
+        self.assertEqual(events, [])
+
+        # A changed, a new and a removed post file
+        hkutils.string_to_file(
+            'Subject: new subject\nMessage-Id: 1@\n\nbody1',
+            os.path.join(self._myheap_dir, '1.post'))
+        hkutils.string_to_file(
+            'Subject: s5\nMessage-Id: 5@',
+            os.path.join(self._myheap_dir, '5.post'))
+        os.remove(os.path.join(self._myheap_dir, '4.post'))
+        postdb.load_heap('my_heap')
+        self.assertEqual(
+            events,
+            [('batch_touch', ['my_heap/1', 'my_heap/4', 'my_heap/5'])])
+        self.assertEqual(self.p(1).subject(), 'new subject')
+        self.assertEqual(self.p(4), None)
+
+        # Moving a post
+        del events[:]
+        postdb.move(self.p(3), 'my_heap/moved', placeholder=True)
+        self.assertEqual(
+            events,
+            [('touch', 'my_heap/moved'),
+             ('touch', 'my_heap/3'), # the placeholder is deleted
+             ('batch_touch', ['my_heap/3', 'my_heap/moved'])])
+
+    def test_reload_heaps(self):
+        """Tests :func:`hklib.PostDB.reload_heaps`."""
+
+        postdb = self._postdb
+        postdb.save()
+        p0 = self.p(0)
+        p1 = self.p(1)
+
+        events = []
+        def listener(e):
+            if e.type == 'batch_touch':
+                events.extend([ post.post_id_str() for post in e.posts ])
+            else:
+                events.append(e.post.post_id_str())
+        postdb.listeners.append(listener)
+
+        # Nothing has changed
+        postdb.reload_heaps(['my_heap'])
+        self.assertEqual(events, [])
+        self.assertTrue(self.p(0) is p0)
+
+        # A changed, a new and a removed post file, and a modified post
+        hkutils.string_to_file(
+            'Subject: new subject\nMessage-Id: 1@\n\nbody1',
+            os.path.join(self._myheap_dir, '1.post'))
+        hkutils.string_to_file(
+            'Subject: s5\nMessage-Id: 5@',
+            os.path.join(self._myheap_dir, '5.post'))
+        os.remove(os.path.join(self._myheap_dir, '4.post'))
+        self.p(3).set_subject('unsaved subject')
+        del events[:]
+
+        postdb.reload_heaps(['my_heap'])
+        self.assertEqual(
+            sorted(events),
+            ['my_heap/1', 'my_heap/3', 'my_heap/4', 'my_heap/5'])
+        self.assertTrue(self.p(1) is p1)
+        self.assertEqual(p1.subject(), 'new subject')
+        self.assertFalse(p1.is_modified())
+        self.assertEqual(self.p(3).subject(), 'subject3')
+        self.assertFalse(self.p(3).is_modified())
+        self.assertEqual(self.p(4), None)
+        self.assertEqual(postdb.post_by_messid('5@'), self.p(5))
+        self.assertEqual(postdb.next_post_index('my_heap'), '6')
+
+        # Saved posts are not read again
+        p1.set_subject('saved subject')
+        postdb.save()
+        del events[:]
+        postdb.reload_heaps(['my_heap'])
+        self.assertEqual(events, [])
+        self.assertEqual(p1.subject(), 'saved subject')
+
+        # With lazy bodies, the posts whose bodies are not loaded are not
+        # touched if only their post files were rewritten, and their bodies
+        # are not read
+        postdb = hklib.PostDB()
+        postdb.set_lazy_bodies(True, max_resident_bodies=1)
+        postdb.add_heap('my_heap', self._myheap_dir)
+        self._postdb = postdb
+        postdb.listeners.append(listener)
+        p2 = self.p(2)
+        for i in ('0', '2', '3'):
+            post_file = os.path.join(self._myheap_dir, i + '.post')
+            hkutils.string_to_file(
+                hkutils.file_to_string(post_file), post_file)
+            os.utime(post_file, (0, 0))
+        hkutils.string_to_file(
+            'Subject: new subject\nMessage-Id: 1@\n\nnew body1',
+            os.path.join(self._myheap_dir, '1.post'))
+        postdb.reload_heaps(['my_heap'])
+        self.assertEqual(events, ['my_heap/1'])
+        self.assertFalse(p2.is_body_loaded())
+        self.assertEqual(p2.body(), 'body2\n')
+        self.assertEqual(self.p(1).body(), 'new body1\n')
+        self.assertEqual(len(postdb._resident_bodies), 1)
+
     def test_add_new_post(self):
         """Tests :func:`hklib.PostDB.add_new_post`."""
 
@@ -1700,6 +2117,152 @@ class Test_PostDB(unittest.TestCase, PostDBHandler):
               ('new_heap', '4'): [('new_heap', '5')]}
         self.assertEqual(postdb.threadstruct(), ts)
 
+    def test_threadstruct_incremental(self):
+        """Tests that the thread structure is patched correctly when posts
+        change."""
+
+        postdb = self._postdb
+
+        def check(expected_ts):
+            ts = postdb.threadstruct()
+            self.assertEqual(ts, expected_ts)
+            # The patched thread structure is the same as the recalculated
+            # one
+            postdb.touch()
+            self.assertEqual(postdb.threadstruct(), ts)
+
+        # Changes that do not affect the thread structure keep it and the
+        # related data
+        ts = postdb.threadstruct()
+        roots = postdb.roots()
+        all = postdb.all()
+        self.p(1).set_tags(['tag'])
+        self.p(1).set_subject('other subject')
+        self.assertTrue(postdb.threadstruct() is ts)
+        self.assertTrue(postdb.roots() is roots)
+        self.assertTrue(postdb.all() is all)
+
+        # Changing the parent
+        self.p(3).set_parent(self.i(2)[1])
+        self.assertTrue(postdb.all() is all)
+        check({None: [self.i(0), self.io(0), self.i(4)],
+               self.i(0): [self.i(1)],
+               self.i(1): [self.i(2)],
+               self.i(2): [self.i(3)]})
+
+        # Changing the date
+        self.p(1).set_date('Wed, 20 Aug 2008 17:41:40 +0200')
+        self.p(0).set_date('Wed, 20 Aug 2008 17:41:50 +0200')
+        check({None: [self.io(0), self.i(4), self.i(0)],
+               self.i(0): [self.i(1)],
+               self.i(1): [self.i(2)],
+               self.i(2): [self.i(3)]})
+
+        # Referring to a post by its messid
+        self.p(4).set_parent('other0@')
+        check({None: [self.io(0), self.i(0)],
+               self.io(0): [self.i(4)],
+               self.i(0): [self.i(1)],
+               self.i(1): [self.i(2)],
+               self.i(2): [self.i(3)]})
+        self.po(0).set_messid('other1@')
+        check({None: [self.io(0), self.i(4), self.i(0)],
+               self.i(0): [self.i(1)],
+               self.i(1): [self.i(2)],
+               self.i(2): [self.i(3)]})
+        self.po(0).set_messid('other0@')
+
+        # Deleting and adding posts
+        self.p(1).delete()
+        check({None: [self.io(0), self.i(2), self.i(0)],
+               self.i(2): [self.i(3)],
+               self.io(0): [self.i(4)]})
+        self.add_post(5, 2)
+        self.add_post(6, 5)
+        check({None: [self.io(0), self.i(2), self.i(0)],
+               self.i(2): [self.i(3), self.i(5)],
+               self.i(5): [self.i(6)],
+               self.io(0): [self.i(4)]})
+
+    def test_touch_fields(self):
+        """Tests that :func:`hklib.PostDB.touch` passes on the modified
+        fields."""
+
+        postdb = self._postdb
+        events = []
+        postdb.listeners.append(lambda e: events.append(e.fields))
+
+        ts = postdb.threadstruct()
+        sort_key = self.p(1).sort_key()
+        self.p(1).set_tags(['tag'])
+        self.p(1).set_body('new body')
+        # The cached sort key is kept if the date is not modified
+        self.assertTrue(self.p(1)._sort_key is sort_key)
+        self.p(1).set_parent('')
+        self.p(1).touch()
+        self.assertEqual(
+            events,
+            [frozenset(['tags']), frozenset(['body']), frozenset(['parent']),
+             None])
+
+        # Modifying the tags does not concern the thread structure, while
+        # modifying the parent does
+        self.assertEqual(ts[None], [self.i(0), self.io(0), self.i(4)])
+        self.assertEqual(
+            postdb.threadstruct()[None],
+            [self.i(0), self.io(0), self.i(1), self.i(4)])
+
+    def test_batch(self):
+        """Tests :func:`hklib.PostDB.batch`."""
+
+        postdb = self._postdb
+        events = []
+        postdb.listeners.append(events.append)
+
+        with postdb.batch():
+            self.p(1).set_tags(['tag'])
+            with postdb.batch():
+                self.p(1).set_subject('subject')
+                self.p(2).set_parent('')
+            # The post database is up-to-date inside the block
+            self.assertEqual(postdb.parent(self.p(2)), None)
+            self.assertEqual(events, [])
+            self.assertEqual(
+                postdb.pending_touched(),
+                {self.p(1): frozenset(['tags', 'subject']),
+                 self.p(2): frozenset(['parent'])})
+        self.assertEqual(postdb.pending_touched(), {})
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].type, 'batch_touch')
+        self.assertEqual(events[0].posts,
+                         postdb.postset([self.p(1), self.p(2)]))
+        self.assertEqual(events[0].fields,
+                         frozenset(['tags', 'subject', 'parent']))
+
+        # An exception inside the block
+        del events[:]
+        try:
+            with postdb.batch():
+                self.p(3).touch()
+                raise hkutils.HkException('error')
+        except hkutils.HkException:
+            pass
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].posts, postdb.postset([self.p(3)]))
+        self.assertEqual(events[0].fields, None)
+
+        # Nothing is sent if no post was touched
+        del events[:]
+        with postdb.batch():
+            pass
+        self.assertEqual(events, [])
+
+        # Touching the whole database is not collected
+        with postdb.batch():
+            postdb.touch()
+            self.assertEqual([ e.type for e in events ], ['touch_all'])
+
     def test_parent(self):
         """Tests :func:`hklib.PostDB.parent`."""
 
@@ -1712,6 +2275,16 @@ class Test_PostDB(unittest.TestCase, PostDBHandler):
         self.assertEqual(postdb.parent(self.p(4)), None)
         self.assertEqual(postdb.parent(self.po(0)), None)
 
+        # Dangling reference that is resolved when the parent is added
+        self.p(4).set_parent('5@')
+        self.assertEqual(postdb.parent(self.p(4)), None)
+        self.add_post(5)
+        self.assertEqual(postdb.parent(self.p(4)), self.p(5))
+
+        # Deleted parent
+        self.p(5).delete()
+        self.assertEqual(postdb.parent(self.p(4)), None)
+
     def test_root(self):
         """Tests :func:`hklib.PostDB.parent`."""
 
@@ -1744,6 +2317,65 @@ class Test_PostDB(unittest.TestCase, PostDBHandler):
         self.assertEqual(postdb.root(self.p(6)), None)
         self.assertEqual(postdb.root(self.p(7)), None)
 
+    def test_depth(self):
+        """Tests :func:`hklib.PostDB.depth`."""
+
+        postdb = self._postdb
+
+        self.assertEqual(postdb.depth(self.p(0)), 0)
+        self.assertEqual(postdb.depth(self.p(1)), 1)
+        self.assertEqual(postdb.depth(self.p(2)), 2)
+        self.assertEqual(postdb.depth(self.p(3)), 1)
+        self.assertEqual(postdb.depth(self.po(0)), 0)
+
+        # The index is updated when the thread structure changes
+        self.p(1).set_parent('')
+        self.assertEqual(postdb.depth(self.p(2)), 1)
+        self.assertEqual(postdb.root(self.p(2)), self.p(1))
+
+        self.introduce_cycle()
+        self.assertEqual(postdb.depth(self.p(3)), None)
+        self.assertEqual(postdb.depth(self.p(7)), None)
+
+    def test_thread_arrays(self):
+        """Tests the handles of the posts and
+        :func:`hklib.PostDB._recalc_thread_arrays`."""
+
+        postdb = self._postdb
+
+        def h(post):
+            return postdb._handles[post.post_id()]
+
+        # Each post has a different handle
+        posts = postdb.real_posts()
+        self.assertEqual(sorted([ h(post) for post in posts ]),
+                         range(len(posts)))
+        for post in posts:
+            self.assertTrue(postdb._handle_table[h(post)] is post)
+
+        def children(post):
+            postdb._recalc_thread_arrays()
+            _roots, offsets, child_handles = postdb._thread_arrays
+            return list(child_handles[offsets[h(post)]:offsets[h(post) + 1]])
+
+        postdb._recalc_thread_arrays()
+        roots, _offsets, _child_handles = postdb._thread_arrays
+        self.assertEqual(list(roots), [h(self.p(0)), h(self.po(0)),
+                                       h(self.p(4))])
+        self.assertEqual(children(self.p(0)), [h(self.p(1)), h(self.p(3))])
+        self.assertEqual(children(self.p(1)), [h(self.p(2))])
+        self.assertEqual(children(self.p(2)), [])
+
+        # A moved post keeps its handle; its old post id gets a new one
+        p1 = self.p(1)
+        old_handle = h(p1)
+        postdb.move(p1, 'my_heap/moved', placeholder=True)
+        self.assertEqual(h(p1), old_handle)
+        self.assertTrue(postdb._handle_table[old_handle] is p1)
+        self.assertEqual(h(self.p(1)), len(posts))
+        self.assertTrue(postdb._handle_table[len(posts)] is self.p(1))
+        self.assertEqual(children(self.p(0)), [h(p1), h(self.p(3))])
+
     def test_children(self):
         """Tests :func:`hklib.PostDB.children`."""
 
@@ -1806,6 +2438,14 @@ class Test_PostDB(unittest.TestCase, PostDBHandler):
             list(postdb.iter_thread(p(0), ts)),
             [p(0), p(1)])
 
+        # Threads deeper than the recursion limit can be iterated
+        self._skipdates = True
+        for i in range(5, 1505):
+            self.add_post(i, i - 1)
+        self.assertEqual(
+            list(postdb.iter_thread(p(4))),
+            [p(4)] + [p(i) for i in range(5, 1505)])
+
     def test_walk_thread(self):
         """Tests :func:`hklib.PostDB.walk_thread`."""
 
@@ -1912,6 +2552,36 @@ class Test_PostDB(unittest.TestCase, PostDBHandler):
             AssertionError,
             lambda: test(hklib.Post.from_str(''), []))
 
+        # Testing the `share_postitems` parameter: the same post item is
+        # yielded for the positions of a post
+
+        postitem_strings = []
+        postitem_ids = set()
+        for postitem in postdb.walk_thread(self.p(1), yield_inner=True,
+                                           share_postitems=True):
+            postitem_strings.append(str(postitem) + '\n')
+            postitem_ids.add(id(postitem))
+        self.assertEqual(
+            ''.join(postitem_strings),
+            ("<PostItem: pos=begin, post_id=my_heap/1, level=0>\n"
+             "<PostItem: pos=inner, post_id=my_heap/1, level=0>\n"
+               "<PostItem: pos=begin, post_id=my_heap/2, level=1>\n"
+               "<PostItem: pos=inner, post_id=my_heap/2, level=1>\n"
+               "<PostItem: pos=end, post_id=my_heap/2, level=1>\n"
+             "<PostItem: pos=end, post_id=my_heap/1, level=0>\n"))
+        self.assertEqual(len(postitem_ids), 2)
+
+        # Threads deeper than the recursion limit can be walked
+        self._skipdates = True
+        for i in range(5, 1505):
+            self.add_post(i, i - 1)
+        postitems = list(postdb.walk_thread(self.p(4)))
+        self.assertEqual(len(postitems), 3002)
+        self.assertEqual(postitems[1500],
+                         hklib.PostItem('begin', self.p(1504), 1500))
+        self.assertEqual(postitems[1501],
+                         hklib.PostItem('end', self.p(1504), 1500))
+
     def test_cycles(self):
         """Tests the following functions:
 
@@ -1933,6 +2603,55 @@ class Test_PostDB(unittest.TestCase, PostDBHandler):
             postdb.cycles(),
             postdb.postset([self.p(3), self.p(5), self.p(6), self.p(7)]))
 
+    def test_cycles_incremental(self):
+        """Tests that :func:`hklib.PostDB.cycles` is updated by
+        :func:`hklib.PostDB._update_cycles` without walking the whole thread
+        structure."""
+
+        postdb = self._postdb
+        p = self.p
+
+        def test(cycles):
+            self.assertEqual(postdb.cycles(),
+                             postdb.postset([ p(i) for i in cycles ]))
+            # The root handles are calculated only by a global walk
+            self.assertEqual(postdb._root_handles, None)
+
+        self.assertEqual(postdb.cycles(), postdb.postset([]))
+
+        # Creating a cycle; 3 hangs below it
+        p(0).set_parent('2')
+        test([0, 1, 2, 3])
+
+        # Moving a post out of the cycle and back
+        p(3).set_parent('4')
+        test([0, 1, 2])
+        p(3).set_parent('1')
+        test([0, 1, 2, 3])
+
+        # A post added below the cycle is also in the cycle
+        self.add_post(5, 3)
+        test([0, 1, 2, 3, 5])
+
+        # Moving the cycle below another cycle
+        self.add_post(6, 7)
+        self.add_post(7, 6)
+        test([0, 1, 2, 3, 5, 6, 7])
+        p(1).set_parent('6')
+        test([0, 1, 2, 3, 5, 6, 7])
+
+        # Breaking the cycles
+        p(6).set_parent('')
+        test([])
+
+        # Creating a cycle and breaking it by deleting a post
+        p(6).set_parent('0')
+        test([0, 1, 2, 3, 5, 6, 7])
+        p(2).delete()
+        test([])
+        p(0).set_parent('7')
+        test([0, 1, 3, 5, 6, 7])
+
     def test_walk_cycles(self):
         """Tests :func:`hklib.PostDB.walk_cycles`."""
 
@@ -2119,6 +2838,151 @@ class Test_PostDB(unittest.TestCase, PostDBHandler):
              po(0): postdb.postset([po(0)]),
              p(4): postdb.postset([p(4)])})
 
+    def test_referring_posts(self):
+        """Tests :func:`hklib.PostDB.referring_posts`."""
+
+        postdb = self._postdb
+        p = self.p
+        po = self.po
+
+        def test(post, expected_posts):
+            self.assertEqual(postdb.referring_posts(post),
+                             postdb.postset(expected_posts))
+
+        test(p(0), [p(1), p(3)])
+        test(p(4), [])
+
+        # Heap links
+        p(2).set_body('heap://0 heap://4')
+        po(0).set_body('heap://my_heap/4 heap://4')
+        test(p(0), [p(1), p(2), p(3)])
+        test(p(4), [p(2), po(0)])
+
+        # The index is updated when a body or a parent changes
+        p(2).set_body('heap://4')
+        p(3).set_parent('')
+        test(p(0), [p(1)])
+        p(2).delete()
+        test(p(4), [po(0)])
+
+    def test_field_indexes(self):
+        """Tests :func:`hklib.PostDB.posts_with_tag`,
+        :func:`hklib.PostDB.posts_by_author`,
+        :func:`hklib.PostDB.posts_in_heap` and the related functions."""
+
+        postdb = self._postdb
+        p = self.p
+        po = self.po
+
+        def test(posts, expected_posts):
+            self.assertEqual(posts, postdb.postset(expected_posts))
+
+        p(1).set_tags(['t1', 't2'])
+        p(2).add_tag('t1')
+        test(postdb.posts_with_tag('t1'), [p(1), p(2)])
+        test(postdb.posts_with_tag('t2'), [p(1)])
+        test(postdb.posts_with_tag('t3'), [])
+        test(postdb.posts_by_author('AUTHOR0 '), [p(0), po(0)])
+        test(postdb.posts_in_heap('my_other_heap'), [po(0)])
+        test(postdb.posts_in_heap('no_such_heap'), [])
+        self.assertEqual(sorted(postdb.tag_names()), ['t1', 't2'])
+        self.assertEqual(
+            sorted(postdb.author_names()),
+            ['author0', 'author1', 'author2', 'author3', 'author4'])
+
+        # The indexes are updated when the posts change
+        p(1).remove_tag('t1')
+        p(3).set_author('Author  Zero')
+        p(4).set_author('author zero')
+        test(postdb.posts_with_tag('t1'), [p(2)])
+        test(postdb.posts_by_author('author zero'), [p(3), p(4)])
+        self.assertEqual(
+            sorted(postdb.author_names()),
+            ['Author  Zero', 'author zero', 'author0', 'author1', 'author2'])
+
+        # Deleted posts are not returned
+        p(4).delete()
+        test(postdb.posts_by_author('author zero'), [p(3)])
+        self.add_post(5, None)
+        test(postdb.posts_in_heap('my_heap'), [p(0), p(1), p(2), p(3), p(5)])
+        self.assertEqual(
+            set(postdb.post_ids_in_heap('my_heap')),
+            set([ p(i).post_id() for i in range(6) ]))
+        postdb.move(p(5), ('my_other_heap', '5'))
+        test(postdb.posts_in_heap('my_other_heap'),
+             [po(0), postdb.post('my_other_heap/5')])
+
+        # `collect.has_tag` uses the tag index
+        test(postdb.postset([p(0), p(2)]).collect.has_tag('t1'), [p(2)])
+        test(postdb.postset([p(0), p(1)]).collect.has_tag('t1'), [])
+
+    def test_generation(self):
+        """Tests :func:`hklib.PostDB.generation`."""
+
+        postdb = self._postdb
+        generation = postdb.generation()
+        self.assertEqual(postdb.generation(), generation)
+        self.p(1).set_subject('new subject')
+        self.assertTrue(postdb.generation() > generation)
+        generation = postdb.generation()
+        postdb.touch()
+        self.assertTrue(postdb.generation() > generation)
+        generation = postdb.generation()
+        self.add_post(5)
+        self.assertTrue(postdb.generation() > generation)
+
+        # Adding and removing posts without touching the post database
+        p5 = self.p(5)
+        generation = postdb.generation()
+        postdb.remove_post_from_dicts(p5)
+        self.assertTrue(postdb.generation() > generation)
+        generation = postdb.generation()
+        postdb.add_post_to_dicts(p5)
+        self.assertTrue(postdb.generation() > generation)
+
+    def test_date_index(self):
+        """Tests :func:`hklib.PostDB.posts_in_date_range`,
+        :func:`hklib.PostDB.newest_posts` and the related functions."""
+
+        postdb = self._postdb
+        p = self.p
+        po = self.po
+        old_localtime_fun = hklib.localtime_fun
+        hklib.localtime_fun = time.gmtime
+
+        def dt(second):
+            return datetime.datetime(2008, 8, 20, 15, 41, second)
+
+        def test(posts, expected_posts):
+            self.assertEqual(posts, postdb.postset(expected_posts))
+
+        try:
+            test(postdb.posts_in_date_range(dt(1), dt(3)), [p(1), p(2)])
+            test(postdb.posts_in_date_range(dts=dt(3)), [p(3), p(4)])
+            test(postdb.posts_in_date_range(dte=dt(1)), [p(0), po(0)])
+            test(postdb.posts_in_date_range(dt(3), dt(1)), [])
+            self.assertEqual(
+                postdb.post_ids_in_date_range(dt(1), dt(3)),
+                [p(1).post_id(), p(2).post_id()])
+            self.assertEqual(postdb.newest_posts(2), [p(4), p(3)])
+            self.assertEqual(postdb.oldest_posts(3)[2], p(1))
+            self.assertEqual(postdb.undated_post_ids(), [])
+
+            # The index is updated when the posts change
+            p(0).set_date('Wed, 20 Aug 2008 17:41:09 +0200')
+            p(4).set_date('')
+            p(3).delete()
+            test(postdb.posts_in_date_range(dts=dt(3)), [p(0)])
+            self.assertEqual(postdb.newest_posts(5),
+                             [p(0), p(2), p(1), po(0)])
+            self.assertEqual(
+                sorted(postdb.undated_post_ids()),
+                [p(3).post_id(), p(4).post_id()])
+            self.add_post(5, None)
+            self.assertEqual(postdb.newest_posts(2), [p(0), p(5)])
+        finally:
+            hklib.localtime_fun = old_localtime_fun
+
     def test_move(self):
         """Tests :func:`hklib.PostDB.move`."""
 
@@ -2231,6 +3095,198 @@ class Test_PostDB(unittest.TestCase, PostDBHandler):
             lambda: postdb.move(p0, 'my_new_heap/moved'))
 
 
+class Test_HeapStorage(unittest.TestCase, PostDBHandler):
+
+    """Tests :class:`hklib.HeapStorage` and its subclasses."""
+
+    def setUp(self):
+        self.setUpDirs()
+        self.create_postdb()
+        self.create_threadst()
+        self._postdb.save()
+
+    def tearDown(self):
+        self.tearDownDirs()
+
+    def test_directory(self):
+        """Tests :class:`hklib.DirectoryHeapStorage`."""
+
+        storage = hklib.DirectoryHeapStorage(self._myheap_dir)
+        self.assertEqual(
+            sorted(storage.stamps().keys()),
+            ['0', '1', '2', '3', '4'])
+        self.assertEqual(
+            storage.postfile_name('1'),
+            os.path.join(self._myheap_dir, '1.post'))
+        self.assertTrue(storage.post_exists('1'))
+        self.assertFalse(storage.post_exists('5'))
+
+        raw_header, body, body_offset = storage.read_post('1')
+        self.assertEqual(raw_header['Subject'], ['subject1'])
+        self.assertEqual(body, 'body1\n')
+        self.assertEqual(storage.read_body('1', body_offset), 'body1\n')
+        self.assertEqual(
+            storage.read_post_text('1'),
+            self.p(1).postfile_str())
+
+        storage.write_post('5', 'Subject: s5\n\nbody5\n')
+        self.assertTrue(storage.post_exists('5'))
+        self.assertEqual(
+            hkutils.file_to_string(storage.postfile_name('5')),
+            'Subject: s5\n\nbody5\n')
+
+    def test_packed(self):
+        """Tests :class:`hklib.PackedHeapStorage` and
+        :func:`hklib.copy_heap_storage`."""
+
+        dir_storage = hklib.DirectoryHeapStorage(self._myheap_dir)
+        pack_dir = os.path.join(self._dir, 'pack')
+        os.mkdir(pack_dir)
+        storage = hklib.PackedHeapStorage(pack_dir)
+        self.assertEqual(storage.stamps(), {})
+
+        # Importing the post files
+        hklib.copy_heap_storage(dir_storage, storage)
+        self.assertEqual(
+            sorted(storage.stamps().keys()),
+            ['0', '1', '2', '3', '4'])
+        self.assertEqual(
+            storage.postfile_name('1'),
+            os.path.join(pack_dir, 'posts.pack'))
+        for i in range(5):
+            self.assertEqual(
+                storage.read_post_text(str(i)),
+                dir_storage.read_post_text(str(i)))
+        raw_header, body, body_offset = storage.read_post('1')
+        self.assertEqual(raw_header['Subject'], ['subject1'])
+        self.assertEqual(body, 'body1\n')
+        self.assertEqual(storage.read_body('1', body_offset), 'body1\n')
+        self.assertEqual(storage.read_post('1', read_body=False),
+                         (raw_header, None, body_offset))
+
+        # Rewriting a post appends a new record
+        data_size = os.path.getsize(storage.data_file_name())
+        storage.write_post('1', 'Subject: new\n\nnew body\n')
+        self.assertTrue(os.path.getsize(storage.data_file_name()) > data_size)
+        _raw_header, body, body_offset = storage.read_post('1')
+        self.assertEqual(body, 'new body\n')
+
+        # The records not covered by the index file are scanned
+        storage2 = hklib.PackedHeapStorage(pack_dir)
+        self.assertEqual(storage2.stamps(), storage.stamps())
+        storage.flush()
+        self.assertTrue(os.path.exists(storage.index_file_name()))
+        storage2 = hklib.PackedHeapStorage(pack_dir)
+        self.assertTrue(storage2._index_written)
+        self.assertEqual(storage2.stamps(), storage.stamps())
+
+        # Compacting removes the old records
+        shifts = storage.compact()
+        self.assertTrue(os.path.getsize(storage.data_file_name()) <= data_size)
+        self.assertEqual(storage.read_post('1')[1], 'new body\n')
+        self.assertEqual(
+            storage.read_body('1', body_offset + shifts['1']),
+            'new body\n')
+        storage2 = hklib.PackedHeapStorage(pack_dir)
+        self.assertEqual(storage2.stamps(), storage.stamps())
+
+        # Exporting the posts into post files
+        export_dir = os.path.join(self._dir, 'export')
+        os.mkdir(export_dir)
+        export_storage = hklib.DirectoryHeapStorage(export_dir)
+        hklib.copy_heap_storage(storage, export_storage)
+        self.assertEqual(
+            hkutils.file_to_string(os.path.join(export_dir, '1.post')),
+            'Subject: new\n\nnew body\n')
+        self.assertEqual(
+            hkutils.file_to_string(os.path.join(export_dir, '2.post')),
+            self.p(2).postfile_str())
+
+        # An incomplete record at the end of the data file is removed
+        data_file = storage.data_file_name()
+        stamps = storage.stamps()
+        data_size = os.path.getsize(data_file)
+        for tail in ('7 100\nSubject: torn', '8 1'):
+            with open(data_file, 'ab') as f:
+                f.write(tail)
+            storage2 = hklib.PackedHeapStorage(pack_dir)
+            self.assertEqual(storage2.stamps(), stamps)
+            self.assertEqual(os.path.getsize(data_file), data_size)
+            self.assertEqual(
+                self.pop_log(),
+                'Warning: incomplete record removed from "%s" at position '
+                '%d.' % (data_file, data_size))
+
+        # Writing a post after the data file was extended by someone else
+        with open(data_file, 'ab') as f:
+            f.write('6 9\nSubject: ')
+        storage.write_post('5', 'Subject: s5\n')
+        self.assertEqual(storage.read_post('5')[0]['Subject'], ['s5'])
+        self.assertEqual(sorted(storage.stamps().keys()),
+                         ['0', '1', '2', '3', '4', '5', '6'])
+        storage2 = hklib.PackedHeapStorage(pack_dir)
+        self.assertEqual(storage2.stamps(), storage.stamps())
+
+        # Incorrect data file
+        hkutils.string_to_file('incorrect\nrecord\n',
+                               storage.data_file_name())
+        self.assertRaises(
+            hkutils.HkException,
+            lambda: hklib.PackedHeapStorage(pack_dir))
+
+    def test_postdb(self):
+        """Tests using :class:`hklib.PackedHeapStorage` via
+        :class:`hklib.PostDB`."""
+
+        pack_dir = os.path.join(self._dir, 'pack')
+        os.mkdir(pack_dir)
+        hklib.copy_heap_storage(
+            hklib.DirectoryHeapStorage(self._myheap_dir),
+            hklib.PackedHeapStorage(pack_dir))
+
+        postdb = hklib.PostDB()
+        postdb.set_lazy_bodies(True)
+        postdb.add_heap('my_heap', pack_dir, 'packed')
+        self._postdb = postdb
+        self.assertEqual(
+            [ post.post_id_str() for post in postdb.all().sorted_list() ],
+            ['my_heap/0', 'my_heap/1', 'my_heap/2', 'my_heap/3', 'my_heap/4'])
+        self.assertFalse(self.p(2).is_modified())
+        self.assertEqual(postdb.root(self.p(2)), self.p(0))
+        self.assertEqual(self.p(2).body(), 'body2\n')
+
+        # Modifying and saving posts
+        self.p(1).set_subject('new subject')
+        postdb.add_new_post(hklib.Post.from_str('Subject: s5'), 'my_heap')
+        postdb.save()
+        self.assertEqual(
+            postdb.storage('my_heap').read_post('1')[0]['Subject'],
+            ['new subject'])
+        self.assertTrue(postdb.storage('my_heap')._index_written)
+
+        # Compaction moves the bodies that have not been read yet
+        self.assertFalse(self.p(4).is_body_loaded())
+        postdb.compact_heap('my_heap')
+        self.assertEqual(self.p(4).body(), 'body4\n')
+        self.assertEqual(self.p(3).stamp(),
+                         postdb.storage('my_heap').stamp('3'))
+
+        # Loading the heap again
+        postdb2 = hklib.PostDB()
+        postdb2.add_heap('my_heap', pack_dir, 'packed')
+        self.assertEqual(
+            postdb2.post_by_post_id('my_heap/1').subject(),
+            'new subject')
+        self.assertEqual(
+            postdb2.post_by_post_id('my_heap/5').subject(),
+            's5')
+
+        # Unknown storage type
+        self.assertRaises(
+            hkutils.HkException,
+            lambda: postdb2.add_heap('other', pack_dir, 'unknown'))
+
+
 class Test_PostItem(unittest.TestCase):
 
     """Tests :class:`hklib.PostItem`."""
@@ -2286,6 +3342,24 @@ class Test_PostItem(unittest.TestCase):
         self.assertNotEquals(postitem1, postitem3)
         self.assertNotEquals(postitem1, postitem4)
 
+    def test_attributes(self):
+        """Tests the data attributes of :class:`hklib.PostItem`."""
+
+        post = hklib.Post.from_str('', post_id=('my_heap', '42'))
+        postitem = hklib.PostItem(pos='begin', post=post, level=0)
+
+        # Additional data attributes can be set, and they are copied
+        postitem.print_post_body = True
+        self.assertEqual(
+            str(postitem),
+            ("<PostItem: pos=begin, post_id=my_heap/42, level=0, "
+             "print_post_body=True>"))
+        postitem2 = postitem.copy()
+        self.assertTrue(postitem2.print_post_body)
+        self.assertEqual(postitem, postitem2)
+        postitem2.print_post_body = False
+        self.assertTrue(postitem.print_post_body)
+
 
 class Test_PostSet(unittest.TestCase, PostDBHandler):
 
@@ -2709,6 +3783,26 @@ class Test_PostSet(unittest.TestCase, PostDBHandler):
         test('124', '0124')
         test('1234', '01234')
 
+        # Posts in a cycle
+        self.introduce_cycle()
+        self.assertEqual(
+            self._postdb.postset(self.p(5)).expb(),
+            self._postdb.postset([self.p(3), self.p(5), self.p(6),
+                                  self.p(7)]))
+
+    def test_thread_roots(self):
+        """Tests :func:`hklib.PostSet.thread_roots`."""
+
+        postdb = self._postdb
+        ps = postdb.postset([self.p(1), self.p(2), self.po(0)])
+        self.assertEqual(ps.thread_roots(),
+                         postdb.postset([self.p(0), self.po(0)]))
+
+        # Posts in cycles have no root
+        self.introduce_cycle()
+        ps = postdb.postset([self.p(2), self.p(5)])
+        self.assertEqual(ps.thread_roots(), postdb.postset([self.p(0)]))
+
     def test_expf(self):
         """Tests :func:`hklib.PostSet.expf`."""
 
@@ -2809,6 +3903,137 @@ class Test_PostSet(unittest.TestCase, PostDBHandler):
             postdb.all().sorted_list(),
             [p(0), po(0), p(1), p(2), p(3), p(4)])
 
+        # Posts without a date precede the others
+        p(2).set_date('')
+        self.assertEqual(
+            postdb.all().sorted_list(),
+            [p(2), p(0), po(0), p(1), p(3), p(4)])
+
+
+class Test_PostBitSet(unittest.TestCase, PostDBHandler):
+
+    """Tests :class:`hklib.PostBitSet`."""
+
+    def setUp(self):
+        self.setUpDirs()
+        self.create_postdb()
+        self.create_threadst()
+
+    def tearDown(self):
+        self.tearDownDirs()
+
+    def test_basic(self):
+        """Tests the basic set functionality of post bit sets."""
+
+        p = self.p
+        postdb = self._postdb
+        bs = postdb.postbitset([p(0), p(2), self.po(0)])
+
+        self.assertEqual(len(bs), 3)
+        self.assertTrue(bs)
+        self.assertFalse(postdb.postbitset([]))
+        self.assertTrue(p(2) in bs)
+        self.assertFalse(p(1) in bs)
+        self.assertFalse('x' in bs)
+        self.assertEqual(set(bs), set([p(0), p(2), self.po(0)]))
+        self.assertTrue(bs.is_set([p(0), p(2), self.po(0)]))
+        self.assertEqual(bs, postdb.postset([p(0), p(2), self.po(0)]))
+        self.assertNotEqual(bs, postdb.postbitset([p(0)]))
+
+        # Modifiers
+        bs.add(p(4))
+        bs.discard(p(0))
+        bs.discard(p(1))
+        self.assertTrue(bs.is_set([p(2), p(4), self.po(0)]))
+        bs.remove(p(2))
+        self.assertRaises(KeyError, lambda: bs.remove(p(2)))
+        bs.update([p(1), p(3)])
+        self.assertTrue(bs.is_set([p(1), p(3), p(4), self.po(0)]))
+
+        # Copies are independent
+        bs2 = bs.copy()
+        bs2.add(p(0))
+        self.assertFalse(p(0) in bs)
+        self.assertEqual(bs.empty_clone(), postdb.postbitset([]))
+
+        # Conversion to post set
+        ps = bs.postset()
+        self.assertTrue(isinstance(ps, hklib.PostSet))
+        self.assertTrue(ps.is_set([p(1), p(3), p(4), self.po(0)]))
+
+    def test_moved_and_removed_posts(self):
+        """Tests post bit sets whose posts are moved or removed."""
+
+        p = self.p
+        postdb = self._postdb
+        p1 = p(1)
+        p2 = p(2)
+        bs = postdb.postbitset([p1, p2])
+
+        # A moved post stays in the set
+        postdb.move(p1, 'my_heap/9', placeholder=True)
+        self.assertEqual(len(bs), 2)
+        self.assertEqual(set(bs), set([p1, p2]))
+        self.assertTrue(p1 in bs)
+        self.assertFalse(p(1) in bs)
+        self.assertTrue(bs.is_set([p1, p2]))
+
+        # A removed post is not counted
+        postdb.remove_post_from_dicts(p2)
+        self.assertEqual(len(bs), 1)
+        self.assertEqual(list(bs), [p1])
+        postdb.remove_post_from_dicts(p1)
+        self.assertEqual(len(bs), 0)
+        self.assertFalse(bs)
+        postdb.add_post_to_dicts(p1)
+        self.assertEqual(len(bs), 1)
+        self.assertEqual(list(bs), [p1])
+
+    def test_set_operations(self):
+        """Tests the set operations of post bit sets."""
+
+        p = self.p
+        postdb = self._postdb
+        bs1 = postdb.postbitset([p(0), p(1), p(2)])
+        bs2 = postdb.postbitset([p(1), p(2), p(3)])
+
+        self.assertTrue((bs1 & bs2).is_set([p(1), p(2)]))
+        self.assertTrue((bs1 | bs2).is_set([p(0), p(1), p(2), p(3)]))
+        self.assertTrue((bs1 - bs2).is_set([p(0)]))
+        self.assertTrue((bs1 ^ bs2).is_set([p(0), p(3)]))
+        self.assertTrue(isinstance(bs1 & bs2, hklib.PostBitSet))
+
+        # Operations with PrePostSets
+        self.assertTrue((bs1 & [p(0), p(3)]).is_set([p(0)]))
+        self.assertTrue(([p(0), p(3)] & bs1).is_set([p(0)]))
+        self.assertTrue((bs1 | p(4)).is_set([p(0), p(1), p(2), p(4)]))
+        self.assertTrue(([p(0), p(3)] - bs1).is_set([p(3)]))
+        self.assertTrue(
+            (bs1 - postdb.postset([p(1)])).is_set([p(0), p(2)]))
+        self.assertTrue(bs1.union([p(3)]).is_set([p(0), p(1), p(2), p(3)]))
+
+        # Post sets accept post bit sets
+        self.assertTrue(
+            (postdb.postset([p(0), p(3)]) & bs1).is_set([p(0)]))
+
+    def test_thread_operations(self):
+        """Tests the thread operations of post bit sets."""
+
+        p = self.p
+        postdb = self._postdb
+        bs = postdb.postbitset([p(1), p(4)])
+
+        self.assertTrue(bs.expb().is_set([p(0), p(1), p(4)]))
+        self.assertTrue(bs.expf().is_set([p(1), p(2), p(4)]))
+        self.assertTrue(bs.exp().is_set([p(0), p(1), p(2), p(3), p(4)]))
+        self.assertTrue(bs.thread_roots().is_set([p(0), p(4)]))
+        self.assertEqual(bs.sorted_list(), [p(1), p(4)])
+        self.assertTrue(
+            bs.collect(lambda post: post is p(1)).is_set([p(1)]))
+        self.assertTrue(
+            postdb.postbitset(postdb.all()).collect.is_root().is_set(
+                [p(0), self.po(0), p(4)]))
+
 
 if __name__ == '__main__':
     hkutils.set_log(False)
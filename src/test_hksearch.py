@@ -27,6 +27,8 @@ Usage:
 
 from __future__ import with_statement
 
+import math
+import os
 import time
 import unittest
 
@@ -222,6 +224,791 @@ class Test_Search(unittest.TestCase, test_hklib.PostDBHandler):
             postdb.postset([self.po(0)]))
 
 
+class Test_Query(unittest.TestCase, test_hklib.PostDBHandler):
+
+    """Tests :class:`hksearch.Query` and :class:`hksearch.Target`."""
+
+    def setUp(self):
+        hklib.localtime_fun = time.gmtime
+        self.setUpDirs()
+        self.create_postdb()
+        self.create_threadst()
+        self._old_target_types = dict(hksearch.target_types)
+        self._old_target_compilers = dict(hksearch.target_compilers)
+        self._old_target_costs = dict(hksearch.target_costs)
+
+    def tearDown(self):
+        hksearch.target_types.clear()
+        hksearch.target_types.update(self._old_target_types)
+        hksearch.target_compilers.clear()
+        hksearch.target_compilers.update(self._old_target_compilers)
+        hksearch.target_costs.clear()
+        hksearch.target_costs.update(self._old_target_costs)
+        self.tearDownDirs()
+
+    def test_targets(self):
+        """Tests parsing and compiling the targets."""
+
+        query = hksearch.Query('Body1 heap:-other after:2008-08-20')
+        target1, target2, target3 = query.targets
+        self.assertEqual(
+            (target1.type, target1.pattern, target1.positive),
+            ('whole', 'Body1', True))
+        self.assertEqual(target1.regexp.pattern, 'Body1')
+        self.assertEqual(
+            (target2.type, target2.pattern, target2.positive),
+            ('heap', 'other', False))
+        self.assertEqual(target3.regexp, None)
+        self.assertEqual(
+            repr(query.targets),
+            '[<target whole:Body1>, <target heap:-other>, '
+            '<target after:2008-08-20>]')
+
+        self.assertTrue(target1.matches(self.p(1)))
+        self.assertFalse(target1.matches(self.p(2)))
+        self.assertFalse(target2.matches(self.p(1)))
+        self.assertTrue(target2.matches(self.po(0)))
+        self.assertTrue(query.matches(self.p(1)))
+        self.assertFalse(query.matches(self.p(2)))
+
+        # Errors are reported when the query is compiled
+        self.assertRaises(
+            hkutils.HkException,
+            lambda: hksearch.Query('after:2009-00'))
+
+    def test_reuse(self):
+        """Tests that a query is compiled only once."""
+
+        postdb = self._postdb
+        calls = []
+        def parse_date(date_str):
+            calls.append(date_str)
+            return old_parse_date(date_str)
+        old_parse_date = hkutils.parse_date
+        hkutils.parse_date = parse_date
+        try:
+            query = hksearch.Query('before:2008-08-20_15:41:01')
+            result = postdb.postset([self.p(0), self.po(0)])
+            self.assertEqual(query.search(postdb.all()), result)
+            self.assertEqual(query.search(postdb.all()), result)
+            self.assertEqual(query.search(postdb.postset(self.p(1))),
+                             postdb.postset([]))
+        finally:
+            hkutils.parse_date = old_parse_date
+        self.assertEqual(calls, ['2008-08-20_15:41:01'])
+
+    def test_add_target_type(self):
+        """Tests :func:`hksearch.add_target_type`."""
+
+        postdb = self._postdb
+
+        # Target type without a compiler
+        hksearch.add_target_type(
+            'index', lambda post, pattern: post.post_index() == pattern)
+        self.assertEqual(
+            hksearch.search('index:1', postdb.all()),
+            postdb.postset([self.p(1)]))
+
+        # Target type with a compiler
+        compiled = []
+        def compile_target(target):
+            compiled.append(target.pattern)
+            post_indices = set(target.pattern.split(','))
+            return lambda post: post.post_index() in post_indices
+        hksearch.add_target_type('index', None, compile_target, 5)
+        query = hksearch.Query('index:1,2 index:-2')
+        self.assertEqual(compiled, ['1,2', '2'])
+        self.assertEqual(query.targets[0].cost, 5)
+        self.assertEqual(query.search(postdb.all()),
+                         postdb.postset([self.p(1)]))
+
+        # Overriding a built-in target type
+        hksearch.add_target_type(
+            'body', lambda post, pattern: post.post_index() == pattern)
+        target = hksearch.Target('body:1')
+        self.assertFalse(target.is_builtin())
+        self.assertEqual(
+            hksearch.search('body:0', postdb.all()),
+            postdb.postset([self.p(0), self.po(0)]))
+        self.assertTrue(hksearch.Target('heap:1').is_builtin())
+        self.assertEqual(hksearch.Target('body:1').cost,
+                         hksearch.default_target_cost)
+
+    def test_plan(self):
+        """Tests :class:`hksearch.QueryPlan`."""
+
+        postdb = self._postdb
+        all_posts = postdb.all()
+
+        # The heap target restricts the posts; afterwards it cannot reject
+        # any of them, so it is executed last
+        plan = hksearch.QueryPlan(hksearch.Query('heap:other body:y'),
+                                  all_posts)
+        self.assertEqual(
+            [ step.target.type for step in plan.steps ],
+            ['body', 'heap'])
+        self.assertEqual(plan.restricted_posts, set([self.po(0).post_id()]))
+        self.assertEqual(list(plan.posts()), [self.po(0)])
+        self.assertEqual(plan.execute(), postdb.postset([self.po(0)]))
+        self.assertEqual(
+            [ (step.post_count, step.rejected_count) for step in plan.steps ],
+            [(1, 0), (1, 0)])
+
+        # The heap, author and tag targets are looked up in the indexes of the
+        # post database
+        self.p(1).set_tags(['tag1'])
+        self.assertEqual(
+            hksearch.Target('tag:G1').candidates(postdb),
+            (set([self.p(1).post_id()]), ()))
+        self.assertEqual(
+            hksearch.Target('author:or[12]').candidates(postdb),
+            (set([self.p(1).post_id(), self.p(2).post_id()]), ()))
+
+        # The date targets are looked up in the date index
+        self.assertEqual(
+            hksearch.Target('before:2008-08-20_15:41:01').candidates(postdb),
+            (set([self.p(0).post_id(), self.po(0).post_id()]), ()))
+        self.p(4).set_date('')
+        self.assertEqual(
+            hksearch.Target('after:2008-08-20_15:41:03').candidates(postdb),
+            (set([self.p(3).post_id(), self.p(4).post_id()]), ()))
+
+        # A negated target does not restrict the posts
+        plan = hksearch.QueryPlan(hksearch.Query('body:1 heap:-other'),
+                                  all_posts)
+        self.assertEqual(plan.restricted_posts, None)
+        self.assertEqual(
+            [ step.target.type for step in plan.steps ],
+            ['heap', 'body'])
+        self.assertEqual(plan.execute(), postdb.postset([self.p(1)]))
+        self.assertEqual(
+            [ (step.post_count, step.rejected_count) for step in plan.steps ],
+            [(6, 1), (5, 4)])
+
+        # Expensive targets are executed last
+        hksearch.add_target_type(
+            'index', lambda post, pattern: post.post_index() == pattern,
+            cost=100)
+        plan = hksearch.QueryPlan(hksearch.Query('index:1 body:1 author:-2'),
+                                  all_posts)
+        self.assertEqual(
+            [ step.target.type for step in plan.steps ],
+            ['author', 'body', 'index'])
+
+        # The candidates are not looked up when a small post set is searched
+        old_ratio = hksearch.CANDIDATE_LOOKUP_MIN_RATIO
+        hksearch.CANDIDATE_LOOKUP_MIN_RATIO = 0.5
+        try:
+            thread = postdb.postset([self.p(1), self.p(2)])
+            plan = hksearch.QueryPlan(hksearch.Query('heap:my_heap body:1'),
+                                      thread)
+            self.assertEqual(
+                [ step.candidates for step in plan.steps ],
+                [None, None])
+            self.assertEqual(plan.restricted_posts, None)
+            self.assertEqual(plan.execute(), postdb.postset([self.p(1)]))
+            plan = hksearch.QueryPlan(hksearch.Query('heap:my_heap'),
+                                      all_posts)
+            self.assertNotEqual(plan.steps[0].candidates, None)
+        finally:
+            hksearch.CANDIDATE_LOOKUP_MIN_RATIO = old_ratio
+
+    def test_explain(self):
+        """Tests :func:`hksearch.QueryPlan.explain`."""
+
+        postdb = self._postdb
+        plan = hksearch.QueryPlan(hksearch.Query('body:1 heap:my_heap'),
+                                  postdb.all())
+        self.assertEqual(
+            plan.explain(),
+            "Query: 'body:1 heap:my_heap'\n"
+            "Posts: 6, restricted to 5\n"
+            "1. body:1 (cost: 20)\n"
+            "2. heap:my_heap (cost: 1, candidates: 5)")
+        plan.execute()
+        self.assertEqual(
+            plan.explain(),
+            "Query: 'body:1 heap:my_heap'\n"
+            "Posts: 6, restricted to 5\n"
+            "1. body:1 (cost: 20) -- 5 posts, 4 rejected\n"
+            "2. heap:my_heap (cost: 1, candidates: 5) -- 1 posts, 0 rejected\n"
+            "Result: 1 posts")
+
+        # The `explain` argument of `search` logs the timed plan
+        self.assertEqual(
+            hksearch.search('body:-1', postdb.all(), explain=True),
+            postdb.all() - postdb.postset(self.p(1)))
+        self.assertEqual(len(self._log), 1)
+        self.assertTrue(
+            self._log[0].startswith(
+                "Query: 'body:-1'\n"
+                "Posts: 6\n"
+                "1. body:-1 (cost: 20) -- 6 posts, 1 rejected, "))
+        self._log = []
+
+    def test_ranked_search(self):
+        """Tests :func:`hksearch.Query.score` and
+        :func:`hksearch.Query.ranked_search`."""
+
+        postdb = self._postdb
+        all_posts = postdb.all()
+        p = self.p
+        po = self.po
+
+        # Relevance
+        self.assertEqual(hksearch.Query('body').score(p(1)), 1.0)
+        self.assertEqual(hksearch.Query('body body:1').score(p(1)), 2.0)
+        self.assertEqual(hksearch.Query('body -body2').score(p(1)), 1.0)
+        self.assertEqual(hksearch.Query('heap:my_heap').score(p(1)), 0.0)
+        # 'subject2' has the weight 3, 'author2' and 'body2' have 1
+        self.assertEqual(hksearch.Query('2').score(p(2)), 5.0)
+        p(2).set_body('body2 body2 body2\n')
+        self.assertAlmostEqual(hksearch.Query('body').score(p(2)),
+                               1 + math.log(3))
+
+        # Recency
+        newest_timestamp = p(4).timestamp()
+        self.assertEqual(
+            hksearch.Query('body').score(p(4), newest_timestamp),
+            2.0)
+        self.assertAlmostEqual(
+            hksearch.Query('body').score(
+                p(4), newest_timestamp + hksearch.RANK_RECENCY_HALF_LIFE),
+            1.5)
+
+        # Ranking: posts with the same score are ordered by their date
+        def test(ranked_posts, expected_posts):
+            self.assertEqual([ post for score, post in ranked_posts ],
+                             expected_posts)
+
+        test(hksearch.Query('body').ranked_search(all_posts, 3),
+             [p(2), p(4), p(3)])
+        test(hksearch.ranked_search('body', all_posts, 10),
+             [p(2), p(4), p(3), p(1), po(0), p(0)])
+        test(hksearch.ranked_search('body -body2', all_posts, 2),
+             [p(4), p(3)])
+        test(hksearch.ranked_search('nothing', all_posts, 2), [])
+        test(hksearch.ranked_search('body', all_posts, 0), [])
+
+    def test_query_cache(self):
+        """Tests :class:`hksearch.QueryCache`."""
+
+        postdb = self._postdb
+        cache = hksearch.QueryCache(max_size=2)
+        self.assertEqual(
+            cache.stats(),
+            {'size': 0, 'max_size': 2, 'hits': 0, 'misses': 0,
+             'hit_rate': 0.0})
+
+        # The first search calculates the result, the second one uses it
+        result = cache.search('body:1', postdb)
+        self.assertEqual(result, postdb.postset(self.p(1)))
+        self.assertTrue(cache.search('body:1', postdb) is result)
+        self.assertEqual(cache.search_exp('body:1', postdb),
+                         postdb.postset(self.p(1)).exp())
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['hits'], stats['misses']),
+                         (1, 2, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 2.0 / 3)
+
+        # The best posts are calculated again only if more posts are needed
+        self.assertEqual(cache.ranked_search('body', postdb, 2),
+                         hksearch.ranked_search('body', postdb.all(), 2))
+        best = cache._entries[(postdb, 'body')][6]
+        cache.ranked_search('body', postdb, 1)
+        self.assertTrue(cache._entries[(postdb, 'body')][6] is best)
+        self.assertEqual(cache.ranked_search('body', postdb, 10),
+                         hksearch.ranked_search('body', postdb.all(), 10))
+        cache.search('body:1', postdb)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+        # Modifying the post database invalidates the result
+        self.p(2).set_body('body1\n')
+        self.assertEqual(cache.search('body:1', postdb),
+                         postdb.postset([self.p(1), self.p(2)]))
+        self.assertEqual(cache.stats()['misses'], 3)
+
+        # Adding a target type invalidates the result
+        hksearch.add_target_type('body', lambda post, pattern: True)
+        self.assertEqual(cache.search('body:1', postdb), postdb.all())
+
+        # The least recently used result is dropped
+        cache.search('body:2', postdb)
+        cache.search('body:1', postdb)
+        cache.search('body:3', postdb)
+        self.assertEqual(cache.stats()['size'], 2)
+        misses = cache.stats()['misses']
+        cache.search('body:1', postdb)
+        cache.search('body:3', postdb)
+        self.assertEqual(cache.stats()['misses'], misses)
+        cache.search('body:2', postdb)
+        self.assertEqual(cache.stats()['misses'], misses + 1)
+
+        # Removing a post file and reloading the post database invalidates
+        # the result
+        cache.search('body4', postdb)
+        postdb.save()
+        os.remove(os.path.join(self._myheap_dir, '4.post'))
+        postdb.reload()
+        self.assertEqual(cache.search('body4', postdb), postdb.postset([]))
+
+        cache.clear()
+        self.assertEqual(
+            cache.stats(),
+            {'size': 0, 'max_size': 2, 'hits': 0, 'misses': 0,
+             'hit_rate': 0.0})
+
+
+class Test_SearchWithIndex(Test_Search):
+
+    """Tests :func:`hksearch.search` when the post database has a search
+    index.
+
+    The search results have to be the same as without the index.
+    """
+
+    def setUp(self):
+        Test_Search.setUp(self)
+        hksearch.enable_index(self._postdb)
+
+    def tearDown(self):
+        hksearch.disable_index(self._postdb)
+        Test_Search.tearDown(self)
+
+    def test_reload_removed_post(self):
+        """Tests that the index and the query cache forget a post whose post
+        file was removed when the post database is reloaded."""
+
+        postdb = self._postdb
+        postdb.save()
+        index = hksearch.search_indexes[postdb]
+        cache = hksearch.QueryCache()
+        p4 = self.p(4)
+        self.assertEqual(hksearch.search('body4', postdb.all()),
+                         postdb.postset(p4))
+        self.assertEqual(cache.search('body4', postdb), postdb.postset(p4))
+
+        os.remove(os.path.join(self._myheap_dir, '4.post'))
+        postdb.reload()
+        self.assertEqual(self.p(4), None)
+        self.assertFalse(p4.post_id() in index._post_tokens)
+        self.assertEqual(index.candidates(['body'], 'body4'), set())
+        self.assertEqual(hksearch.search('body4', postdb.all()),
+                         postdb.postset([]))
+        self.assertEqual(cache.search('body4', postdb), postdb.postset([]))
+
+    def test_reload_changed_post(self):
+        """Tests that the index follows a post whose post file was changed
+        when the post database is reloaded."""
+
+        postdb = self._postdb
+        postdb.save()
+        index = hksearch.search_indexes[postdb]
+        p1 = self.p(1)
+        self.assertEqual(hksearch.search('body1', postdb.all()),
+                         postdb.postset(p1))
+
+        hkutils.string_to_file(
+            'Author: author1\nSubject: subject1\nMessage-Id: 1@\n\n'
+            'durian',
+            os.path.join(self._myheap_dir, '1.post'))
+        postdb.reload()
+        self.assertTrue(self.p(1) is p1)
+        self.assertEqual(index.candidates(['body'], 'durian'),
+                         set([p1.post_id()]))
+        self.assertEqual(hksearch.search('durian', postdb.all()),
+                         postdb.postset(p1))
+        self.assertEqual(hksearch.search('body1', postdb.all()),
+                         postdb.postset([]))
+
+    def test_search_in_batch(self):
+        """Tests that a search performed inside a batch block sees the posts
+        modified in the block."""
+
+        postdb = self._postdb
+        index = hksearch.search_indexes[postdb]
+        all_posts = postdb.all()
+        p1 = self.p(1)
+        self.assertEqual(hksearch.search('body1', all_posts),
+                         postdb.postset(p1))
+
+        with postdb.batch():
+            p1.set_body('changed\n')
+            self.assertEqual(index.candidates(['body'], 'body1'), set())
+            self.assertEqual(index.candidates(['body'], 'changed'),
+                             set([p1.post_id()]))
+            self.assertEqual(hksearch.search('body1', all_posts),
+                             postdb.postset([]))
+            self.assertEqual(hksearch.search('chang.d', all_posts),
+                             postdb.postset(p1))
+            with postdb.batch():
+                p1.set_body('again\n')
+                self.assertEqual(hksearch.search('changed', all_posts),
+                                 postdb.postset([]))
+            self.assertEqual(hksearch.search('again', all_posts),
+                             postdb.postset(p1))
+
+        self.assertEqual(index.candidates(['body'], 'again'),
+                         set([p1.post_id()]))
+        self.assertEqual(hksearch.search('again', all_posts),
+                         postdb.postset(p1))
+
+    def test_index_used(self):
+        """Tests that the fields of the posts that are not candidates are not
+        searched."""
+
+        postdb = self._postdb
+        all_posts = postdb.all()
+
+        # `index.candidates` is replaced with a function that finds nothing,
+        # so only the unindexed fields are searched
+        index = hksearch.search_indexes[postdb]
+        index.candidates = lambda fields, word: set()
+        self.assertEqual(hksearch.search('body1', all_posts),
+                         postdb.postset([]))
+        self.assertEqual(hksearch.search('my_other_heap', all_posts),
+                         postdb.postset([self.po(0)]))
+        self.assertEqual(hksearch.search('body:body1', all_posts),
+                         postdb.postset([]))
+        self.assertEqual(hksearch.search('-body1', all_posts), all_posts)
+
+        # `index.regexp_candidates` is replaced similarly, so only the fields
+        # whose trigrams are not indexed are searched
+        index.regexp_candidates = lambda fields, pattern: set()
+        self.assertEqual(hksearch.search('body.', all_posts),
+                         postdb.postset([]))
+        self.assertEqual(hksearch.search('subject:subj.ct1', all_posts),
+                         postdb.postset([]))
+        self.assertEqual(hksearch.search('my_other.heap', all_posts),
+                         postdb.postset([self.po(0)]))
+
+        # Patterns that do not require any trigram are matched against all
+        # posts
+        del index.regexp_candidates
+        self.assertEqual(hksearch.search('b.d', all_posts), all_posts)
+
+
+class Test_ParallelSearch(Test_Search):
+
+    """Tests :func:`hksearch.search` when the post database has a search
+    pool.
+
+    The search results have to be the same as without the pool.
+    """
+
+    def setUp(self):
+        Test_Search.setUp(self)
+        hksearch.enable_parallel_search(self._postdb, processes=2,
+                                        min_posts=0)
+
+    def tearDown(self):
+        hksearch.disable_parallel_search(self._postdb)
+        Test_Search.tearDown(self)
+
+    def test_pool_used(self):
+        """Tests that the posts are searched by the pool."""
+
+        postdb = self._postdb
+        all_posts = postdb.all()
+        pool = hksearch.search_pools[postdb]
+
+        # The pool is used only if the post database is large enough
+        pool.min_posts = len(postdb.real_posts()) + 1
+        self.assertEqual(hksearch.parallel_search_pool(postdb), None)
+        pool.min_posts = len(postdb.real_posts())
+        self.assertEqual(hksearch.parallel_search_pool(postdb), pool)
+
+        # `pool.search` is replaced with a function that finds nothing, so
+        # only the fields that are not in the index are searched
+        pool.search = lambda fields, pattern: set()
+        self.assertEqual(hksearch.search('body:body1', all_posts),
+                         postdb.postset([]))
+        self.assertEqual(hksearch.search('body1', all_posts),
+                         postdb.postset([]))
+        self.assertEqual(hksearch.search('my_other_heap', all_posts),
+                         postdb.postset([self.po(0)]))
+        self.assertEqual(hksearch.search('subject:subject1', all_posts),
+                         postdb.postset(self.p(1)))
+
+    def test_search_pool(self):
+        """Tests :func:`hksearch.SearchPool.search`."""
+
+        postdb = self._postdb
+        pool = hksearch.search_pools[postdb]
+
+        def test(fields, pattern, flags, expected_posts):
+            self.assertEqual(
+                pool.search(fields, pattern, flags),
+                set([ post.post_id() for post in expected_posts ]))
+
+        test(('body',), 'BODY1', hksearch.regexp_options, [self.p(1)])
+        test(('body',), 'BODY1', 0, [])
+        test(('body',), '^body[12]$', hksearch.regexp_options,
+             [self.p(1), self.p(2)])
+        test(('author',), 'author[34]', 0, [self.p(3), self.p(4)])
+        test(('postid',), '^my_heap/1$', 0, [self.p(1)])
+        test(('body', 'tags'), 'nothing', 0, [])
+
+        # The snapshot is written again after the post database changes
+        snapshot_file = pool._snapshot_file
+        self.p(1).set_tags(['mytag', 'other'])
+        self.p(2).delete()
+        test(('tags',), '^other$', 0, [self.p(1)])
+        test(hksearch.parallel_fields, '^$', 0,
+             [ post for post in postdb.real_posts()
+               if '' in hksearch.whole_target_strings(post) ])
+        test(('body',), '^$', 0, [self.p(2)])
+        self.assertNotEqual(pool._snapshot_file, snapshot_file)
+        self.assertFalse(os.path.exists(snapshot_file))
+
+        pool.close()
+        self.assertFalse(os.path.exists(snapshot_file))
+
+    def test_search_pool_delta(self):
+        """Tests that only the delta snapshot is written when some posts
+        are changed."""
+
+        postdb = self._postdb
+        pool = hksearch.search_pools[postdb]
+        p1 = self.p(1)
+
+        def test(fields, pattern, expected_posts):
+            self.assertEqual(
+                pool.search(fields, pattern, 0),
+                set([ post.post_id() for post in expected_posts ]))
+
+        old_max_ratio = hksearch.SNAPSHOT_DELTA_MAX_RATIO
+        hksearch.SNAPSHOT_DELTA_MAX_RATIO = 1.0
+        try:
+            test(('body',), '^body1$', [p1])
+            snapshot_file = pool._snapshot_file
+
+            # Changing the tags of a post writes only the delta
+            p1.set_tags(['newtag'])
+            test(('tags',), '^newtag$', [p1])
+            test(('body',), '^body1$', [p1])
+            self.assertEqual(pool._snapshot_file, snapshot_file)
+            self.assertNotEqual(pool._delta_file, None)
+            self.assertEqual(pool._delta_posts, [p1])
+
+            # Changing the post back to its original state removes it from
+            # the delta
+            delta_file = pool._delta_file
+            p1.set_tags([])
+            test(('tags',), '^newtag$', [])
+            self.assertEqual(pool._snapshot_file, snapshot_file)
+            self.assertEqual(pool._delta_file, None)
+            self.assertFalse(os.path.exists(delta_file))
+
+            # Touching a post without changing its strings does not write
+            # anything
+            postdb.touch(p1)
+            test(('body',), '^body1$', [p1])
+            self.assertEqual(pool._delta_file, None)
+
+            # New and moved posts are written into the delta; the posts that
+            # are moved or removed are ignored in the snapshot
+            p5 = self.add_post(5)
+            postdb.move(self.p(3), ('my_heap', 'moved'))
+            test(('body',), '^body[35]$', [p5, self.p('moved')])
+            test(('postid',), '^my_heap/',
+                 [self.p(0), p1, self.p(2), self.p(4), p5,
+                  self.p('moved')])
+            self.assertEqual(pool._snapshot_file, snapshot_file)
+
+            # Changes in a batch block are seen inside the block
+            with postdb.batch():
+                p1.set_body('changed\n')
+                test(('body',), '^changed$', [p1])
+            test(('body',), '^changed$', [p1])
+            self.assertEqual(pool._snapshot_file, snapshot_file)
+
+            # Too many changes and touching the whole post database write the
+            # snapshot again
+            for post in postdb.real_posts():
+                post.set_tags(['all'])
+            test(('tags',), '^all$', postdb.real_posts())
+            self.assertNotEqual(pool._snapshot_file, snapshot_file)
+            self.assertEqual(pool._delta_file, None)
+            snapshot_file = pool._snapshot_file
+            postdb.touch()
+            test(('tags',), '^all$', postdb.real_posts())
+            self.assertNotEqual(pool._snapshot_file, snapshot_file)
+        finally:
+            hksearch.SNAPSHOT_DELTA_MAX_RATIO = old_max_ratio
+
+
+class Test_SearchIndex(unittest.TestCase, test_hklib.PostDBHandler):
+
+    """Tests :class:`hksearch.SearchIndex`."""
+
+    def setUp(self):
+        self.setUpDirs()
+        self.create_postdb()
+        self.create_threadst()
+        self._index = hksearch.SearchIndex(self._postdb)
+
+    def tearDown(self):
+        self._index.close()
+        self.tearDownDirs()
+
+    def test_tokenize(self):
+        """Tests :func:`hksearch.tokenize` and
+        :func:`hksearch.is_plain_word`."""
+
+        self.assertEqual(
+            hksearch.tokenize(['Hello, World!', 'foo_bar-baz\xc5\xb1x2']),
+            frozenset(['hello', 'world', 'foo_bar', 'baz', 'x2']))
+        self.assertTrue(hksearch.is_plain_word('Foo_1'))
+        self.assertFalse(hksearch.is_plain_word('foo.'))
+        self.assertFalse(hksearch.is_plain_word(''))
+        self.assertFalse(hksearch.is_plain_word('foo\n'))
+
+    def test_required_trigrams(self):
+        """Tests :func:`hksearch.trigrams` and
+        :func:`hksearch.required_trigrams`."""
+
+        self.assertEqual(
+            hksearch.trigrams(['aBcd', 'xy', 'efg']),
+            frozenset(['abc', 'bcd', 'efg']))
+
+        def test(pattern, trigrams):
+            self.assertEqual(hksearch.required_trigrams(pattern),
+                             frozenset(trigrams))
+
+        test('Abcd', ['abc', 'bcd'])
+        test('ab.cde', ['cde'])
+        test('abc|def', [])
+        test('x(abc|def)y', [])
+        test('(abc)+d?efg', ['abc', 'efg'])
+        test('(?:abc)*', [])
+        test('a[bc]def', ['def'])
+        test('\\bfoo\\b', ['foo'])
+        test('ab\xc5\xb1cd', [])
+        test('a\\.bc', ['a.b', '.bc'])
+        test('(', [])
+
+    def test_regexp_candidates(self):
+        """Tests :func:`hksearch.SearchIndex.regexp_candidates`."""
+
+        index = self._index
+        p = self.p
+        po = self.po
+
+        def test(fields, pattern, posts):
+            self.assertEqual(index.regexp_candidates(fields, pattern),
+                             set([ post.post_id() for post in posts ]))
+
+        test(['body'], 'body1', [p(1)])
+        test(['body'], 'Bod.1', [p(0), p(1), p(2), p(3), p(4), po(0)])
+        test(['body'], 'subject4', [])
+        test(['subject', 'body'], 'ject4', [p(4)])
+        test(['body'], 'dy3$', [p(3)])
+        self.assertEqual(index.regexp_candidates(['body'], 'b.dy'), None)
+        self.assertEqual(
+            index.regexp_candidates(['subject', 'body'], '(subject|body)4'),
+            None)
+
+        # The index is updated when a post is touched
+        p(1).set_body('new body')
+        test(['body'], 'body1', [])
+        test(['body'], 'new', [p(1)])
+
+    def test_candidates(self):
+        """Tests :func:`hksearch.SearchIndex.candidates`."""
+
+        index = self._index
+        p = self.p
+        po = self.po
+
+        def test(fields, word, posts):
+            self.assertEqual(index.candidates(fields, word),
+                             set([ post.post_id() for post in posts ]))
+
+        test(['body'], 'body1', [p(1)])
+        test(['body'], 'BODY0', [p(0), po(0)])
+        test(['body'], 'ody', [p(0), p(1), p(2), p(3), p(4), po(0)])
+        test(['author'], 'body1', [])
+        test(['author', 'subject'], 'subject4', [p(4)])
+
+        # Words without trigrams cannot be looked up
+        self.assertEqual(index.candidates(['body'], 'dy'), None)
+
+        # The index is updated when a post is touched
+        p(1).set_body('new body')
+        p(2).set_tags(['mytag'])
+        test(['body'], 'body1', [])
+        test(['body'], 'new', [p(1)])
+        test(['tags'], 'mytag', [p(2)])
+        self.assertFalse('dy1' in index._token_trigrams['body'])
+        self.assertTrue('new' in index._token_trigrams['body']['new'])
+        with self._postdb.batch():
+            p(2).set_tags([])
+            p(3).set_subject('mytag')
+        test(['tags'], 'mytag', [])
+        test(['subject'], 'mytag', [p(3)])
+
+        # Modifying other fields does not retokenize the post
+        index._post_field_tokens = None
+        p(1).set_date('')
+        del index._post_field_tokens
+
+        # New, moved and reloaded posts are updated in the index without
+        # rebuilding it
+        postdb = self._postdb
+        postings = index._postings
+        postdb.add_new_post(hklib.Post.from_str('\nnewpost'), 'my_heap', '5')
+        test(['body'], 'newpost', [p(5)])
+        postdb.move(p(4), 'my_heap/moved')
+        test(['body'], 'body4', [p('moved')])
+        postdb.save()
+        hkutils.string_to_file('\nreloaded',
+                               os.path.join(self._myheap_dir, '3.post'))
+        postdb.load_heap('my_heap')
+        test(['body'], 'reloaded', [p(3)])
+        self.assertTrue(index._postings is postings)
+
+        # The index is rebuilt after the whole database was touched
+        p(1)._body = 'changed silently'
+        self._postdb.touch()
+        self.assertEqual(index._postings, None)
+        test(['body'], 'silently', [p(1)])
+
+    def test_save(self):
+        """Tests that the index is saved into the cache directory."""
+
+        postdb = self._postdb
+        postdb.save()
+        cache_dir = os.path.join(self._dir, 'cache_dir')
+        os.mkdir(cache_dir)
+        postdb.set_cache_dir(cache_dir)
+        postdb.load_heap('my_heap')
+
+        # Building the index saves it
+        index = self._index
+        self.assertEqual(index.candidates(['body'], 'body1'),
+                         set([('my_heap', '1')]))
+        index_file = postdb.cache_file_name('my_heap', 'index')
+        self.assertEqual(index_file, os.path.join(cache_dir, 'my_heap.index'))
+        self.assertTrue(os.path.exists(index_file))
+
+        # The saved tokens are used if the stamp of the post did not change
+        saved = postdb.read_cache_file('my_heap', 'index',
+                                       hksearch.SEARCH_INDEX_VERSION)
+        stamp, field_tokens, field_trigrams = saved['1']
+        field_tokens['body'] = frozenset(['from_cache'])
+        postdb.write_cache_file('my_heap', 'index',
+                                hksearch.SEARCH_INDEX_VERSION, saved)
+        postdb.touch()
+        self.assertEqual(index.candidates(['body'], 'from_cache'),
+                         set([('my_heap', '1')]))
+
+        # The post is tokenized again if it is modified
+        self.p(1).set_body('body1')
+        postdb.touch()
+        self.assertEqual(index.candidates(['body'], 'from_cache'), set())
+
+
 if __name__ == '__main__':
     hkutils.set_log(False)
     unittest.main()